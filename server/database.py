@@ -0,0 +1,108 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from dotenv import load_dotenv
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool, StaticPool
+from sqlmodel import Session, create_engine
+
+load_dotenv()
+
+sqlite_url = os.getenv("DATABASE_URL") or "sqlite:///data/voizchat.db"
+
+db_pool_size = int(os.getenv("DB_POOL_SIZE") or 10)
+db_max_overflow = int(os.getenv("DB_MAX_OVERFLOW") or 10)
+db_pool_timeout = float(os.getenv("DB_POOL_TIMEOUT") or 30)
+db_threads = int(os.getenv("DB_THREADS") or 4)
+
+sqlite_journal_mode = (os.getenv("SQLITE_JOURNAL_MODE") or "WAL").upper()
+sqlite_synchronous = (os.getenv("SQLITE_SYNCHRONOUS") or "NORMAL").upper()
+sqlite_busy_timeout = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS") or 5000)
+sqlite_cache_size = int(os.getenv("SQLITE_CACHE_SIZE") or -32000)  # negative values are KiB, so ~32 MB
+sqlite_mmap_size = int(os.getenv("SQLITE_MMAP_SIZE") or 256 * 1024 * 1024)
+
+JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"}
+SYNCHRONOUS_MODES = {"OFF", "NORMAL", "FULL", "EXTRA"}
+
+if sqlite_journal_mode not in JOURNAL_MODES:
+    raise ValueError(f"invalid SQLITE_JOURNAL_MODE: {sqlite_journal_mode}")
+if sqlite_synchronous not in SYNCHRONOUS_MODES:
+    raise ValueError(f"invalid SQLITE_SYNCHRONOUS: {sqlite_synchronous}")
+
+
+def is_memory_database(url: str) -> bool:
+    return url in ("sqlite://", "sqlite:///:memory:") or "mode=memory" in url
+
+
+def set_sqlite_pragmas(dbapi_connection, _connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"PRAGMA journal_mode={sqlite_journal_mode}")
+        cursor.execute(f"PRAGMA synchronous={sqlite_synchronous}")
+        cursor.execute(f"PRAGMA busy_timeout={sqlite_busy_timeout:d}")
+        cursor.execute(f"PRAGMA cache_size={sqlite_cache_size:d}")
+        cursor.execute(f"PRAGMA mmap_size={sqlite_mmap_size:d}")
+    finally:
+        cursor.close()
+
+
+def create_db_engine(url: str = sqlite_url) -> Engine:
+    if not url.startswith("sqlite"):
+        return create_engine(url, pool_size=db_pool_size, max_overflow=db_max_overflow, pool_timeout=db_pool_timeout)
+
+    if is_memory_database(url):
+        # every pooled connection would see its own empty database
+        engine = create_engine(url, connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    else:
+        engine = create_engine(
+            url,
+            connect_args={"check_same_thread": False},
+            poolclass=QueuePool,
+            pool_size=db_pool_size,
+            max_overflow=db_max_overflow,
+            pool_timeout=db_pool_timeout,
+        )
+    event.listen(engine, "connect", set_sqlite_pragmas)
+    return engine
+
+
+def get_effective_pragmas(engine: Engine) -> dict:
+    if engine.dialect.name != "sqlite":
+        return {}
+    pragmas = {}
+    with engine.connect() as connection:
+        for pragma in ("journal_mode", "synchronous", "busy_timeout", "cache_size", "mmap_size"):
+            pragmas[pragma] = connection.exec_driver_sql(f"PRAGMA {pragma}").scalar()
+    return pragmas
+
+
+def check_database(engine: Engine):
+    pool = engine.pool
+    pool_info = f"{type(pool).__name__}(size={pool.size()})" if isinstance(pool, QueuePool) else type(pool).__name__
+    print(f"Database pool: {pool_info}, max_overflow={db_max_overflow}")
+    pragmas = get_effective_pragmas(engine)
+    if pragmas:
+        print("SQLite pragmas: " + ", ".join(f"{name}={value}" for name, value in pragmas.items()))
+        if sqlite_journal_mode == "WAL" and str(pragmas["journal_mode"]).upper() != "WAL":
+            print(f"WARNING: requested WAL journal mode but database is using {pragmas['journal_mode']}")
+
+
+print(f"Using database: {sqlite_url}")
+engine = create_db_engine()
+
+# all blocking database work started from async code goes through this pool,
+# so queries never run on the event loop and can't starve the websockets
+db_executor = ThreadPoolExecutor(max_workers=db_threads, thread_name_prefix="db")
+
+
+async def run_db(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(db_executor, partial(func, *args))
+
+
+async def run_in_session(func, *args):
+    def call():
+        with Session(engine, expire_on_commit=False) as session:
+            return func(session, *args)
+    return await run_db(call)
@@ -1,8 +1,9 @@
-﻿import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-import os
+﻿import os
 from dotenv import load_dotenv
+from sqlmodel import Session
+
+from database import engine
+from services.email_outbox import EmailOutbox
 
 load_dotenv()
 
@@ -11,31 +12,27 @@ sender_email = os.getenv("GMAIL_ADDRESS")
 
 password = os.getenv("GMAIL_PASSWORD")  # Use an app-specific password for Gmail
 
+# defaults are Gmail's; for local testing run python -m util.smtp_sink and set
+# SMTP_HOST=localhost SMTP_PORT=8025 SMTP_STARTTLS=0
+smtp_host = os.getenv("SMTP_HOST") or "smtp.gmail.com"
+smtp_port = int(os.getenv("SMTP_PORT") or 587)
+smtp_starttls = (os.getenv("SMTP_STARTTLS") or "1") == "1"
+smtp_username = os.getenv("SMTP_USERNAME") or sender_email
+
 webclient_base_url = os.getenv("WEBCLIENT_BASE_URL") or "http://localhost:5173"
 
-def send_email(receiver_email, subject, body):
-    # Construct the message
-    message = MIMEMultipart()
-    message["From"] = sender_email
-    message["To"] = receiver_email
-    message["Subject"] = subject
-    message.attach(MIMEText(body, "plain"))
-
-    try:
-        with smtplib.SMTP("smtp.gmail.com", 587) as server:
-            server.starttls()  # Upgrade connection to secure
-            server.login(sender_email, password)
-            server.sendmail(sender_email, receiver_email, message.as_string())
-            print("Email sent successfully!")
-    except Exception as e:
-        print(f"Error: {e}")
-
-def send_verification_email(receiver_email, verification_code):
+outbox = EmailOutbox(engine, sender_email or "voizchat@localhost", smtp_host, smtp_port, smtp_username, password, smtp_starttls)
+
+def send_email(session: Session, receiver_email, subject, body):
+    # queued in the caller's transaction and sent by the outbox worker once it commits
+    outbox.enqueue(session, receiver_email, subject, body)
+
+def send_verification_email(session: Session, receiver_email, verification_code):
     subject = "Verification Code"
     body = f"Your verification code is: {webclient_base_url}/verify/{verification_code}"
-    send_email(receiver_email, subject, body)
+    send_email(session, receiver_email, subject, body)
 
-def send_recovery_email(receiver_email, verification_code):
+def send_recovery_email(session: Session, receiver_email, verification_code):
     subject = "Password Recovery Code"
     body = f"Click on this link to reset your password: {webclient_base_url}/reset-password?email={receiver_email}&code={verification_code}"
-    send_email(receiver_email, subject, body)
\ No newline at end of file
+    send_email(session, receiver_email, subject, body)
\ No newline at end of file
@@ -1,27 +1,53 @@
-import hashlib
+import asyncio
 import os
+import math
+import secrets
 from contextlib import asynccontextmanager
 from typing import Annotated
-from fastapi import Depends, FastAPI, HTTPException, Query, Response,  WebSocket, WebSocketDisconnect, status, WebSocketException
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Response,  WebSocket, WebSocketDisconnect, status, WebSocketException
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from sqlmodel import Session, SQLModel, create_engine, select, text
-from base64 import b64encode, b64decode
+from sqlmodel import Session, select
+from base64 import b64encode
 import jwt
 from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 import time
 from enum import Enum
 
+from database import engine, check_database, run_db, run_in_session
+from migrations.runner import ensure_schema
+import email_service
 from email_service import send_verification_email, send_recovery_email
 from model.opened_chat import OpenedChat, OpenedChatResponse
-from services.websocket_manager import ConnectionManager
+from services.websocket_manager import ConnectionManager, login_timeout as ws_login_timeout
+from services.whiteboard_coalescer import WhiteboardCoalescer
+from services.whiteboard_store import WhiteboardStore
+from services.password_hasher import PasswordHasher, PasswordHasherBusy
+from services.auth_cache import AuthCache, AuthenticatedUser
+from services.message_history import InvalidCursor, PageBounds, clamp_page_size, decode_cursor, load_page_bounds, render_page, stream_page
+from services.message_cache import MessageCache
+from services.user_index import UserIndex, user_search_limit
+from services.presence import PresenceTracker
+from services.read_receipts import ReadReceipts
+from services.rate_limit import RateLimiter
+from services import compression, ws_codec
+from services.compression import CompressionMiddleware
+from services.ws_commands import ChannelLookup, CommandContext, CommandRegistry
+from services.message_search import InvalidSearchQuery, SearchBackfill, index_message, search_messages
 from model.user import User, CreateUserRequest, PrivateUserInfo, LoginRequest, UserInfo, RequestPasswordResetBody, ResetPasswordRequest
 from model.friend_list import FriendListEntry, FriendStateUpdate
-from model.message import Message, NewMessage
+from model.message import Message, MessageSearchResults, NewMessage
 from model.channels import Channel, ChannelUser, ChannelType
-from model.whiteboard import WhiteboardDrawData
+from model.unread_counter import UnreadCounter
+from model.presence import PresenceEntry
+from model.read_receipt import ReadMessageRequest
+from model.whiteboard import WhiteboardDrawData, WhiteboardSnapshot, WhiteboardSyncRequest
 from dotenv import load_dotenv
-from model.call import CallEnd, CallInvite, CallAnswer, CallIceCandidate
+from model.call import (
+    CallEnd, CallInvite, CallAnswer, CallIceCandidate,
+    CallEndRequest, CallInviteRequest, CallAnswerRequest, CallIceCandidateRequest
+)
 
 import logging
 #logging.basicConfig()
@@ -29,63 +55,17 @@ import logging
 #sqlalchemy_logging.setLevel(logging.DEBUG)
 load_dotenv()
 
-sqlite_url = os.getenv("DATABASE_URL") or "sqlite:///data/voizchat.db"
-print(f"Using database: {sqlite_url}")
-engine = create_engine(sqlite_url, connect_args={"check_same_thread": False})
+password_hasher = PasswordHasher()
 
 def hash_password(password: str):
-    salt = os.urandom(32)
-    passwordhash = hashlib.scrypt(password.encode("utf-8"), salt=salt, n=16384, r=8, p=1)
-    return f"1${b64encode(salt).decode('utf-8')}${b64encode(passwordhash).decode('utf-8')}"
+    return password_hasher.hash(password)
 
 def verify_password_hash(password_hash, password):
-    version, salt, expected_hash = password_hash.split('$')
-    if version != "1": return False
-    salt = b64decode(salt)
-    expected_hash = b64decode(expected_hash)
-    return hashlib.scrypt(password.encode("utf-8"), salt=salt, n=16384, r=8, p=1) == expected_hash
-
-
-def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
-    
-
-def initialize_users(session: Session):
-    if not session.exec(select(User)).all():
-        test_users = [
-            User(email="test1@example.com", username="test1", passwordhash=hash_password("asdf"), is_verified=True),
-            User(email="test2@example.com", username="test2", passwordhash=hash_password("asdf"), is_verified=True),
-            User(email="test3@example.com", username="test3", passwordhash=hash_password("asdf"), is_verified=True),
-            User(email="test4@example.com", username="test4", passwordhash=hash_password("asdf"), is_verified=True),
-            User(email="test5@example.com", username="test5", passwordhash=hash_password("asdf"), is_verified=True),
-            User(email="test6@example.com", username="test6", passwordhash=hash_password("asdf"), is_verified=True),
-            User(email="test7@example.com", username="test7", passwordhash=hash_password("asdf"), is_verified=True),
-            User(email="test8@example.com", username="test8", passwordhash=hash_password("asdf"), is_verified=True),
-            User(email="test9@example.com", username="test9", passwordhash=hash_password("asdf"), is_verified=True),
-        ]
-        session.add_all(test_users)
-        session.add_all([
-            FriendListEntry(user_id=1, friend_id=4, pending=False),
-            FriendListEntry(user_id=1, friend_id=5, pending=True),
-            FriendListEntry(user_id=1, friend_id=7, pending=True),
-            FriendListEntry(user_id=1, friend_id=9, pending=False),
-            FriendListEntry(user_id=2, friend_id=1, pending=False),
-            FriendListEntry(user_id=2, friend_id=9, pending=False),
-            FriendListEntry(user_id=3, friend_id=7, pending=False),
-            FriendListEntry(user_id=4, friend_id=5, pending=False),
-            FriendListEntry(user_id=6, friend_id=1, pending=True),
-            FriendListEntry(user_id=6, friend_id=7, pending=False),
-            FriendListEntry(user_id=7, friend_id=2, pending=False),
-            FriendListEntry(user_id=7, friend_id=5, pending=False),
-            FriendListEntry(user_id=8, friend_id=3, pending=False),
-            FriendListEntry(user_id=8, friend_id=1, pending=True),
-        ])
-        session.commit()
-    
+    return password_hasher.verify(password_hash, password)
 
 
 def get_session():
-    with Session(engine) as session:
+    with Session(engine, expire_on_commit=False) as session:
         yield session
 
 
@@ -96,21 +76,42 @@ SessionDep = Annotated[Session, Depends(get_session)]
 async def lifespan(_app: FastAPI):
     # Startup
     hash(_app)
-    create_db_and_tables()
+    ensure_schema(engine)
+    check_database(engine)
     with Session(engine) as session:
-        initialize_users(session)
+        user_index.load(session)
+    await manager.start()
+    presence.start()
+    read_receipts.start()
+    email_service.outbox.start()
+    backfill_task = asyncio.create_task(search_backfill.run())
     yield
     # Cleanup
-    pass
+    backfill_task.cancel()
+    presence.stop()
+    await read_receipts.stop()
+    await email_service.outbox.stop()
+    await manager.stop()
+    whiteboard_store.save_all()
 
 app = FastAPI(lifespan=lifespan)
 
 
+@app.exception_handler(PasswordHasherBusy)
+async def password_hasher_busy_handler(_request, _exc: PasswordHasherBusy):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Server is busy, try again later"},
+        headers={"Retry-After": "1"},
+    )
+
+
 origins = [
     "http://localhost:5173",  # Vite's default dev server
     "http://127.0.0.1:5173"  # Alternative localhost
 ]
 
+app.add_middleware(CompressionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -141,7 +142,11 @@ credentials_exception = HTTPException(
     detail="Could not validate credentials",
     headers={"WWW-Authenticate": "Bearer"},
 )
+
 async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], session: SessionDep):
+    cached_user = auth_cache.get(token)
+    if cached_user:
+        return cached_user
     try:
         payload = jwt.decode(token, jwt_public_key, algorithms=["EdDSA"])
         user_id: int = payload.get("uid")
@@ -151,22 +156,27 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], sessio
     except jwt.InvalidTokenError as e:
         print(e)
         raise credentials_exception
-    user = session.get(User, user_id)
+    user = await run_db(session.get, User, user_id)
     if user is None:
         print("user not found")
         raise credentials_exception
-    return user
+    authenticated_user = AuthenticatedUser.from_user(user)
+    auth_cache.put(token, authenticated_user, payload.get("exp"))
+    return authenticated_user
 
 async def get_current_active_user(
-    current_user: Annotated[User, Depends(get_current_user)],
+    current_user: Annotated[AuthenticatedUser, Depends(get_current_user)],
 ):
     if not current_user.is_verified:
         raise HTTPException(status_code=400, detail="Unverified user")
     return current_user
 
-UserDep = Annotated[User, Depends(get_current_active_user)]
+UserDep = Annotated[AuthenticatedUser, Depends(get_current_active_user)]
 
-async def get_active_user_by_token(token: str, session: Session):
+def get_active_user_by_token(session: Session, token: str):
+    cached_user = auth_cache.get(token)
+    if cached_user:
+        return cached_user if cached_user.is_verified else None
     try:
         payload = jwt.decode(token, jwt_public_key, algorithms=["EdDSA"])
         user_id: int = payload.get("uid")
@@ -175,30 +185,49 @@ async def get_active_user_by_token(token: str, session: Session):
     except jwt.InvalidTokenError as e:
         return None
     user = session.get(User, user_id)
-    if user is None or not user.is_verified:
+    if user is None:
         return None
-    return user
+    authenticated_user = AuthenticatedUser.from_user(user)
+    auth_cache.put(token, authenticated_user, payload.get("exp"))
+    return authenticated_user if authenticated_user.is_verified else None
 
 
 manager = ConnectionManager()
+# per-process caches, kept in step across workers by envelopes on the manager's broker
+auth_cache = AuthCache(manager)
+user_index = UserIndex(manager)
+message_cache = MessageCache(manager)
+whiteboard_store = WhiteboardStore(manager)
+presence = PresenceTracker(manager)
+read_receipts = ReadReceipts(manager)
+rate_limiter = RateLimiter()
+ws_commands = CommandRegistry(ChannelLookup(manager), rate_limiter)
+whiteboard_coalescer = WhiteboardCoalescer(manager)
+search_backfill = SearchBackfill()
 
 async def receive_websocket_cmd(ws: WebSocket):
-    data = await ws.receive_json()
+    # JSON text or, from clients that negotiated it, msgpack binary frames
+    message = await ws.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message["code"], message.get("reason"))
     try:
-        return data["cmd"], data["data"]
+        if message.get("bytes") is not None:
+            return ws_codec.decode_binary(message["bytes"])
+        return ws_codec.decode_text(message["text"])
     except Exception as e:
         print(e)
         raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION)
 
 @app.websocket("/api/ws")
-async def websocket_endpoint(websocket: WebSocket, session: SessionDep):
+async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
 
-    data = await websocket.receive_json()
     try:
+        # a client that never logs in would otherwise hold the socket open forever
+        data = await asyncio.wait_for(websocket.receive_json(), ws_login_timeout)
         if data["cmd"] == "login":
             token = data["data"]["token"]
-            current_user = await get_active_user_by_token(token, session)
+            current_user = await run_in_session(get_active_user_by_token, token)
             if not current_user:
                 raise ValueError("cannot authenticate user")
         else:
@@ -207,84 +236,124 @@ async def websocket_endpoint(websocket: WebSocket, session: SessionDep):
         print(e)
         raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION)
 
-    await manager.connect(websocket, current_user)
+    # login is always JSON; an unknown encoding falls back to JSON, clients tell frames apart by type
+    encoding = data["data"].get("encoding")
+    connection = await manager.connect(websocket, current_user, encoding if encoding in ws_codec.ENCODINGS else ws_codec.JSON)
+    context = CommandContext(current_user, connection)
     try:
         while True:
             (cmd, data) = await receive_websocket_cmd(websocket)
-            if cmd == "read_message":
-                message_id = data.get("message_id")
-                message = session.get(Message, message_id)
-                ChannelUser.update_last_read_message_id(session, str(current_user.userid), message)
-            elif cmd == "whiteboard":
-                channel_id = data.get("channel_id")
-                channel = session.exec(select(Channel).where(Channel.channel_id == channel_id)).first()
-                if channel:
-                    await manager.broadcast_to_channel(
-                        session,
-                        channel,
-                        "whiteboard",
-                        WhiteboardDrawData(**data),
-                        current_user
-                    )
-            elif cmd == "call-invite":
-                channel_id = data.get("channel_id")
-                channel = session.exec(select(Channel).where(Channel.channel_id == channel_id)).first()
-                if channel:
-                    offer = data.get("offer")
-                    if not offer or "type" not in offer or "sdp" not in offer:
-                        print("Invalid offer received:", offer)
-                        continue
-                    await manager.broadcast_to_channel(
-                        session,
-                        channel,
-                        "call-invite",
-                        CallInvite(caller_id=str(current_user.userid), offer=offer),
-                        current_user
-                    )
-            elif cmd == "call-answer":
-                channel_id = data.get("channel_id")
-                channel = session.exec(select(Channel).where(Channel.channel_id == channel_id)).first()
-
-                if channel:
-                    answer = data.get("answer")
-                    if not answer or "type" not in answer or "sdp" not in answer:
-                        print("Invalid answer received:", answer)
-                        continue
-                    await manager.broadcast_to_channel(
-                        session,
-                        channel,
-                        "call-answer",
-                        CallAnswer(caller_id=str(current_user.userid), answer=answer),
-                        current_user
-                    )
-            elif cmd == "call-end":
-                channel_id = data.get("channel_id")
-                channel = session.exec(select(Channel).where(Channel.channel_id == channel_id)).first()
-                
-                if channel:
-                    await manager.broadcast_to_channel(
-                        session,
-                        channel,
-                        "call-end",
-                        CallEnd(caller_id=str(current_user.userid), channel_id=channel_id),
-                        current_user
-                        )
-            elif cmd == "call-ice-candidate":
-                channel_id = data.get("channel_id")
-                channel = session.exec(select(Channel).where(Channel.channel_id == channel_id)).first()
-
-                if channel:
-                    candidate = data.get("candidate")
-                    await manager.broadcast_to_channel(
-                        session,
-                        channel,
-                        "call-ice-candidate",
-                        CallIceCandidate(caller_id=str(current_user.userid), candidate=candidate),
-                        current_user
-                    )
+            connection.touch()
+            if cmd == "pong":
+                # answers the server's ping, proves the socket is alive but not that the user is
+                continue
+            # any other command counts as activity, clients send "heartbeat" on user input while otherwise quiet
+            presence.activity(current_user.userid)
+            await ws_commands.dispatch(context, cmd, data)
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket)
 
+@ws_commands.command("heartbeat")
+async def heartbeat_command(context: CommandContext, data):
+    pass
+
+@ws_commands.command("read_message", ReadMessageRequest)
+async def read_message_command(context: CommandContext, request: ReadMessageRequest):
+    # membership is checked when the batch is written
+    channel_id = request.channel_id or await run_in_session(Message.channel_id_of, request.message_id)
+    if channel_id:
+        read_receipts.mark_read(context.user.userid, channel_id, request.message_id)
+
+@ws_commands.command("whiteboard", WhiteboardDrawData, channel=True, rate_class="whiteboard")
+async def whiteboard_command(context: CommandContext, draw_data: WhiteboardDrawData, channel: Channel):
+    await whiteboard_store.append(draw_data)
+    whiteboard_coalescer.add(
+        await manager.get_channel_members(channel),
+        context.user.userid,
+        draw_data
+    )
+
+@ws_commands.command("whiteboard-sync", WhiteboardSyncRequest, channel=True, rate_class="whiteboard_sync")
+async def whiteboard_sync_command(context: CommandContext, request: WhiteboardSyncRequest, channel: Channel):
+    snapshot = await whiteboard_store.snapshot(str(channel.channel_id))
+    context.connection.send(
+        "whiteboard-snapshot",
+        WhiteboardSnapshot(channel_id=str(channel.channel_id), snapshot=b64encode(snapshot).decode("utf-8"))
+    )
+
+@ws_commands.command("call-invite", CallInviteRequest, channel=True, rate_class="call")
+async def call_invite_command(context: CommandContext, request: CallInviteRequest, channel: Channel):
+    await manager.broadcast_to_channel(
+        channel,
+        "call-invite",
+        CallInvite(caller_id=str(context.user.userid), offer=request.offer.model_dump()),
+        context.user
+    )
+
+@ws_commands.command("call-answer", CallAnswerRequest, channel=True, rate_class="call")
+async def call_answer_command(context: CommandContext, request: CallAnswerRequest, channel: Channel):
+    await manager.broadcast_to_channel(
+        channel,
+        "call-answer",
+        CallAnswer(caller_id=str(context.user.userid), answer=request.answer.model_dump()),
+        context.user
+    )
+
+@ws_commands.command("call-end", CallEndRequest, channel=True, rate_class="call")
+async def call_end_command(context: CommandContext, request: CallEndRequest, channel: Channel):
+    await manager.broadcast_to_channel(
+        channel,
+        "call-end",
+        CallEnd(caller_id=str(context.user.userid), channel_id=request.channel_id),
+        context.user
+    )
+
+@ws_commands.command("call-ice-candidate", CallIceCandidateRequest, channel=True, rate_class="call")
+async def call_ice_candidate_command(context: CommandContext, request: CallIceCandidateRequest, channel: Channel):
+    await manager.broadcast_to_channel(
+        channel,
+        "call-ice-candidate",
+        CallIceCandidate(caller_id=str(context.user.userid), candidate=request.candidate),
+        context.user
+    )
+
+
+# /api/metrics lists server internals, it is only served to callers presenting this token
+metrics_token = os.getenv("METRICS_TOKEN") or ""
+
+def require_metrics_token(authorization: Annotated[str | None, Header()] = None):
+    if not metrics_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not secrets.compare_digest(token.encode(), metrics_token.encode()):
+        raise HTTPException(status_code=401, detail="Invalid metrics token", headers={"WWW-Authenticate": "Bearer"})
+
+@app.get("/api/metrics", dependencies=[Depends(require_metrics_token)])
+def get_metrics() -> dict:
+    return {
+        "channel_members": manager.channel_members_stats(),
+        "fanout": manager.fanout_stats.as_dict(),
+        "connections": manager.connection_stats(),
+        "heartbeat": manager.heartbeat_stats(),
+        "encodings": manager.encoding_stats(),
+        "compression": compression.stats(),
+        "email_outbox": email_service.outbox.stats(),
+        "whiteboard": whiteboard_coalescer.stats(),
+        "pubsub": manager.broker.stats(),
+        "presence": presence.stats(),
+        "read_receipts": read_receipts.stats(),
+        "ws_commands": ws_commands.stats(),
+        "rate_limit": rate_limiter.stats(),
+        "whiteboard_store": whiteboard_store.stats(),
+        "password_hasher": password_hasher.stats(),
+        "auth_cache": auth_cache.stats(),
+        "user_index": user_index.stats(),
+        "message_cache": message_cache.stats(),
+        "search_backfill": search_backfill.stats(),
+    }
+
 
 @app.post("/api/users/register", response_model=dict)
 def create_user(user_request: CreateUserRequest, session: SessionDep):
@@ -293,10 +362,11 @@ def create_user(user_request: CreateUserRequest, session: SessionDep):
     session.add(user)
     session.commit()
     session.refresh(user)
+    user_index.add(user.userid, user.username)
 
     user.verification_code = os.urandom(20).hex()
     user.verification_code_expiration = int(time.time()) + 60 * 60 * 24  # one day
-    send_verification_email(user_request.email, user.verification_code)
+    send_verification_email(session, user_request.email, user.verification_code)
 
     session.commit()
 
@@ -321,6 +391,7 @@ def verify_user(verification_code: str, session: SessionDep):
         user.verification_code_expiration = None
         session.commit()
         session.refresh(user)
+        auth_cache.invalidate_user(user.id)
         return Response(status_code=204)
     
     raise HTTPException(status_code=404, detail="Verification code not found")
@@ -328,7 +399,7 @@ def verify_user(verification_code: str, session: SessionDep):
 
 @app.post("/api/users/login", response_model=dict)
 def login_user(user_request: LoginRequest, session: SessionDep):
-    user = session.exec(select(User).where(User.email == user_request.email)).first()
+    user = User.by_email(session, user_request.email)
 
     if not user or not verify_password_hash(user.passwordhash, user_request.password):
         raise HTTPException(status_code=401, detail="Invalid username or password")
@@ -345,7 +416,7 @@ def login_user(user_request: LoginRequest, session: SessionDep):
 
 @app.post("/api/users/token")
 def login_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], session: SessionDep) -> dict[str, str]:
-    user = session.exec(select(User).where(User.email == form_data.username)).first()
+    user = User.by_email(session, form_data.username)
     if not user or not verify_password_hash(user.passwordhash, form_data.password):
         raise HTTPException(status_code=401, detail="Invalid username or password")
     one_week_in_seconds = 60*60*24*7
@@ -356,20 +427,20 @@ def login_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], sess
 
 @app.post("/api/users/request-password-reset")
 def request_password_reset(data: RequestPasswordResetBody, session: SessionDep):
-    user = session.exec(select(User).where(User.email == data.email)).first()
+    user = User.by_email(session, data.email)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
     user.reset_password_token = os.urandom(20).hex()
     user.reset_password_token_expiration = int(time.time()) + 60 * 15
-    send_recovery_email(user.email, user.reset_password_token)
+    send_recovery_email(session, user.email, user.reset_password_token)
     session.commit()
 
     return {"message": "Reset email sent."}
 
 @app.post("/api/users/reset-password")
 def reset_password(data: ResetPasswordRequest, session: SessionDep):
-    user = session.exec(select(User).where(User.email == data.email)).first()
+    user = User.by_email(session, data.email)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
@@ -384,27 +455,37 @@ def reset_password(data: ResetPasswordRequest, session: SessionDep):
     user.reset_password_token = None
     user.reset_password_token_expiration = None
     session.commit()
+    auth_cache.invalidate_user(user.id)
 
     return {"success": True, "message": "Password reset successfully."}
 
 @app.get("/api/users/")
 def read_users(
     session: SessionDep,
-    offset: int = 0,
+    after: str | None = None,
     limit: Annotated[int, Query(le=100)] = 100,
 ) -> list[UserInfo]:
+    # keyset pagination: pass the last userid of a page as `after` to get the next one
     return [
         UserInfo.from_user(user)
-             for user in session.exec(select(User).offset(offset).limit(limit)).all()
+             for user in User.page(session, after, limit)
     ]
 
+@app.get("/api/users/search")
+async def search_users(
+    prefix: Annotated[str, Query(min_length=1)],
+    current_user: UserDep,
+    limit: int = user_search_limit,
+) -> list[UserInfo]:
+    return user_index.search(prefix, limit)
+
 @app.get("/api/users/me")
 def get_current_user(current_user: UserDep) -> UserInfo:
     return UserInfo.from_user(current_user)
 
 @app.get("/api/users/find-by-id/{userid}")
 def read_user(userid: str, session: SessionDep, current_user: UserDep) -> UserInfo:
-    user = session.exec(select(User).where(User.userid == userid)).first()
+    user = User.by_userid(session, userid)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return UserInfo.from_user(user)
@@ -416,12 +497,14 @@ def delete_user(user_id: int, session: SessionDep):
         raise HTTPException(status_code=404, detail="User not found")
     session.delete(user)
     session.commit()
+    auth_cache.invalidate_user(user_id)
+    user_index.remove(user.userid, user.username)
     return {"ok": True}
 
 @app.post("/api/users/reset-password")
 #TBD
 def reset_password(user_request: CreateUserRequest, session: SessionDep) -> dict[str, str]:
-    user = session.exec(select(User).where(User.email == user_request.email)).first()
+    user = User.by_email(session, user_request.email)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     user.passwordhash = hash_password(user_request.password)
@@ -433,27 +516,22 @@ def find_user_by_name(username: str, session: SessionDep) -> UserInfo:
         raise HTTPException(status_code=404, detail="User not found")
     return UserInfo.from_user(user)
 
+
 @app.post("/api/user/add-friend/{user_id}", status_code=201)
 async def add_friend(user_id: str, session: SessionDep, current_user: UserDep):
     if user_id == current_user.userid:
         raise HTTPException(status_code=400, detail="Cannot add yourself as a friend")
 
-    friend = session.exec(select(User).where(User.userid == user_id)).first()
+    friend = await run_db(User.by_userid, session, user_id)
     if not friend:
         raise HTTPException(status_code=404, detail="User not found")
 
-    friend_entry = session.exec(
-        select(FriendListEntry)
-        .where(
-            ((FriendListEntry.user_id == friend.id) & (FriendListEntry.friend_id == current_user.id)) |
-            ((FriendListEntry.friend_id == friend.id) & (FriendListEntry.user_id == current_user.id))
-        )
-    ).first()
+    friend_entry = await run_db(FriendListEntry.find, session, current_user.id, friend.id)
 
     if not friend_entry:
         friend_entry = FriendListEntry(user_id=current_user.id, friend_id=friend.id)
         session.add(friend_entry)
-        session.commit()
+        await run_db(session.commit)
         await manager.broadcast_to_user(
             current_user.userid,
             "friend-state-update",
@@ -470,7 +548,8 @@ async def add_friend(user_id: str, session: SessionDep, current_user: UserDep):
         if friend_entry.friend_id == current_user.id:
             friend_entry.pending = False
             friend_entry.date_added = int(time.time())
-            session.commit()
+            await run_db(session.commit)
+            presence.invalidate_friends(current_user.userid, friend.userid)
 
             await manager.broadcast_to_user(
                 current_user.userid,
@@ -490,19 +569,10 @@ async def add_friend(user_id: str, session: SessionDep, current_user: UserDep):
 
 @app.post("/api/user/remove-friend/{user_id}", status_code=204)
 async def remove_friend(user_id: str, session: SessionDep, current_user: UserDep):
-    friend = session.exec(select(User).where(User.userid == user_id)).first()
+    friend = await run_db(User.by_userid, session, user_id)
     if not friend:
         raise HTTPException(status_code=404, detail="User not found")
-    entry = session.exec(
-        select(FriendListEntry)
-        .where(
-            (
-                (FriendListEntry.user_id == friend.id) & (FriendListEntry.friend_id == current_user.id)
-            ) | (
-                (FriendListEntry.friend_id == friend.id) & (FriendListEntry.user_id == current_user.id)
-            )
-        )
-    ).first()
+    entry = await run_db(FriendListEntry.find, session, current_user.id, friend.id)
 
     if not entry:
         raise HTTPException(status_code=404, detail="User not a friend")
@@ -543,59 +613,79 @@ async def remove_friend(user_id: str, session: SessionDep, current_user: UserDep
              FriendStateUpdate(other_user=UserInfo.from_user(current_user), new_state="remove-friend")
         )
 
-    session.delete(entry)
-    session.commit()
+    await run_db(session.delete, entry)
+    await run_db(session.commit)
+    presence.invalidate_friends(current_user.userid, friend.userid)
     return Response(status_code=204)
 
 
-def get_friend_list_entries(session: SessionDep, user: User, what: str):
-    if what == "friends":
-        condition = ((FriendListEntry.user_id == user.id) | (FriendListEntry.friend_id == user.id)) & (FriendListEntry.pending == False)
-        onclause =  (((User.id == FriendListEntry.friend_id) & (FriendListEntry.user_id == user.id)) |
-                     ((User.id == FriendListEntry.user_id) & (FriendListEntry.friend_id == user.id)))
-    elif what == "outgoing-requests":
-        condition = (FriendListEntry.user_id == user.id) & (FriendListEntry.pending == True)
-        onclause = (User.id == FriendListEntry.friend_id)
-    elif what == "incoming-requests":
-        condition = (FriendListEntry.friend_id == user.id) & (FriendListEntry.pending == True)
-        onclause = (User.id == FriendListEntry.user_id)
-
-    return session.exec(
-        select(User)
-        .join(FriendListEntry, onclause)
-        .where(condition)
-    ).all()
+@app.get("/api/presence/friends")
+async def get_friends_presence(current_user: UserDep) -> list[PresenceEntry]:
+    return await presence.friends_presence(current_user.userid)
 
 @app.get("/api/user/get-friends")
 def get_friends(session: SessionDep, current_user: UserDep) -> list[UserInfo]:
-    return [UserInfo.from_user(friend) for friend in get_friend_list_entries(session, current_user, "friends")]
+    return [UserInfo.from_user(friend) for friend in FriendListEntry.list_users(session, current_user.id, "friends")]
 
 @app.get("/api/user/outgoing-friend-requests")
 def get_friends(session: SessionDep, current_user: UserDep) -> list[UserInfo]:
-    return [UserInfo.from_user(friend) for friend in get_friend_list_entries(session, current_user, "outgoing-requests")]
+    return [UserInfo.from_user(friend) for friend in FriendListEntry.list_users(session, current_user.id, "outgoing-requests")]
 
 @app.get("/api/user/incoming-friend-requests")
 def get_friends(session: SessionDep, current_user: UserDep) -> list[UserInfo]:
-    return [UserInfo.from_user(friend) for friend in get_friend_list_entries(session, current_user, "incoming-requests")]
+    return [UserInfo.from_user(friend) for friend in FriendListEntry.list_users(session, current_user.id, "incoming-requests")]
 
 
-@app.post("/api/message/{channel_id}")
-async def post_message(new_message: NewMessage, channel_id: str, current_user: UserDep,
-                       session: SessionDep):
-    channel = session.exec(select(Channel).where(Channel.channel_id == channel_id)).first()
-    if not channel:
-        raise HTTPException(status_code=404, detail="User not found")
+def insert_message(session: Session, channel: Channel, sender: User, text: str) -> Message:
     timestamp = int(time.time())
     channel.last_update = timestamp
-    message = Message(channel_id = channel.channel_id, sender_id = current_user.userid,
-                      message=new_message.message, created_at=timestamp)
+    message = Message(channel_id = channel.channel_id, sender_id = sender.userid,
+                      message=text, created_at=timestamp)
     session.add(message)
+    session.flush()
+    index_message(session, message)
+    UnreadCounter.increment_for_channel(session, str(channel.channel_id), str(sender.userid))
     session.commit()
     session.refresh(message)
+    return message
+
+def check_rate_limit(rate_class: str, scope: str, key):
+    retry_after = rate_limiter.check(rate_class, scope, key)
+    if retry_after:
+        raise HTTPException(
+            status_code=429,
+            detail=f"Too many requests, {scope} limit reached",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+
+@app.post("/api/message/{channel_id}")
+async def post_message(new_message: NewMessage, channel_id: str, current_user: UserDep,
+                       session: SessionDep):
+    check_rate_limit("message", "user", current_user.userid)
+    channel = await run_db(Channel.by_channel_id, session, channel_id)
+    if not channel:
+        raise HTTPException(status_code=404, detail="User not found")
+    check_rate_limit("message", "channel", channel.channel_id)
+    message = await run_db(insert_message, session, channel, current_user, new_message.message)
+    message_cache.append(message)
 
-    await manager.broadcast_to_channel(session, channel, "message", message, current_user)
+    await manager.broadcast_to_channel(channel, "message", message, current_user)
     return message
 
+async def load_recent_messages(session: Session, channel: Channel, limit: int) -> list[tuple[int, str]]:
+    # newest `limit` messages as (id, json), from the ring buffer when the channel is cached
+    channel_id = str(channel.channel_id)
+    entries = message_cache.latest(channel_id, limit)
+    if entries is not None:
+        return entries
+    message_cache.begin_load(channel_id)
+    messages = None
+    try:
+        messages = await run_db(Message.latest, session, channel.channel_id, message_cache.per_channel)
+    finally:
+        message_cache.finish_load(channel_id, messages)
+    return [(message.id, message.model_dump_json()) for message in messages[-limit:]]
+
 @app.get("/api/messages/{channel_id}")
 async def get_messages(
     channel_id: str,
@@ -604,35 +694,76 @@ async def get_messages(
     limit: int = 20,
     before_id: int | None = None,
 ):
-    channel = session.exec(select(Channel).where(Channel.channel_id == channel_id)).first()
+    channel = await run_db(Channel.by_channel_id, session, channel_id)
+    if not channel:
+        raise HTTPException(status_code=404, detail="Channel not found")
+    limit = clamp_page_size(limit)
+    if before_id is None and limit <= message_cache.per_channel:
+        entries = await load_recent_messages(session, channel, limit)
+        return Response(content="[" + ",".join(encoded for _, encoded in entries) + "]", media_type="application/json")
+    return await run_db(Message.latest, session, channel.channel_id, limit, before_id)
+
+@app.get("/api/messages/{channel_id}/history")
+async def get_message_history(
+    channel_id: str,
+    current_user: UserDep,
+    session: SessionDep,
+    cursor: str | None = None,
+    before: int | None = None,
+    after: int | None = None,
+    around: int | None = None,
+    limit: int | None = None,
+    if_none_match: Annotated[str | None, Header()] = None,
+):
+    channel = await run_db(Channel.by_channel_id, session, channel_id)
     if not channel:
         raise HTTPException(status_code=404, detail="Channel not found")
-    query = select(Message).where(Message.channel_id == channel.channel_id)
-    if before_id is not None:
-        query = query.where(Message.id < before_id)
-    query = query.order_by(Message.id.desc()).limit(limit)
-    return list(session.exec(query))[::-1]
 
-@app.get("/api/opened_chat/all")
-async def get_opened_chats(current_user:UserDep, session: SessionDep) -> list[OpenedChatResponse]:
-    channels = session.exec(
-        select(Channel)
-        .join(OpenedChat, Channel.channel_id == OpenedChat.channel_id)
-        .where(OpenedChat.user_id == current_user.userid)
-    ).all()
-
-    unread_messages_count_query=text(
-    '''
-        SELECT COUNT(*) AS count, messages.channel_id
-        FROM messages
-        JOIN channel_users ON messages.channel_id = channel_users.channel_id
-        WHERE channel_users.user_id = :userid AND
-        channel_users.last_read_message_id < messages.id
-        GROUP BY messages.channel_id;
-    ''').params(userid = str(current_user.userid))
-
-    unread_messages_result = session.exec(unread_messages_count_query).all()
-    unread_messages_dict = {row.channel_id: row.count for row in unread_messages_result}
+    if cursor is not None:
+        try:
+            direction, message_id = decode_cursor(cursor)
+        except InvalidCursor:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    else:
+        anchors = [(name, value) for name, value in (("before", before), ("after", after), ("around", around)) if value is not None]
+        if len(anchors) > 1:
+            raise HTTPException(status_code=400, detail="Only one of before, after and around can be given")
+        direction, message_id = anchors[0] if anchors else ("latest", None)
+
+    limit = clamp_page_size(limit)
+    entries = None
+    if direction == "latest" and limit <= message_cache.per_channel:
+        entries = await load_recent_messages(session, channel, limit)
+        bounds = PageBounds.from_entries(str(channel.channel_id), entries)
+    else:
+        bounds = await run_db(load_page_bounds, session, str(channel.channel_id), direction, message_id, limit)
+    headers = {"ETag": bounds.etag, "Cache-Control": "private, no-cache"}
+    if if_none_match is not None and bounds.etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    if entries is not None:
+        return Response(content=render_page(bounds, [encoded for _, encoded in entries]), media_type="application/json", headers=headers)
+    return StreamingResponse(stream_page(engine, bounds), media_type="application/json", headers=headers)
+
+@app.get("/api/search/messages")
+async def get_search_messages(
+    q: str,
+    current_user: UserDep,
+    session: SessionDep,
+    channel_id: str | None = None,
+    cursor: str | None = None,
+    limit: int | None = None,
+) -> MessageSearchResults:
+    try:
+        results, next_cursor = await run_db(search_messages, session, str(current_user.userid), q, channel_id,
+                                            cursor, clamp_page_size(limit))
+    except InvalidSearchQuery:
+        raise HTTPException(status_code=400, detail="Invalid search query")
+    return MessageSearchResults(results=results, next_cursor=next_cursor)
+
+def load_opened_chats(session: Session, current_user: User) -> list[OpenedChatResponse]:
+    channels = OpenedChat.channels_for_user(session, current_user.userid)
+
+    unread_messages_dict = UnreadCounter.for_user(session, str(current_user.userid))
 
     return [
         OpenedChatResponse(channel = channel, users=[
@@ -642,16 +773,18 @@ async def get_opened_chats(current_user:UserDep, session: SessionDep) -> list[Op
         for channel in channels
     ]
 
+@app.get("/api/opened_chat/all")
+async def get_opened_chats(current_user:UserDep, session: SessionDep) -> list[OpenedChatResponse]:
+    return await run_db(load_opened_chats, session, current_user)
+
 
 class OpenChatOpenMode(str, Enum):
     user = "user"
     channel = "channel"
 
-@app.post("/api/opened_chat/{open_mode}/{target_id}")
-async def post_opened_chat(open_mode: OpenChatOpenMode, target_id: str, current_user:
-UserDep, session: SessionDep) -> OpenedChatResponse:
+def open_chat(session: Session, open_mode: OpenChatOpenMode, target_id: str, current_user: User) -> OpenedChatResponse:
     if open_mode == OpenChatOpenMode.user:
-        user = session.exec(select(User).where(User.userid == target_id)).first()
+        user = User.by_userid(session, target_id)
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         channel = ChannelUser.find_user_channel(session, current_user.userid, user.userid)
@@ -667,12 +800,11 @@ UserDep, session: SessionDep) -> OpenedChatResponse:
 
 
     elif open_mode == OpenChatOpenMode.channel:
-        channel = session.exec(select(Channel).where(Channel.channel_id == target_id)).first()
+        channel = Channel.by_channel_id(session, target_id)
         if not channel:
             raise HTTPException(status_code=404, detail="Channel not found")
 
-    if not session.exec(select(OpenedChat).where((OpenedChat.user_id == current_user.userid) & (
-            OpenedChat.channel_id == channel.channel_id))).first():
+    if not OpenedChat.find(session, current_user.userid, channel.channel_id):
         opened_chat = OpenedChat(user_id=current_user.userid, channel_id=channel.channel_id)
         session.add(opened_chat)
         print("commit()")
@@ -686,19 +818,27 @@ UserDep, session: SessionDep) -> OpenedChatResponse:
     else:
         raise HTTPException(status_code=400, detail="Chat already exists")
 
-@app.delete("/api/opened_chat/{channel_id}")
-async def delete_opened_chat(channel_id: str, current_user: UserDep, session: SessionDep):
-    channel = session.exec(select(Channel).where(Channel.channel_id == channel_id)).first()
+@app.post("/api/opened_chat/{open_mode}/{target_id}")
+async def post_opened_chat(open_mode: OpenChatOpenMode, target_id: str, current_user:
+UserDep, session: SessionDep) -> OpenedChatResponse:
+    response = await run_db(open_chat, session, open_mode, target_id, current_user)
+    manager.invalidate_channel_members(response.channel.channel_id)
+    return response
+
+def close_opened_chat(session: Session, channel_id: str, current_user: User):
+    channel = Channel.by_channel_id(session, channel_id)
     if not channel:
         raise HTTPException(status_code=404, detail="User not found")
     if channel.channel_type == ChannelType.user:
-        delete_chat = session.exec(select(OpenedChat).where(
-            (OpenedChat.user_id == current_user.userid) & (OpenedChat.channel_id == channel_id)
-        )).first()
+        delete_chat = OpenedChat.find(session, current_user.userid, channel_id)
 
         if delete_chat:
             session.delete(delete_chat)
             session.commit()
             return Response(status_code=204)
         else:
-            raise HTTPException(status_code=404, detail="Chat not found")
\ No newline at end of file
+            raise HTTPException(status_code=404, detail="Chat not found")
+
+@app.delete("/api/opened_chat/{channel_id}")
+async def delete_opened_chat(channel_id: str, current_user: UserDep, session: SessionDep):
+    return await run_db(close_opened_chat, session, channel_id, current_user)
@@ -0,0 +1,30 @@
+﻿import sys
+
+from database import engine
+from migrations.runner import apply_migrations, get_schema_version, pending_migrations, verify_schema
+from migrations.framework import latest_version
+
+usage = "usage: python -m migrations apply|plan|verify"
+
+if len(sys.argv) != 2 or sys.argv[1] not in ("apply", "plan", "verify"):
+    print(usage)
+    sys.exit(2)
+
+command = sys.argv[1]
+if command == "plan":
+    pending = pending_migrations(engine)
+    print(f"Schema version {get_schema_version(engine)}, latest {latest_version()}")
+    for step in pending:
+        print(f"  {step.version} {step.name}")
+    if not pending:
+        print("Nothing to apply")
+elif command == "apply":
+    if not apply_migrations(engine):
+        print(f"Schema already at version {latest_version()}")
+else:
+    problems = verify_schema(engine)
+    for problem in problems:
+        print(problem)
+    if problems:
+        sys.exit(1)
+    print(f"Schema OK (version {latest_version()})")
@@ -0,0 +1,55 @@
+﻿import os
+import time
+from dataclasses import dataclass
+from typing import Callable
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+migration_batch_size = int(os.getenv("MIGRATION_BATCH_SIZE") or 5000)
+migration_batch_pause = float(os.getenv("MIGRATION_BATCH_PAUSE") or 0.01)
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    # steps must be idempotent: a step interrupted halfway is run again from the start
+    apply: Callable[[Engine], None]
+
+registry: dict[int, Migration] = dict()
+
+def migration(version: int, name: str):
+    def register(func: Callable[[Engine], None]):
+        if version in registry:
+            raise ValueError(f"duplicate migration version {version}: {name}, {registry[version].name}")
+        registry[version] = Migration(version, name, func)
+        return func
+    return register
+
+def all_migrations() -> list[Migration]:
+    return [registry[version] for version in sorted(registry)]
+
+def latest_version() -> int:
+    return max(registry, default=0)
+
+def execute(engine: Engine, *statements: str):
+    # DDL is transactional in SQLite, so a failed step leaves nothing half applied
+    with engine.begin() as connection:
+        for statement in statements:
+            connection.execute(text(statement))
+
+def column_exists(engine: Engine, table: str, column: str) -> bool:
+    with engine.connect() as connection:
+        return any(row[1] == column for row in connection.exec_driver_sql(f"PRAGMA table_info({table})"))
+
+def batched_backfill(engine: Engine, table: str, statement: str,
+                     batch_size: int = migration_batch_size, pause: float = migration_batch_pause) -> int:
+    # runs statement over ranges of the table's integer id (bound as :start and :end), committing
+    # after each range so request handlers only ever wait for one short batch on the write lock
+    with engine.connect() as connection:
+        max_id = connection.exec_driver_sql(f"SELECT MAX(id) FROM {table}").scalar() or 0
+    rows = 0
+    for start in range(0, max_id, batch_size):
+        with engine.begin() as connection:
+            rows += connection.execute(text(statement), {"start": start, "end": start + batch_size}).rowcount
+        time.sleep(pause)
+    return rows
@@ -0,0 +1,87 @@
+﻿import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from sqlalchemy import inspect
+from sqlalchemy.engine import Engine
+from sqlmodel import SQLModel
+
+from migrations.framework import Migration, all_migrations, latest_version
+import migrations.steps  # registers the steps
+
+# a migration that is already running (e.g. a long backfill) is waited for at most this long
+migration_lock_timeout = float(os.getenv("MIGRATION_LOCK_TIMEOUT") or 600)
+
+class SchemaVersionError(Exception):
+    pass
+
+@contextmanager
+def migration_lock(engine: Engine):
+    # several server processes booting on one database must not run the steps at the same time. The
+    # steps commit through their own connections, so the lock can't be a write transaction on the
+    # database itself; it is one on a sidecar SQLite file, held until every step is applied
+    database = engine.url.database
+    if engine.dialect.name != "sqlite" or not database or database == ":memory:" or "mode=memory" in str(engine.url):
+        yield
+        return
+    connection = sqlite3.connect(database + ".migrate-lock", timeout=migration_lock_timeout, isolation_level=None)
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        yield
+    finally:
+        connection.close()
+
+def get_schema_version(engine: Engine) -> int:
+    with engine.connect() as connection:
+        return connection.exec_driver_sql("PRAGMA user_version").scalar()
+
+def set_schema_version(engine: Engine, version: int):
+    with engine.begin() as connection:
+        connection.exec_driver_sql(f"PRAGMA user_version = {version:d}")
+
+def pending_migrations(engine: Engine) -> list[Migration]:
+    current = get_schema_version(engine)
+    if current > latest_version():
+        raise SchemaVersionError(f"database schema version {current} is newer than this server ({latest_version()})")
+    return [step for step in all_migrations() if step.version > current]
+
+def apply_migrations(engine: Engine) -> list[Migration]:
+    with migration_lock(engine):
+        # read under the lock: a process that waited finds the steps another one applied
+        pending = pending_migrations(engine)
+        for step in pending:
+            print(f"Applying migration {step.version} {step.name}...")
+            started_at = time.perf_counter()
+            step.apply(engine)
+            set_schema_version(engine, step.version)
+            print(f"Applied migration {step.version} {step.name} in {time.perf_counter() - started_at:.2f}s")
+    return pending
+
+def ensure_schema(engine: Engine):
+    # boot fast path: a single PRAGMA read when the schema is already current
+    current = get_schema_version(engine)
+    if current == latest_version():
+        print(f"Database schema up to date (version {current})")
+        return
+    apply_migrations(engine)
+
+def verify_schema(engine: Engine) -> list[str]:
+    problems = []
+    current = get_schema_version(engine)
+    if current != latest_version():
+        problems.append(f"schema version is {current}, expected {latest_version()}")
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    for table in SQLModel.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            problems.append(f"missing table {table.name}")
+            continue
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                problems.append(f"missing column {table.name}.{column.name}")
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                problems.append(f"missing index {index.name} on {table.name}")
+    return problems
@@ -0,0 +1,107 @@
+﻿from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+
+from migrations.framework import migration, execute, batched_backfill
+from model.user import User
+from model.message import Message
+from model.channels import Channel, ChannelUser
+from model.opened_chat import OpenedChat
+from model.friend_list import FriendListEntry
+from model.unread_counter import UnreadCounter
+from model.email_outbox import OutboundEmail
+from services.password_hasher import scrypt_hash
+
+# Steps run in version order and every one of them is idempotent, so databases created
+# by the old create_all startup (user_version 0) are brought up to date by the same path.
+
+
+@migration(1, "initial_schema")
+def initial_schema(engine: Engine):
+    for model in (User, Channel, Message, ChannelUser, OpenedChat, FriendListEntry):
+        model.__table__.create(engine, checkfirst=True)
+
+
+@migration(2, "hot_path_indexes")
+def hot_path_indexes(engine: Engine):
+    execute(
+        engine,
+        "CREATE INDEX IF NOT EXISTS ix_messages_channel_id_id ON messages (channel_id, id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_channels_channel_id ON channels (channel_id)",
+        "CREATE INDEX IF NOT EXISTS ix_channel_users_channel_id_user_id ON channel_users (channel_id, user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_channel_users_user_id ON channel_users (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_friend_list_user_id_friend_id ON friend_list (user_id, friend_id)",
+        "CREATE INDEX IF NOT EXISTS ix_friend_list_friend_id_user_id ON friend_list (friend_id, user_id)",
+    )
+
+
+@migration(3, "unread_counters")
+def unread_counters(engine: Engine):
+    UnreadCounter.__table__.create(engine, checkfirst=True)
+    batched_backfill(engine, "channel_users", """
+        INSERT INTO unread_counters (channel_id, user_id, unread_count)
+        SELECT channel_users.channel_id, channel_users.user_id, (
+            SELECT COUNT(*) FROM messages
+            WHERE messages.channel_id = channel_users.channel_id
+            AND messages.id > COALESCE(channel_users.last_read_message_id, 0)
+            AND messages.sender_id != channel_users.user_id
+        )
+        FROM channel_users
+        WHERE channel_users.id > :start AND channel_users.id <= :end
+        ON CONFLICT(channel_id, user_id) DO UPDATE SET unread_count = excluded.unread_count
+    """)
+
+
+@migration(4, "seed_test_users")
+def seed_test_users(engine: Engine):
+    with Session(engine) as session:
+        if session.exec(select(User)).first():
+            return
+        test_users = [
+            User(email=f"test{i}@example.com", username=f"test{i}", passwordhash=scrypt_hash("asdf"), is_verified=True)
+            for i in range(1, 10)
+        ]
+        session.add_all(test_users)
+        session.add_all([
+            FriendListEntry(user_id=1, friend_id=4, pending=False),
+            FriendListEntry(user_id=1, friend_id=5, pending=True),
+            FriendListEntry(user_id=1, friend_id=7, pending=True),
+            FriendListEntry(user_id=1, friend_id=9, pending=False),
+            FriendListEntry(user_id=2, friend_id=1, pending=False),
+            FriendListEntry(user_id=2, friend_id=9, pending=False),
+            FriendListEntry(user_id=3, friend_id=7, pending=False),
+            FriendListEntry(user_id=4, friend_id=5, pending=False),
+            FriendListEntry(user_id=6, friend_id=1, pending=True),
+            FriendListEntry(user_id=6, friend_id=7, pending=False),
+            FriendListEntry(user_id=7, friend_id=2, pending=False),
+            FriendListEntry(user_id=7, friend_id=5, pending=False),
+            FriendListEntry(user_id=8, friend_id=3, pending=False),
+            FriendListEntry(user_id=8, friend_id=1, pending=True),
+        ])
+        session.commit()
+
+
+@migration(5, "messages_fts")
+def messages_fts(engine: Engine):
+    # external content table over messages; rows are added by insert_message, and the history
+    # up to end_id is indexed in the background by services.message_search.SearchBackfill.
+    # channel_id is indexed so searches can be narrowed to the caller's channels inside MATCH,
+    # and weighted 0 so it never affects the ranking
+    execute(
+        engine,
+        """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            message, channel_id,
+            content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )""",
+        "INSERT INTO messages_fts (messages_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)')",
+        """CREATE TABLE IF NOT EXISTS search_backfill (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            next_id INTEGER NOT NULL,
+            end_id INTEGER NOT NULL
+        )""",
+        "INSERT OR IGNORE INTO search_backfill (id, next_id, end_id) SELECT 1, 0, COALESCE(MAX(id), 0) FROM messages",
+    )
+
+
+@migration(6, "email_outbox")
+def email_outbox(engine: Engine):
+    OutboundEmail.__table__.create(engine, checkfirst=True)
@@ -1,4 +1,4 @@
-﻿from pydantic import BaseModel
+﻿from pydantic import BaseModel, ConfigDict
 
 class CallInvite(BaseModel):
     caller_id: str
@@ -14,4 +14,26 @@ class CallIceCandidate(BaseModel):
 
 class CallEnd(BaseModel):
     caller_id: str
+    channel_id: str
+
+# payloads of the call-* commands clients send over the websocket
+
+class SessionDescription(BaseModel):
+    model_config = ConfigDict(extra="allow")
+    type: str
+    sdp: str
+
+class CallInviteRequest(BaseModel):
+    channel_id: str
+    offer: SessionDescription
+
+class CallAnswerRequest(BaseModel):
+    channel_id: str
+    answer: SessionDescription
+
+class CallIceCandidateRequest(BaseModel):
+    channel_id: str
+    candidate: dict
+
+class CallEndRequest(BaseModel):
     channel_id: str
\ No newline at end of file
@@ -1,17 +1,22 @@
 ﻿
 
-from sqlmodel import Field, SQLModel, Column, Session, text, select
+from sqlmodel import Field, SQLModel, Column, Index, Session, text, select
 from util.ulidtype import ULIDType
 from ulid import ULID
 from enum import Enum
 from model.user import User
 from model.message import Message
+from model.unread_counter import UnreadCounter
 class Channel(SQLModel, table=True):
     __tablename__ : str = "channels"
+    __table_args__ = (Index("ix_channels_channel_id", "channel_id", unique=True),)
     id: int | None = Field(default=None, primary_key=True)
     channel_id: ULID = Field(default_factory=ULID, sa_column=Column(ULIDType))
     channel_type: str
     last_update: int
+    @staticmethod
+    def by_channel_id(session: Session, channel_id) -> "Channel | None":
+        return session.exec(select(Channel).where(Channel.channel_id == channel_id)).first()
     def get_users(self, session: Session, skip_user: User = None) -> list[User]:
         return [
             user
@@ -30,6 +35,10 @@ class ChannelType(str, Enum):
 
 class ChannelUser(SQLModel, table=True):
     __tablename__ : str = "channel_users"
+    __table_args__ = (
+        Index("ix_channel_users_channel_id_user_id", "channel_id", "user_id"),
+        Index("ix_channel_users_user_id", "user_id"),
+    )
     id: int | None = Field(default=None, primary_key=True)
     channel_id: ULID = Field(default_factory=ULID, sa_column=Column(ULIDType))
     user_id: ULID = Field(default_factory=ULID, sa_column=Column(ULIDType))
@@ -50,16 +59,25 @@ class ChannelUser(SQLModel, table=True):
         return None
     @staticmethod
     def update_last_read_message_id(session: Session, user: str, message: Message) -> None:
+        ChannelUser.advance_last_read_message_id(session, user, str(message.channel_id), message.id)
+        session.commit()
+    @staticmethod
+    def advance_last_read_message_id(session: Session, user: str, channel_id: str, message_id: int) -> bool:
+        # only moves forward, and only to a message that belongs to the channel; doesn't commit
         query = text("""
             UPDATE channel_users 
             SET last_read_message_id = :message_id 
             WHERE channel_id = :channel_id 
             AND user_id = :user_id
             AND (last_read_message_id IS NULL OR last_read_message_id < :message_id)
+            AND EXISTS (SELECT 1 FROM messages WHERE messages.id = :message_id AND messages.channel_id = :channel_id)
         """).params(
             user_id = user,
-            message_id = message.id,
-            channel_id = str(message.channel_id)
+            message_id = message_id,
+            channel_id = channel_id
         )
-        session.exec(query)
-        session.commit()
\ No newline at end of file
+        result = session.exec(query)
+        if result.rowcount:
+            UnreadCounter.recount(session, channel_id, user, message_id)
+            return True
+        return False
\ No newline at end of file
@@ -0,0 +1,70 @@
+﻿from sqlmodel import Field, SQLModel, Session, Index, select, func, text
+
+
+class OutboundEmail(SQLModel, table=True):
+    # a row per email waiting to be sent; sent ones are deleted, ones that ran out of
+    # attempts or were refused for good stay with failed_at set
+    __tablename__ : str = "email_outbox"
+    __table_args__ = (Index("ix_email_outbox_due", "failed_at", "next_attempt_at"),)
+    id: int | None = Field(default=None, primary_key=True)
+    recipient: str
+    subject: str
+    body: str
+    created_at: int
+    attempts: int = 0
+    next_attempt_at: int = 0
+    last_error: str | None = None
+    failed_at: int | None = None
+
+    @staticmethod
+    def due(session: Session, now: int, limit: int) -> list["OutboundEmail"]:
+        return list(session.exec(
+            select(OutboundEmail)
+            .where(OutboundEmail.failed_at == None, OutboundEmail.next_attempt_at <= now)
+            .order_by(OutboundEmail.next_attempt_at)
+            .limit(limit)
+        ))
+
+    @staticmethod
+    def claim(session: Session, id: int, next_attempt_at: int, lease_until: int) -> bool:
+        # pushes next_attempt_at out to the end of a lease before sending; the update only matches
+        # while the row is as this worker read it, so of several workers that read it one wins.
+        # doesn't commit
+        result = session.exec(text("""
+            UPDATE email_outbox SET next_attempt_at = :lease_until
+            WHERE id = :id AND next_attempt_at = :next_attempt_at AND failed_at IS NULL
+        """).params(id=id, next_attempt_at=next_attempt_at, lease_until=lease_until))
+        return result.rowcount == 1
+
+    @staticmethod
+    def delete_claimed(session: Session, id: int, lease_until: int) -> bool:
+        # false if the lease ran out and another worker has taken the row over; doesn't commit
+        result = session.exec(text(
+            "DELETE FROM email_outbox WHERE id = :id AND next_attempt_at = :lease_until"
+        ).params(id=id, lease_until=lease_until))
+        return result.rowcount == 1
+
+    @staticmethod
+    def reschedule_claimed(session: Session, id: int, lease_until: int, attempts: int, last_error: str,
+                           next_attempt_at: int, failed_at: int | None) -> bool:
+        # like delete_claimed, for a send that failed; doesn't commit
+        result = session.exec(text("""
+            UPDATE email_outbox
+            SET attempts = :attempts, last_error = :last_error, next_attempt_at = :next_attempt_at, failed_at = :failed_at
+            WHERE id = :id AND next_attempt_at = :lease_until
+        """).params(id=id, lease_until=lease_until, attempts=attempts, last_error=last_error,
+                    next_attempt_at=next_attempt_at, failed_at=failed_at))
+        return result.rowcount == 1
+
+    @staticmethod
+    def next_attempt(session: Session) -> int | None:
+        return session.exec(
+            select(func.min(OutboundEmail.next_attempt_at)).where(OutboundEmail.failed_at == None)
+        ).one()
+
+    @staticmethod
+    def counts(session: Session) -> tuple[int, int]:
+        # (pending, failed)
+        pending = session.exec(select(func.count()).where(OutboundEmail.failed_at == None)).one()
+        failed = session.exec(select(func.count()).where(OutboundEmail.failed_at != None)).one()
+        return pending, failed
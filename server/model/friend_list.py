@@ -1,16 +1,65 @@
-﻿from sqlmodel import Field, SQLModel
+﻿from sqlmodel import Field, SQLModel, Index, Session, text, select
 from pydantic import BaseModel
-from model.user import UserInfo
+from model.user import User, UserInfo
 
 
 class FriendListEntry(SQLModel, table=True):
     __tablename__ : str = "friend_list"
+    # friendships are looked up from both sides, so each direction gets its own index
+    __table_args__ = (
+        Index("ix_friend_list_user_id_friend_id", "user_id", "friend_id"),
+        Index("ix_friend_list_friend_id_user_id", "friend_id", "user_id"),
+    )
     id: int | None = Field(default=None, primary_key=True)
     user_id: int = Field(foreign_key="user.id")
     friend_id: int = Field(foreign_key="user.id")
     pending: bool = True
     date_added: int | None
 
+    @staticmethod
+    def find(session: Session, user_id: int, friend_id: int) -> "FriendListEntry | None":
+        # the entry between two users, whichever of them sent the request
+        return session.exec(
+            select(FriendListEntry)
+            .where(
+                ((FriendListEntry.user_id == friend_id) & (FriendListEntry.friend_id == user_id)) |
+                ((FriendListEntry.friend_id == friend_id) & (FriendListEntry.user_id == user_id))
+            )
+        ).first()
+
+    @staticmethod
+    def list_users(session: Session, user_id: int, what: str) -> list[User]:
+        # what: friends, outgoing-requests or incoming-requests
+        if what == "friends":
+            condition = ((FriendListEntry.user_id == user_id) | (FriendListEntry.friend_id == user_id)) & (FriendListEntry.pending == False)
+            onclause =  (((User.id == FriendListEntry.friend_id) & (FriendListEntry.user_id == user_id)) |
+                         ((User.id == FriendListEntry.user_id) & (FriendListEntry.friend_id == user_id)))
+        elif what == "outgoing-requests":
+            condition = (FriendListEntry.user_id == user_id) & (FriendListEntry.pending == True)
+            onclause = (User.id == FriendListEntry.friend_id)
+        elif what == "incoming-requests":
+            condition = (FriendListEntry.friend_id == user_id) & (FriendListEntry.pending == True)
+            onclause = (User.id == FriendListEntry.user_id)
+        else:
+            raise ValueError(f"unknown friend list {what}")
+
+        return session.exec(
+            select(User)
+            .join(FriendListEntry, onclause)
+            .where(condition)
+        ).all()
+
+    @staticmethod
+    def friend_userids(session: Session, userid: str) -> list[str]:
+        rows = session.exec(text("""
+            SELECT friend.userid FROM user AS me
+            JOIN friend_list ON (friend_list.user_id = me.id OR friend_list.friend_id = me.id) AND friend_list.pending = 0
+            JOIN user AS friend ON friend.id = CASE WHEN friend_list.user_id = me.id
+                                                    THEN friend_list.friend_id ELSE friend_list.user_id END
+            WHERE me.userid = :userid
+        """).params(userid=str(userid))).all()
+        return [row[0] for row in rows]
+
 
 class FriendStateUpdate(BaseModel):
     other_user: UserInfo
@@ -1,5 +1,5 @@
 ﻿from typing import Annotated
-from sqlmodel import Field, SQLModel, Column
+from sqlmodel import Field, SQLModel, Column, Index, Session, select
 from util.ulidtype import ULIDType
 from pydantic import BaseModel, StringConstraints
 from ulid import ULID
@@ -7,11 +7,30 @@ from ulid import ULID
 
 class Message(SQLModel, table=True):
     __tablename__ : str = "messages"
+    __table_args__ = (Index("ix_messages_channel_id_id", "channel_id", "id"),)
     id: int | None = Field(default=None, primary_key=True)
     channel_id: ULID = Field(default_factory=ULID, sa_column=Column(ULIDType))
     sender_id: ULID = Field(default_factory=ULID, sa_column=Column(ULIDType))
     message: str
     created_at: int
 
+    @staticmethod
+    def latest(session: Session, channel_id, limit: int, before_id: int | None = None) -> list["Message"]:
+        # newest `limit` messages before before_id, oldest first
+        query = select(Message).where(Message.channel_id == channel_id)
+        if before_id is not None:
+            query = query.where(Message.id < before_id)
+        query = query.order_by(Message.id.desc()).limit(limit)
+        return list(session.exec(query))[::-1]
+
+    @staticmethod
+    def channel_id_of(session: Session, message_id: int) -> str | None:
+        message = session.get(Message, message_id)
+        return str(message.channel_id) if message else None
+
+class MessageSearchResults(BaseModel):
+    results: list[Message]
+    next_cursor: str | None = None
+
 class NewMessage(BaseModel):
     message: Annotated[str, StringConstraints(max_length=512)]
\ No newline at end of file
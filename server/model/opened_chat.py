@@ -1,5 +1,5 @@
 ﻿
-from sqlmodel import Field, SQLModel, Column, UniqueConstraint
+from sqlmodel import Field, SQLModel, Column, UniqueConstraint, Session, select
 from util.ulidtype import ULIDType
 from ulid import ULID
 from enum import Enum
@@ -15,6 +15,20 @@ class OpenedChat(SQLModel, table=True):
 
     __table_args__ = (UniqueConstraint("user_id", "channel_id", name="uix_user_id_target_id"),)
 
+    @staticmethod
+    def find(session: Session, user_id, channel_id) -> "OpenedChat | None":
+        return session.exec(select(OpenedChat).where(
+            (OpenedChat.user_id == user_id) & (OpenedChat.channel_id == channel_id)
+        )).first()
+
+    @staticmethod
+    def channels_for_user(session: Session, user_id) -> list[Channel]:
+        return session.exec(
+            select(Channel)
+            .join(OpenedChat, Channel.channel_id == OpenedChat.channel_id)
+            .where(OpenedChat.user_id == user_id)
+        ).all()
+
 
 class OpenedChatResponse(BaseModel):
     channel: Channel
@@ -0,0 +1,17 @@
+﻿from enum import Enum
+from pydantic import BaseModel
+
+
+class PresenceStatus(str, Enum):
+    online = "online"
+    idle = "idle"
+    offline = "offline"
+
+
+class PresenceEntry(BaseModel):
+    user_id: str
+    status: PresenceStatus
+
+
+class PresenceUpdate(BaseModel):
+    updates: list[PresenceEntry]
@@ -0,0 +1,17 @@
+﻿from pydantic import BaseModel
+
+
+class ReadReceipt(BaseModel):
+    channel_id: str
+    user_id: str
+    message_id: int
+
+
+class ReadReceiptUpdate(BaseModel):
+    receipts: list[ReadReceipt]
+
+
+class ReadMessageRequest(BaseModel):
+    message_id: int
+    # older clients don't send it
+    channel_id: str | None = None
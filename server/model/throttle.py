@@ -0,0 +1,7 @@
+﻿from pydantic import BaseModel
+
+
+class Throttled(BaseModel):
+    cmd: str
+    scope: str  # "user" or "channel", whose budget ran out
+    retry_after_ms: int
@@ -0,0 +1,75 @@
+﻿from sqlmodel import Field, SQLModel, Column, Session, UniqueConstraint, text
+from util.ulidtype import ULIDType
+from ulid import ULID
+
+# unread = messages after the member's last read message that were sent by someone else
+EXPECTED_UNREAD_COUNTS_QUERY = """
+    SELECT channel_users.channel_id, channel_users.user_id, COALESCE(counts.unread_count, 0) AS unread_count
+    FROM channel_users
+    LEFT JOIN (
+        SELECT channel_users.id AS channel_user_id, COUNT(*) AS unread_count
+        FROM messages
+        JOIN channel_users ON channel_users.channel_id = messages.channel_id
+        WHERE messages.id > COALESCE(channel_users.last_read_message_id, 0)
+        AND messages.sender_id != channel_users.user_id
+        GROUP BY channel_users.id
+    ) AS counts ON counts.channel_user_id = channel_users.id
+"""
+
+class UnreadCounter(SQLModel, table=True):
+    __tablename__ : str = "unread_counters"
+    id: int | None = Field(default=None, primary_key=True)
+    channel_id: ULID = Field(default_factory=ULID, sa_column=Column(ULIDType))
+    user_id: ULID = Field(default_factory=ULID, sa_column=Column(ULIDType, index=True))
+    unread_count: int = 0
+
+    __table_args__ = (UniqueConstraint("channel_id", "user_id", name="uix_unread_channel_user"),)
+
+    @staticmethod
+    def increment_for_channel(session: Session, channel_id: str, sender_id: str) -> None:
+        session.exec(text("""
+            INSERT INTO unread_counters (channel_id, user_id, unread_count)
+            SELECT channel_id, user_id, 1 FROM channel_users
+            WHERE channel_id = :channel_id AND user_id != :sender_id
+            ON CONFLICT(channel_id, user_id) DO UPDATE SET unread_count = unread_count + 1
+        """).params(channel_id=str(channel_id), sender_id=str(sender_id)))
+
+    @staticmethod
+    def recount(session: Session, channel_id: str, user_id: str, last_read_message_id: int) -> None:
+        session.exec(text("""
+            INSERT INTO unread_counters (channel_id, user_id, unread_count)
+            VALUES (:channel_id, :user_id, (
+                SELECT COUNT(*) FROM messages
+                WHERE channel_id = :channel_id AND id > :message_id AND sender_id != :user_id
+            ))
+            ON CONFLICT(channel_id, user_id) DO UPDATE SET unread_count = excluded.unread_count
+        """).params(channel_id=str(channel_id), user_id=str(user_id), message_id=last_read_message_id))
+
+    @staticmethod
+    def for_user(session: Session, user_id: str) -> dict[str, int]:
+        rows = session.exec(text("""
+            SELECT channel_id, unread_count FROM unread_counters WHERE user_id = :user_id
+        """).params(user_id=str(user_id))).all()
+        return {row.channel_id: row.unread_count for row in rows}
+
+    @staticmethod
+    def rebuild(session: Session) -> None:
+        session.exec(text("DELETE FROM unread_counters"))
+        session.exec(text(f"""
+            INSERT INTO unread_counters (channel_id, user_id, unread_count)
+            SELECT channel_id, user_id, unread_count FROM ({EXPECTED_UNREAD_COUNTS_QUERY})
+        """))
+        session.commit()
+
+    @staticmethod
+    def verify(session: Session) -> list:
+        return session.exec(text(f"""
+            SELECT expected.channel_id, expected.user_id,
+                   expected.unread_count AS expected_count,
+                   COALESCE(unread_counters.unread_count, 0) AS actual_count
+            FROM ({EXPECTED_UNREAD_COUNTS_QUERY}) AS expected
+            LEFT JOIN unread_counters
+                ON unread_counters.channel_id = expected.channel_id
+                AND unread_counters.user_id = expected.user_id
+            WHERE expected.unread_count != COALESCE(unread_counters.unread_count, 0)
+        """)).all()
@@ -1,4 +1,4 @@
-﻿from sqlmodel import Field, SQLModel, Column
+﻿from sqlmodel import Field, SQLModel, Column, Session, select
 from pydantic import BaseModel
 from util.ulidtype import ULIDType
 from ulid import ULID
@@ -14,6 +14,19 @@ class User(SQLModel, table=True):
     verification_code_expiration: int | None = None
     reset_password_token: str | None = None
     reset_password_token_expiration: int | None = None
+    @staticmethod
+    def by_email(session: Session, email: str) -> "User | None":
+        return session.exec(select(User).where(User.email == email)).first()
+    @staticmethod
+    def by_userid(session: Session, userid: str) -> "User | None":
+        return session.exec(select(User).where(User.userid == userid)).first()
+    @staticmethod
+    def page(session: Session, after: str | None, limit: int) -> list["User"]:
+        # keyset pagination by userid
+        query = select(User).order_by(User.userid)
+        if after is not None:
+            query = query.where(User.userid > after)
+        return session.exec(query.limit(limit)).all()
 class CreateUserRequest(BaseModel):
     email: str
     username: str
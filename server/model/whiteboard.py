@@ -7,4 +7,21 @@ class WhiteboardDrawData(BaseModel):
     prevX: int
     prevY: int
     line_width: int
-    line_color: str
\ No newline at end of file
+    line_color: str
+
+class WhiteboardStroke(BaseModel):
+    sender_id: str
+    line_width: int
+    line_color: str
+    points: list[int]  # flattened polyline: x0, y0, x1, y1, ...
+
+class WhiteboardBatch(BaseModel):
+    channel_id: str
+    strokes: list[WhiteboardStroke]
+
+class WhiteboardSnapshot(BaseModel):
+    channel_id: str
+    snapshot: str  # base64 of the binary snapshot, see services/whiteboard_store.py
+
+class WhiteboardSyncRequest(BaseModel):
+    channel_id: str
@@ -0,0 +1,121 @@
+﻿import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from ulid import ULID
+
+from model.user import User
+
+auth_cache_size = int(os.getenv("AUTH_CACHE_SIZE") or 10000)
+auth_cache_ttl = float(os.getenv("AUTH_CACHE_TTL") or 300)
+
+@dataclass(frozen=True, slots=True)
+class AuthenticatedUser:
+    # detached snapshot of the User columns request handlers need, safe to share between requests
+    id: int
+    userid: ULID
+    email: str
+    username: str
+    is_verified: bool
+
+    @staticmethod
+    def from_user(user: User) -> "AuthenticatedUser":
+        return AuthenticatedUser(
+            id=user.id,
+            userid=user.userid,
+            email=user.email,
+            username=user.username,
+            is_verified=user.is_verified,
+        )
+
+class AuthCache:
+    # with a manager, invalidations are published on its broker so other nodes drop the user's
+    # tokens too instead of serving a stale user until the ttl runs out
+    def __init__(self, manager=None, max_size: int = auth_cache_size, ttl: float = auth_cache_ttl):
+        self.manager = manager
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict[str, tuple[float, AuthenticatedUser]] = OrderedDict()
+        self.tokens_by_user: dict[int, set[str]] = dict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # invalidations come from sync endpoints running on worker threads
+        self.lock = threading.Lock()
+        if manager is not None:
+            manager.envelope_handlers["invalidate-user"] = self.handle_invalidate_user_envelope
+            manager.resync_handlers.append(self.handle_resync)
+
+    def get(self, token: str) -> AuthenticatedUser | None:
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, user = entry
+            if expires_at <= time.time():
+                self._remove(token)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(token)
+            self.hits += 1
+            return user
+
+    def put(self, token: str, user: AuthenticatedUser, token_expiration: int | None = None):
+        expires_at = time.time() + self.ttl
+        if token_expiration is not None:
+            expires_at = min(expires_at, token_expiration)
+        with self.lock:
+            self._remove(token)
+            self.entries[token] = (expires_at, user)
+            self.tokens_by_user.setdefault(user.id, set()).add(token)
+            while len(self.entries) > self.max_size:
+                oldest_token = next(iter(self.entries))
+                self._remove(oldest_token)
+                self.evictions += 1
+
+    def _remove(self, token: str):
+        entry = self.entries.pop(token, None)
+        if entry is None:
+            return
+        tokens = self.tokens_by_user.get(entry[1].id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self.tokens_by_user[entry[1].id]
+
+    def invalidate_user(self, user_id: int):
+        self._invalidate_user(user_id)
+        if self.manager is not None:
+            self.manager.broker.publish({"op": "invalidate-user", "user": user_id})
+
+    async def handle_invalidate_user_envelope(self, envelope: dict):
+        self._invalidate_user(envelope["user"])
+
+    async def handle_resync(self):
+        # invalidations from other nodes may have been missed
+        with self.lock:
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            self.tokens_by_user.clear()
+
+    def _invalidate_user(self, user_id: int):
+        with self.lock:
+            for token in self.tokens_by_user.pop(user_id, ()):
+                self.entries.pop(token, None)
+                self.invalidations += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
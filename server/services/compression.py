@@ -0,0 +1,186 @@
+﻿import logging
+import os
+import time
+import brotli
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+from websockets.frames import CTRL_OPCODES, Frame, Opcode
+
+logger = logging.getLogger(__name__)
+
+# the responders and the websocket protocol below extend private starlette and uvicorn classes, written
+# against the versions pinned in requirements.txt; if those internals move, the app still starts and
+# falls back to plain GZipMiddleware and uvicorn's default websocket protocol
+try:
+    from starlette.middleware.gzip import GZipResponder, IdentityResponder
+    starlette_responders = all(hasattr(IdentityResponder, hook) for hook in ("apply_compression", "send_with_compression"))
+except ImportError:
+    starlette_responders = False
+if not starlette_responders:
+    logger.warning("starlette's compression responders changed, falling back to GZipMiddleware without brotli or metrics")
+    GZipResponder = IdentityResponder = object
+try:
+    from uvicorn.protocols.websockets.websockets_sansio_impl import WebSocketsSansIOProtocol
+except ImportError:
+    WebSocketsSansIOProtocol = None
+
+# REST responses: brotli when the client accepts it, otherwise gzip, bodies under the minimum as they are
+http_compress_min_size = int(os.getenv("HTTP_COMPRESS_MIN_SIZE") or 1024)
+http_gzip_level = int(os.getenv("HTTP_GZIP_LEVEL") or 6)
+http_brotli_quality = int(os.getenv("HTTP_BROTLI_QUALITY") or 4)
+
+# websocket permessage-deflate; messages under the threshold are sent uncompressed
+ws_deflate_threshold = int(os.getenv("WS_DEFLATE_THRESHOLD") or 1024)
+ws_deflate_level = int(os.getenv("WS_DEFLATE_LEVEL") or 6)
+ws_deflate_mem_level = int(os.getenv("WS_DEFLATE_MEM_LEVEL") or 5)
+ws_deflate_window_bits = int(os.getenv("WS_DEFLATE_WINDOW_BITS") or 12)
+# context takeover compresses repetitive frames much better, at the cost of keeping the window per connection
+ws_deflate_server_context_takeover = (os.getenv("WS_DEFLATE_SERVER_CONTEXT_TAKEOVER") or "1") == "1"
+ws_deflate_client_context_takeover = (os.getenv("WS_DEFLATE_CLIENT_CONTEXT_TAKEOVER") or "1") == "1"
+
+class CompressionStats:
+    def __init__(self):
+        self.compressed = 0
+        self.skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    def record(self, bytes_in: int, bytes_out: int, elapsed: float):
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.seconds += elapsed
+
+    def as_dict(self) -> dict:
+        return {
+            "compressed": self.compressed,
+            "skipped": self.skipped,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "ratio": self.bytes_out / self.bytes_in if self.bytes_in else 0.0,
+            "cpu_ms": self.seconds * 1000,
+        }
+
+compression_stats = {
+    "http_br": CompressionStats(),
+    "http_gzip": CompressionStats(),
+    "ws_deflate": CompressionStats(),
+}
+
+def stats() -> dict:
+    return {name: entry.as_dict() for name, entry in compression_stats.items()}
+
+class MeteredResponder:
+    # records bytes and CPU per encoding around starlette's responders
+    stats_key: str
+
+    async def send_with_compression(self, message):
+        if (message["type"] == "http.response.body" and not self.started and not message.get("more_body", False)
+                and len(message.get("body", b"")) < self.minimum_size):
+            compression_stats[self.stats_key].skipped += 1
+        await super().send_with_compression(message)
+
+    async def apply_compression(self, body: bytes, *, more_body: bool) -> bytes:
+        started_at = time.perf_counter()
+        compressed = await super().apply_compression(body, more_body=more_body)
+        entry = compression_stats[self.stats_key]
+        entry.record(len(body), len(compressed), time.perf_counter() - started_at)
+        if not more_body:
+            entry.compressed += 1
+        return compressed
+
+class MeteredGZipResponder(MeteredResponder, GZipResponder):
+    stats_key = "http_gzip"
+
+class BrotliCompressResponder(IdentityResponder):
+    content_encoding = "br"
+
+    def __init__(self, app, minimum_size: int, quality: int):
+        super().__init__(app, minimum_size)
+        self.quality = quality
+        self.compressor: brotli.Compressor | None = None
+
+    async def apply_compression(self, body: bytes, *, more_body: bool) -> bytes:
+        if self.compressor is None:
+            self.compressor = brotli.Compressor(quality=self.quality)
+        # streamed chunks are flushed so the client can render history as it arrives
+        return self.compressor.process(body) + (self.compressor.flush() if more_body else self.compressor.finish())
+
+class MeteredBrotliResponder(MeteredResponder, BrotliCompressResponder):
+    stats_key = "http_br"
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int = http_compress_min_size,
+                 gzip_level: int = http_gzip_level, brotli_quality: int = http_brotli_quality):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.fallback = None if starlette_responders else GZipMiddleware(app, minimum_size, gzip_level)
+
+    async def __call__(self, scope, receive, send):
+        if self.fallback is not None:
+            await self.fallback(scope, receive, send)
+            return
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accepted = {
+            part.split(";")[0].strip().lower()
+            for part in Headers(scope=scope).get("Accept-Encoding", "").split(",")
+        }
+        if "br" in accepted:
+            responder = MeteredBrotliResponder(self.app, self.minimum_size, self.brotli_quality)
+        elif "gzip" in accepted:
+            responder = MeteredGZipResponder(self.app, self.minimum_size, self.gzip_level)
+        else:
+            responder = IdentityResponder(self.app, self.minimum_size)
+        await responder(scope, receive, send)
+
+class ThresholdPerMessageDeflate(PerMessageDeflate):
+    # RFC 7692 decides compression per message: a message sent with RSV1 unset is plain, and since it
+    # never goes through the compressor the shared context stays valid for the next compressed one
+    def encode(self, frame: Frame) -> Frame:
+        if frame.opcode in CTRL_OPCODES:
+            return frame
+        entry = compression_stats["ws_deflate"]
+        if frame.opcode is not Opcode.CONT and frame.fin and len(frame.data) < ws_deflate_threshold:
+            entry.skipped += 1
+            return frame
+        started_at = time.perf_counter()
+        encoded = super().encode(frame)
+        entry.record(len(frame.data), len(encoded.data), time.perf_counter() - started_at)
+        if frame.opcode is not Opcode.CONT:
+            entry.compressed += 1
+        return encoded
+
+class ThresholdPerMessageDeflateFactory(ServerPerMessageDeflateFactory):
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, ThresholdPerMessageDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            self.compress_settings,
+        )
+
+if WebSocketsSansIOProtocol is not None:
+    class DeflateWebSocketProtocol(WebSocketsSansIOProtocol):
+        # uvicorn's websocket protocol with the policy above, run with
+        # uvicorn main:app --ws services.compression:DeflateWebSocketProtocol
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            if self.config.ws_per_message_deflate and hasattr(self, "conn"):
+                self.conn.available_extensions = [ThresholdPerMessageDeflateFactory(
+                    server_no_context_takeover=not ws_deflate_server_context_takeover,
+                    client_no_context_takeover=not ws_deflate_client_context_takeover,
+                    server_max_window_bits=ws_deflate_window_bits,
+                    client_max_window_bits=ws_deflate_window_bits,
+                    compress_settings={"level": ws_deflate_level, "memLevel": ws_deflate_mem_level},
+                )]
+else:
+    logger.warning("uvicorn's sans-I/O websocket protocol is gone, --ws %s:DeflateWebSocketProtocol "
+                   "uses the default protocol without the compression threshold", __name__)
+    from uvicorn.protocols.websockets.auto import AutoWebSocketsProtocol as DeflateWebSocketProtocol
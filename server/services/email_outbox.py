@@ -0,0 +1,230 @@
+﻿import asyncio
+import logging
+import os
+import random
+import smtplib
+import ssl
+import threading
+import time
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlmodel import Session
+
+from model.email_outbox import OutboundEmail
+
+logger = logging.getLogger(__name__)
+
+email_batch_size = int(os.getenv("EMAIL_BATCH_SIZE") or 50)
+email_max_attempts = int(os.getenv("EMAIL_MAX_ATTEMPTS") or 8)
+email_retry_base = float(os.getenv("EMAIL_RETRY_BASE") or 5)
+email_retry_max = float(os.getenv("EMAIL_RETRY_MAX") or 3600)
+# fallback for wakeups that were missed, e.g. rows inserted by another worker process
+email_poll_interval = float(os.getenv("EMAIL_POLL_INTERVAL") or 30)
+smtp_timeout = float(os.getenv("SMTP_TIMEOUT") or 30)
+# how long a worker owns a row it is sending; has to outlast a send including a reconnect, a row whose
+# worker died mid-send goes out again after it
+email_claim_lease = int(os.getenv("EMAIL_CLAIM_LEASE") or 300)
+smtp_idle_timeout = float(os.getenv("SMTP_IDLE_TIMEOUT") or 60)
+
+def build_message(sender: str, recipient: str, subject: str, body: str) -> str:
+    message = MIMEMultipart()
+    message["From"] = sender
+    message["To"] = recipient
+    message["Subject"] = subject
+    message.attach(MIMEText(body, "plain"))
+    return message.as_string()
+
+def is_permanent(error: Exception) -> bool:
+    # the recipient or the message was refused for good; anything else (connection, auth,
+    # 4xx) is worth another try later
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    return isinstance(error, smtplib.SMTPDataError) and error.smtp_code >= 500
+
+class EmailOutbox:
+    # emails are rows in email_outbox added in the caller's transaction, so a request that rolls back
+    # sends nothing and one that commits can't lose its email. A worker thread sends them over one
+    # SMTP connection it keeps open while there is mail and closes after smtp_idle_timeout; failures
+    # are retried with exponential backoff up to email_max_attempts. Every server process runs a worker
+    # on the same table, so a worker claims a row before sending it and only the one that wins sends.
+    def __init__(self, engine: Engine, sender: str, host: str, port: int,
+                 username: str | None = None, password: str | None = None, starttls: bool = True):
+        self.engine = engine
+        self.sender = sender
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.smtp: smtplib.SMTP | None = None
+        self.smtp_last_used = 0.0
+        self.wake = threading.Event()
+        self.stopping = False
+        self.thread: threading.Thread | None = None
+        self.enqueued = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.claimed_elsewhere = 0
+        self.lost_leases = 0
+        self.connects = 0
+        self.total_send_seconds = 0.0
+
+    def enqueue(self, session: Session, recipient: str, subject: str, body: str):
+        now = int(time.time())
+        session.add(OutboundEmail(recipient=recipient, subject=subject, body=body, created_at=now, next_attempt_at=now))
+        event.listen(session, "after_commit", self._after_commit, once=True)
+        self.enqueued += 1
+
+    def _after_commit(self, session: Session):
+        self.wake.set()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="email-outbox", daemon=True)
+        self.thread.start()
+
+    async def stop(self, timeout: float = 5):
+        # unsent rows stay in the table and go out after the next start; the join waits for a send in
+        # progress, on a thread so the event loop keeps serving the rest of the shutdown
+        self.stopping = True
+        self.wake.set()
+        if self.thread is not None:
+            await asyncio.to_thread(self.thread.join, timeout)
+
+    def _run(self):
+        while not self.stopping:
+            self.wake.clear()
+            try:
+                delay = self.send_due()
+            except Exception:
+                logger.exception("email outbox failed")
+                self._close()
+                delay = email_poll_interval
+            if self.smtp is not None:
+                idle = time.monotonic() - self.smtp_last_used
+                if idle >= smtp_idle_timeout:
+                    self._close()
+                else:
+                    delay = min(delay, smtp_idle_timeout - idle)
+            self.wake.wait(delay)
+        self._close()
+
+    def send_due(self) -> float:
+        # sends what is due and returns how long to sleep before the next attempt is due
+        with Session(self.engine, expire_on_commit=False) as session:
+            emails = OutboundEmail.due(session, int(time.time()), email_batch_size)
+            for email in emails:
+                if self.stopping:
+                    return 0
+                lease_until = int(time.time()) + email_claim_lease
+                # the claim is committed before sending so other workers see it
+                claimed = OutboundEmail.claim(session, email.id, email.next_attempt_at, lease_until)
+                session.commit()
+                if not claimed:
+                    self.claimed_elsewhere += 1
+                    continue
+                self._deliver(session, email, lease_until)
+                # one commit per email, a crash mid-batch doesn't send the earlier ones twice
+                session.commit()
+            if len(emails) == email_batch_size:
+                return 0
+            next_attempt = OutboundEmail.next_attempt(session)
+        if next_attempt is None:
+            return email_poll_interval
+        return min(email_poll_interval, max(0.0, next_attempt - time.time()))
+
+    def _deliver(self, session: Session, email: OutboundEmail, lease_until: int):
+        started_at = time.perf_counter()
+        try:
+            self._send(build_message(self.sender, email.recipient, email.subject, email.body), email.recipient)
+        except Exception as e:
+            # anything, not only SMTP and socket errors: a row left leased would be retried forever
+            # without its attempts going up
+            attempts = email.attempts + 1
+            failed_at = None
+            next_attempt_at = lease_until
+            if is_permanent(e) or attempts >= email_max_attempts:
+                failed_at = int(time.time())
+                self.failed += 1
+                logger.error("giving up on email %s to %s after %d attempts: %r", email.id, email.recipient, attempts, e)
+            else:
+                delay = min(email_retry_max, email_retry_base * 2 ** (attempts - 1))
+                next_attempt_at = int(time.time() + delay * random.uniform(0.8, 1.2))
+                self.retried += 1
+                logger.warning("email %s to %s failed, retrying in %.0fs: %r", email.id, email.recipient, delay, e)
+            if not isinstance(e, smtplib.SMTPResponseException):
+                # the connection itself is suspect
+                self._close()
+            if not OutboundEmail.reschedule_claimed(session, email.id, lease_until, attempts, repr(e)[:500],
+                                                    next_attempt_at, failed_at):
+                self._lost_lease(email)
+            return
+        finally:
+            self.total_send_seconds += time.perf_counter() - started_at
+        if not OutboundEmail.delete_claimed(session, email.id, lease_until):
+            self._lost_lease(email)
+        self.sent += 1
+
+    def _lost_lease(self, email: OutboundEmail):
+        # the send outlasted the lease and another worker has claimed the row since, it owns the row now
+        self.lost_leases += 1
+        logger.warning("email %s to %s took longer than its %ds claim, another worker may send it again",
+                       email.id, email.recipient, email_claim_lease)
+
+    def _send(self, message: str, recipient: str):
+        # a connection the server dropped while idle is reopened once before counting as a failure
+        for reconnect in (True, False):
+            smtp = self._connection()
+            try:
+                smtp.sendmail(self.sender, [recipient], message)
+                self.smtp_last_used = time.monotonic()
+                return
+            except smtplib.SMTPServerDisconnected:
+                self._close()
+                if not reconnect:
+                    raise
+
+    def _connection(self) -> smtplib.SMTP:
+        if self.smtp is None:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=smtp_timeout)
+            try:
+                if self.starttls:
+                    smtp.starttls(context=ssl.create_default_context())
+                if self.password:
+                    smtp.login(self.username, self.password)
+            except Exception:
+                smtp.close()
+                raise
+            self.smtp = smtp
+            self.smtp_last_used = time.monotonic()
+            self.connects += 1
+        return self.smtp
+
+    def _close(self):
+        if self.smtp is None:
+            return
+        smtp, self.smtp = self.smtp, None
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+
+    def stats(self) -> dict:
+        with Session(self.engine) as session:
+            pending, failed_rows = OutboundEmail.counts(session)
+        return {
+            "pending": pending,
+            "failed_rows": failed_rows,
+            "enqueued": self.enqueued,
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "claimed_elsewhere": self.claimed_elsewhere,
+            "lost_leases": self.lost_leases,
+            "smtp_connects": self.connects,
+            "smtp_connected": self.smtp is not None,
+            "avg_send_ms": self.total_send_seconds / (self.sent + self.retried + self.failed) * 1000
+                if self.sent + self.retried + self.failed else 0.0,
+        }
@@ -0,0 +1,144 @@
+﻿import os
+from bisect import bisect_left
+from collections import OrderedDict, deque
+
+from model.message import Message
+
+message_cache_per_channel = int(os.getenv("MESSAGE_CACHE_PER_CHANNEL") or 50)
+message_cache_max_bytes = int(os.getenv("MESSAGE_CACHE_MAX_BYTES") or 16 * 1024 * 1024)
+
+# rough per-entry cost of the deque slot, tuple and int on top of the JSON text itself
+ENTRY_OVERHEAD = 120
+
+class ChannelBuffer:
+    def __init__(self, capacity: int, messages: list[Message]):
+        # the newest `capacity` messages of the channel as (id, json) pairs, oldest first
+        self.entries: deque[tuple[int, str]] = deque(maxlen=capacity)
+        self.bytes = 0
+        # fewer rows than capacity on load means the buffer holds the channel's whole history
+        self.complete = len(messages) < capacity
+        for message in messages:
+            self.insert(message.id, message.model_dump_json())
+
+    def insert(self, message_id: int, encoded: str):
+        entries = self.entries
+        if entries and message_id <= entries[-1][0]:
+            # messages posted on other nodes can arrive out of order
+            if len(entries) == entries.maxlen and message_id < entries[0][0]:
+                return
+            position = bisect_left(entries, (message_id,))
+            if entries[position][0] == message_id:
+                return
+        else:
+            position = len(entries)
+        if len(entries) == entries.maxlen:
+            self.bytes -= len(entries.popleft()[1]) + ENTRY_OVERHEAD
+            position -= 1
+        entries.insert(position, (message_id, encoded))
+        self.bytes += len(encoded) + ENTRY_OVERHEAD
+
+    def latest(self, limit: int) -> list[tuple[int, str]] | None:
+        if limit > len(self.entries) and not self.complete:
+            return None
+        return list(self.entries)[-limit:]
+
+class MessageCache:
+    # serves first-page history of active channels without touching SQLite;
+    # every method runs on the event loop, so no locking is needed. With a manager, appends are
+    # published on its broker so the buffers of other nodes get messages posted there too
+    def __init__(self, manager=None, per_channel: int = message_cache_per_channel, max_bytes: int = message_cache_max_bytes):
+        self.manager = manager
+        self.per_channel = per_channel
+        self.max_bytes = max_bytes
+        self.channels: OrderedDict[str, ChannelBuffer] = OrderedDict()
+        self.bytes = 0
+        # loads in flight per channel, and channels that got a message while one was running
+        self.pending_loads: dict[str, int] = dict()
+        self.stale_loads: set[str] = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.remote_appends = 0
+        if manager is not None:
+            manager.envelope_handlers["message-appended"] = self.handle_message_appended_envelope
+            manager.resync_handlers.append(self.handle_resync)
+
+    def latest(self, channel_id: str, limit: int) -> list[tuple[int, str]] | None:
+        buffer = self.channels.get(channel_id)
+        entries = buffer.latest(limit) if buffer is not None and limit <= self.per_channel else None
+        if entries is None:
+            self.misses += 1
+            return None
+        self.channels.move_to_end(channel_id)
+        self.hits += 1
+        return entries
+
+    def begin_load(self, channel_id: str):
+        self.pending_loads[channel_id] = self.pending_loads.get(channel_id, 0) + 1
+
+    def finish_load(self, channel_id: str, messages: list[Message] | None):
+        # messages are the newest per_channel rows, oldest first, or None if the load failed
+        pending = self.pending_loads.get(channel_id, 1) - 1
+        stale = channel_id in self.stale_loads
+        if pending:
+            self.pending_loads[channel_id] = pending
+        else:
+            self.pending_loads.pop(channel_id, None)
+            self.stale_loads.discard(channel_id)
+        if messages is None or stale or channel_id in self.channels:
+            # a message was posted while loading and may be missing from this snapshot
+            return
+        buffer = ChannelBuffer(self.per_channel, messages)
+        self.channels[channel_id] = buffer
+        self.bytes += buffer.bytes
+        self._evict()
+
+    def append(self, message: Message):
+        channel_id = str(message.channel_id)
+        encoded = message.model_dump_json()
+        self._insert(channel_id, message.id, encoded)
+        if self.manager is not None:
+            self.manager.broker.publish({"op": "message-appended", "channel": channel_id, "id": message.id, "json": encoded})
+
+    async def handle_message_appended_envelope(self, envelope: dict):
+        self.remote_appends += 1
+        self._insert(envelope["channel"], envelope["id"], envelope["json"])
+
+    async def handle_resync(self):
+        # appends from other nodes may have been missed, reload channels on their next read
+        self.stale_loads.update(self.pending_loads)
+        self.channels.clear()
+        self.bytes = 0
+
+    def _insert(self, channel_id: str, message_id: int, encoded: str):
+        buffer = self.channels.get(channel_id)
+        if buffer is None:
+            if channel_id in self.pending_loads:
+                self.stale_loads.add(channel_id)
+            return
+        before = buffer.bytes
+        buffer.insert(message_id, encoded)
+        self.bytes += buffer.bytes - before
+        self.channels.move_to_end(channel_id)
+        self._evict()
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self.channels:
+            _, buffer = self.channels.popitem(last=False)
+            self.bytes -= buffer.bytes
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "channels": len(self.channels),
+            "messages": sum(len(buffer.entries) for buffer in self.channels.values()),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "per_channel": self.per_channel,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "remote_appends": self.remote_appends,
+        }
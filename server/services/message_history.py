@@ -0,0 +1,104 @@
+﻿import json
+import os
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from dataclasses import dataclass
+from typing import Iterator
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select, text
+
+from model.message import Message
+
+message_page_size = int(os.getenv("MESSAGE_PAGE_SIZE") or 20)
+message_page_max = int(os.getenv("MESSAGE_PAGE_MAX") or 100)
+message_stream_batch = int(os.getenv("MESSAGE_STREAM_BATCH") or 50)
+
+DIRECTIONS = ("latest", "before", "after", "around")
+
+class InvalidCursor(ValueError):
+    pass
+
+def clamp_page_size(limit: int | None) -> int:
+    if limit is None:
+        return message_page_size
+    return max(1, min(limit, message_page_max))
+
+def encode_cursor(direction: str, message_id: int) -> str:
+    return urlsafe_b64encode(f"{direction}:{message_id}".encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple[str, int]:
+    try:
+        direction, message_id = urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().split(":")
+        message_id = int(message_id)
+    except ValueError:
+        raise InvalidCursor(cursor)
+    if direction not in DIRECTIONS[1:]:
+        raise InvalidCursor(cursor)
+    return direction, message_id
+
+@dataclass(frozen=True, slots=True)
+class PageBounds:
+    channel_id: str
+    first_id: int | None
+    last_id: int | None
+    count: int
+
+    @staticmethod
+    def from_entries(channel_id: str, entries: list[tuple[int, str]]) -> "PageBounds":
+        if not entries:
+            return PageBounds(channel_id, None, None, 0)
+        return PageBounds(channel_id, entries[0][0], entries[-1][0], len(entries))
+
+    @property
+    def etag(self) -> str:
+        # messages are never edited in place, so the id range and row count identify the page content
+        return f'"{self.channel_id}-{self.first_id or 0}-{self.last_id or 0}-{self.count}"'
+
+    def cursors(self) -> dict:
+        if not self.count:
+            return {"prev_cursor": None, "next_cursor": None}
+        return {
+            "prev_cursor": encode_cursor("before", self.first_id),
+            "next_cursor": encode_cursor("after", self.last_id),
+        }
+
+PAGE_IDS = {
+    "latest": "SELECT id FROM messages WHERE channel_id = :channel_id ORDER BY id DESC LIMIT :limit",
+    "before": "SELECT id FROM messages WHERE channel_id = :channel_id AND id < :message_id ORDER BY id DESC LIMIT :limit",
+    "after": "SELECT id FROM messages WHERE channel_id = :channel_id AND id > :message_id ORDER BY id ASC LIMIT :limit",
+}
+PAGE_IDS["around"] = f"""
+    SELECT id FROM ({PAGE_IDS["before"].replace(":limit", ":older_limit")})
+    UNION ALL
+    SELECT id FROM (SELECT id FROM messages WHERE channel_id = :channel_id AND id >= :message_id ORDER BY id ASC LIMIT :newer_limit)
+"""
+
+def load_page_bounds(session: Session, channel_id: str, direction: str, message_id: int | None, limit: int) -> PageBounds:
+    # only ids are touched here, through the (channel_id, id) index; the rows are read later by the stream
+    params = {"channel_id": channel_id, "message_id": message_id, "limit": limit,
+              "older_limit": limit // 2, "newer_limit": limit - limit // 2}
+    row = session.exec(text(f"SELECT MIN(id), MAX(id), COUNT(*) FROM ({PAGE_IDS[direction]})").params(**params)).one()
+    return PageBounds(channel_id, row[0], row[1], row[2])
+
+def stream_page(engine: Engine, bounds: PageBounds) -> Iterator[str]:
+    # runs after the request's session is gone, so it owns its session and holds at most one batch of rows
+    yield '{"messages":['
+    if bounds.count:
+        with Session(engine) as session:
+            query = (
+                select(Message)
+                .where(Message.channel_id == bounds.channel_id)
+                .where(Message.id >= bounds.first_id, Message.id <= bounds.last_id)
+                .order_by(Message.id)
+                .execution_options(yield_per=message_stream_batch)
+            )
+            separator = ""
+            for message in session.exec(query):
+                yield separator + message.model_dump_json()
+                separator = ","
+    yield page_tail(bounds)
+
+def page_tail(bounds: PageBounds) -> str:
+    return "]," + json.dumps(bounds.cursors(), separators=(",", ":"))[1:]
+
+def render_page(bounds: PageBounds, encoded_messages: list[str]) -> str:
+    return '{"messages":[' + ",".join(encoded_messages) + page_tail(bounds)
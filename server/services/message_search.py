@@ -0,0 +1,141 @@
+﻿import asyncio
+import json
+import logging
+import os
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from sqlmodel import Session, text
+
+from database import run_in_session
+from model.message import Message
+
+logger = logging.getLogger(__name__)
+
+search_backfill_batch = int(os.getenv("SEARCH_BACKFILL_BATCH") or 2000)
+search_backfill_pause = float(os.getenv("SEARCH_BACKFILL_PAUSE") or 0.05)
+search_max_terms = int(os.getenv("SEARCH_MAX_TERMS") or 16)
+search_channel_filter_max = int(os.getenv("SEARCH_CHANNEL_FILTER_MAX") or 200)
+
+class InvalidSearchQuery(ValueError):
+    pass
+
+def build_match_query(query: str) -> str:
+    # every word becomes a quoted FTS5 string so user input can't inject query syntax;
+    # a trailing * keeps its meaning as a prefix search
+    terms = []
+    for word in query.split()[:search_max_terms]:
+        prefix = word.endswith("*")
+        word = word.replace('"', "").rstrip("*")
+        if word:
+            terms.append(f'"{word}"' + ("*" if prefix else ""))
+    if not terms:
+        raise InvalidSearchQuery(query)
+    return " ".join(terms)
+
+def encode_search_cursor(offset: int, max_id: int) -> str:
+    return urlsafe_b64encode(json.dumps([offset, max_id]).encode()).decode().rstrip("=")
+
+def decode_search_cursor(cursor: str) -> tuple[int, int]:
+    try:
+        offset, max_id = json.loads(urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        offset, max_id = int(offset), int(max_id)
+    except (ValueError, TypeError):
+        raise InvalidSearchQuery(cursor)
+    if offset < 0:
+        raise InvalidSearchQuery(cursor)
+    return offset, max_id
+
+def index_message(session: Session, message: Message):
+    session.exec(text("INSERT INTO messages_fts (rowid, message, channel_id) VALUES (:id, :message, :channel_id)")
+                 .params(id=message.id, message=message.message, channel_id=str(message.channel_id)))
+
+def search_messages(session: Session, user_id: str, query: str, channel_id: str | None,
+                    cursor: str | None, limit: int) -> tuple[list[Message], str | None]:
+    # results are ordered by bm25 rank, then id. The cursor is the offset of the next page and the newest
+    # message id when the first page was served, so every page ranks the same set of messages. bm25
+    # scores themselves drift as new messages change the index statistics, which is why the cursor
+    # isn't a (rank, id) keyset: that would skip or repeat hits once the scores moved. FTS5 scores
+    # every match before applying the LIMIT anyway, so the OFFSET costs little extra.
+    conditions = []
+    match = f"message : ({build_match_query(query)})"
+    if channel_id is not None:
+        conditions.append("AND messages.channel_id = :channel_id")
+        # it ends up inside the MATCH expression, so it must not be able to close the quoted string
+        channel_ids = [channel_id.replace('"', "")]
+    else:
+        channel_ids = session.exec(text("SELECT channel_id FROM channel_users WHERE user_id = :user_id")
+                                   .params(user_id=user_id)).scalars().all()
+    if not channel_ids:
+        return [], None
+    if len(channel_ids) <= search_channel_filter_max:
+        # channel ids are rare tokens, so FTS5 skips straight to the caller's messages instead of
+        # ranking every match of a common word and discarding other channels afterwards
+        match += " AND channel_id : (" + " OR ".join(f'"{channel}"' for channel in channel_ids) + ")"
+    params = {"query": match, "user_id": user_id, "channel_id": channel_id, "limit": limit}
+    if cursor is not None:
+        params["offset"], params["max_id"] = decode_search_cursor(cursor)
+    else:
+        params["offset"] = 0
+        params["max_id"] = session.exec(text("SELECT COALESCE(MAX(id), 0) FROM messages")).scalar()
+    rows = session.exec(text(f"""
+        SELECT messages.id, messages.channel_id, messages.sender_id, messages.message, messages.created_at
+        FROM messages_fts
+        JOIN messages ON messages.id = messages_fts.rowid
+        WHERE messages_fts MATCH :query
+        AND messages.channel_id IN (SELECT channel_id FROM channel_users WHERE user_id = :user_id)
+        AND messages.id <= :max_id
+        {" ".join(conditions)}
+        ORDER BY messages_fts.rank, messages.id
+        LIMIT :limit OFFSET :offset
+    """).params(**params)).all()
+    messages = [
+        Message(id=row.id, channel_id=row.channel_id, sender_id=row.sender_id, message=row.message, created_at=row.created_at)
+        for row in rows
+    ]
+    next_cursor = encode_search_cursor(params["offset"] + limit, params["max_id"]) if len(rows) == limit else None
+    return messages, next_cursor
+
+class SearchBackfill:
+    # indexes the history that predates the messages_fts migration in small committed batches,
+    # so writers only ever wait for one batch; progress lives in search_backfill and survives restarts
+    def __init__(self, batch_size: int = search_backfill_batch, pause: float = search_backfill_pause):
+        self.batch_size = batch_size
+        self.pause = pause
+        self.next_id = 0
+        self.end_id = 0
+        self.batches = 0
+        self.done = False
+
+    def run_batch(self, session: Session) -> bool:
+        row = session.exec(text("SELECT next_id, end_id FROM search_backfill WHERE id = 1")).first()
+        if row is None or row.next_id >= row.end_id:
+            self.done = True
+            return True
+        batch_end = min(row.next_id + self.batch_size, row.end_id)
+        session.exec(text("""
+            INSERT INTO messages_fts (rowid, message, channel_id)
+            SELECT id, message, channel_id FROM messages WHERE id > :start AND id <= :end
+        """).params(start=row.next_id, end=batch_end))
+        session.exec(text("UPDATE search_backfill SET next_id = :end WHERE id = 1").params(end=batch_end))
+        session.commit()
+        self.next_id, self.end_id = batch_end, row.end_id
+        self.batches += 1
+        self.done = batch_end >= row.end_id
+        return self.done
+
+    async def run(self):
+        try:
+            while not await run_in_session(self.run_batch):
+                await asyncio.sleep(self.pause)
+        except Exception:
+            logger.exception("search backfill stopped, it will resume from message %d on next start", self.next_id)
+            return
+        if self.batches:
+            logger.info("search backfill finished after %d batches", self.batches)
+
+    def stats(self) -> dict:
+        return {
+            "done": self.done,
+            "next_id": self.next_id,
+            "end_id": self.end_id,
+            "batches": self.batches,
+        }
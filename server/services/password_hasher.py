@@ -0,0 +1,79 @@
+﻿import hashlib
+import os
+import threading
+import time
+from base64 import b64encode, b64decode
+from concurrent.futures import ThreadPoolExecutor
+
+password_hash_workers = int(os.getenv("PASSWORD_HASH_WORKERS") or 2)
+password_hash_queue_limit = int(os.getenv("PASSWORD_HASH_QUEUE_LIMIT") or 16)
+
+def scrypt_hash(password: str) -> str:
+    salt = os.urandom(32)
+    passwordhash = hashlib.scrypt(password.encode("utf-8"), salt=salt, n=16384, r=8, p=1)
+    return f"1${b64encode(salt).decode('utf-8')}${b64encode(passwordhash).decode('utf-8')}"
+
+def scrypt_verify(password_hash: str, password: str) -> bool:
+    version, salt, expected_hash = password_hash.split('$')
+    if version != "1": return False
+    salt = b64decode(salt)
+    expected_hash = b64decode(expected_hash)
+    return hashlib.scrypt(password.encode("utf-8"), salt=salt, n=16384, r=8, p=1) == expected_hash
+
+class PasswordHasherBusy(Exception):
+    pass
+
+class PasswordHasher:
+    # scrypt costs ~16 MB and tens of ms per call, so it runs on a small dedicated pool
+    # and callers beyond the queue limit are rejected right away instead of piling up
+    def __init__(self, workers: int = password_hash_workers, queue_limit: int = password_hash_queue_limit):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scrypt")
+        self.max_pending = workers + queue_limit
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.calls = 0
+        self.rejected = 0
+        self.total_wait_seconds = 0.0
+        self.total_hash_seconds = 0.0
+        self.max_hash_seconds = 0.0
+
+    def _timed(self, submitted_at: float, func, *args):
+        started_at = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = time.perf_counter() - started_at
+            with self.lock:
+                self.calls += 1
+                self.total_wait_seconds += started_at - submitted_at
+                self.total_hash_seconds += elapsed
+                self.max_hash_seconds = max(self.max_hash_seconds, elapsed)
+
+    def _run(self, func, *args):
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise PasswordHasherBusy()
+            self.pending += 1
+        try:
+            return self.executor.submit(self._timed, time.perf_counter(), func, *args).result()
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def hash(self, password: str) -> str:
+        return self._run(scrypt_hash, password)
+
+    def verify(self, password_hash: str, password: str) -> bool:
+        return self._run(scrypt_verify, password_hash, password)
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "calls": self.calls,
+            "rejected": self.rejected,
+            "avg_wait_ms": self.total_wait_seconds / self.calls * 1000 if self.calls else 0.0,
+            "avg_hash_ms": self.total_hash_seconds / self.calls * 1000 if self.calls else 0.0,
+            "max_hash_ms": self.max_hash_seconds * 1000,
+        }
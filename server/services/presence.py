@@ -0,0 +1,278 @@
+﻿import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from ulid import ULID
+
+from database import run_in_session
+from model.friend_list import FriendListEntry
+from model.presence import PresenceEntry, PresenceStatus, PresenceUpdate
+
+logger = logging.getLogger(__name__)
+
+presence_flush_interval = float(os.getenv("PRESENCE_FLUSH_MS") or 250) / 1000
+presence_idle_after = float(os.getenv("PRESENCE_IDLE_AFTER") or 300)
+presence_idle_check_interval = float(os.getenv("PRESENCE_IDLE_CHECK") or 5)
+presence_friend_cache_size = int(os.getenv("PRESENCE_FRIEND_CACHE_SIZE") or 10000)
+# every node re-sends its full state this often; a node not heard from within the TTL is taken to be
+# gone and its users offline
+presence_announce_interval = float(os.getenv("PRESENCE_ANNOUNCE_INTERVAL") or 30)
+presence_node_ttl = float(os.getenv("PRESENCE_NODE_TTL") or 3 * presence_announce_interval)
+
+# a user connected to several nodes shows the most present of their states
+STATUS_RANK = {PresenceStatus.offline: 0, PresenceStatus.idle: 1, PresenceStatus.online: 2}
+
+class PresenceTracker:
+    # status changes are only marked dirty when they happen and are resolved together every flush
+    # interval, so a reconnect or a flapping tab within one interval produces no frame at all.
+    # Each node tracks its own sockets and shares its per-user status over the manager's broker;
+    # the node where a change happens notifies the user's online friends. The periodic full announce
+    # repairs state lost with missed envelopes and lets the other nodes expire one that crashed.
+    def __init__(self, manager, flush_interval: float = presence_flush_interval, idle_after: float = presence_idle_after):
+        self.manager = manager
+        self.flush_interval = flush_interval
+        self.idle_after = idle_after
+        self.node_id = str(ULID())
+        self.local_connections: dict[str, int] = dict()
+        self.last_active: dict[str, float] = dict()
+        self.announced: dict[str, PresenceStatus] = dict()
+        self.remote: dict[str, dict[str, PresenceStatus]] = dict()
+        self.node_seen: dict[str, float] = dict()
+        self.published: dict[str, PresenceStatus] = dict()
+        self.dirty: set[str] = set()
+        self.friends: OrderedDict[str, list[str]] = OrderedDict()
+        self.task: asyncio.Task | None = None
+        self.flushes = 0
+        self.changes = 0
+        self.suppressed = 0
+        self.frames = 0
+        self.expired_nodes = 0
+        self.resyncs = 0
+        manager.envelope_handlers["presence"] = self.handle_presence_envelope
+        manager.envelope_handlers["presence-announce"] = self.handle_presence_announce_envelope
+        manager.envelope_handlers["invalidate-friends"] = self.handle_invalidate_friends_envelope
+        manager.resync_handlers.append(self.resync)
+        manager.connect_handlers.append(self.connected)
+        manager.disconnect_handlers.append(self.disconnected)
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def connected(self, user_id):
+        user_id = str(user_id)
+        self.local_connections[user_id] = self.local_connections.get(user_id, 0) + 1
+        self.last_active[user_id] = time.monotonic()
+        self.dirty.add(user_id)
+
+    def disconnected(self, user_id):
+        user_id = str(user_id)
+        count = self.local_connections.get(user_id, 0) - 1
+        if count > 0:
+            self.local_connections[user_id] = count
+            return
+        self.local_connections.pop(user_id, None)
+        self.last_active.pop(user_id, None)
+        self.dirty.add(user_id)
+
+    def activity(self, user_id):
+        user_id = str(user_id)
+        if user_id not in self.local_connections:
+            return
+        now = time.monotonic()
+        if now - self.last_active[user_id] > self.idle_after:
+            self.dirty.add(user_id)
+        self.last_active[user_id] = now
+
+    def local_status(self, user_id: str) -> PresenceStatus:
+        if user_id not in self.local_connections:
+            return PresenceStatus.offline
+        if time.monotonic() - self.last_active[user_id] > self.idle_after:
+            return PresenceStatus.idle
+        return PresenceStatus.online
+
+    def status(self, user_id) -> PresenceStatus:
+        user_id = str(user_id)
+        states = [self.local_status(user_id), *self.remote.get(user_id, {}).values()]
+        return max(states, key=STATUS_RANK.__getitem__)
+
+    async def get_friends(self, user_id: str) -> list[str]:
+        friends = self.friends.get(user_id)
+        if friends is not None:
+            self.friends.move_to_end(user_id)
+            return friends
+        friends = await run_in_session(FriendListEntry.friend_userids, user_id)
+        self.friends[user_id] = friends
+        while len(self.friends) > presence_friend_cache_size:
+            self.friends.popitem(last=False)
+        return friends
+
+    def invalidate_friends(self, *user_ids):
+        for user_id in user_ids:
+            self.friends.pop(str(user_id), None)
+        self.manager.broker.publish({"op": "invalidate-friends", "users": [str(user_id) for user_id in user_ids]})
+
+    async def handle_invalidate_friends_envelope(self, envelope: dict):
+        for user_id in envelope["users"]:
+            self.friends.pop(user_id, None)
+
+    async def handle_presence_envelope(self, envelope: dict):
+        user_id, status = envelope["user"], PresenceStatus(envelope["status"])
+        self.node_seen[envelope["node"]] = time.monotonic()
+        nodes = self.remote.setdefault(user_id, dict())
+        if status == PresenceStatus.offline:
+            nodes.pop(envelope["node"], None)
+            if not nodes:
+                del self.remote[user_id]
+        else:
+            nodes[envelope["node"]] = status
+        # the originating node notifies friends, this one only keeps its dedupe state in step
+        self._set_published(user_id, self.status(user_id))
+
+    def announce(self, request: bool = False):
+        # this node's full state, replacing what the other nodes hold for it; with request set they
+        # answer with theirs
+        self.manager.broker.publish({
+            "op": "presence-announce", "node": self.node_id, "request": request,
+            "users": {user_id: status.value for user_id, status in self.announced.items()},
+        })
+
+    async def handle_presence_announce_envelope(self, envelope: dict):
+        node = envelope["node"]
+        self.node_seen[node] = time.monotonic()
+        users = {user_id: PresenceStatus(status) for user_id, status in envelope["users"].items()}
+        changed = self._forget_node(node, keep=users)
+        for user_id, status in users.items():
+            self.remote.setdefault(user_id, dict())[node] = status
+        # corrections of envelopes this node missed, the originating node notified the friends
+        for user_id in changed | users.keys():
+            self._set_published(user_id, self.status(user_id))
+        if envelope["request"]:
+            self.announce()
+
+    async def resync(self):
+        # envelopes from the other nodes may have been missed while the broker was away: forget their
+        # states and the friend lists they might have invalidated, and ask them to announce again
+        self.resyncs += 1
+        self.remote.clear()
+        self.node_seen.clear()
+        self.friends.clear()
+        self.announce(request=True)
+
+    def _forget_node(self, node: str, keep=()) -> set[str]:
+        forgotten = set()
+        for user_id, nodes in list(self.remote.items()):
+            if node in nodes and user_id not in keep:
+                del nodes[node]
+                if not nodes:
+                    del self.remote[user_id]
+                forgotten.add(user_id)
+        return forgotten
+
+    def _expire_nodes(self):
+        now = time.monotonic()
+        for node, seen in list(self.node_seen.items()):
+            if now - seen <= presence_node_ttl:
+                continue
+            del self.node_seen[node]
+            self.expired_nodes += 1
+            forgotten = self._forget_node(node)
+            logger.warning("presence node %s stopped announcing, dropping its %d users", node, len(forgotten))
+            # its users' friends are notified by one of the remaining nodes, the lowest id, so only once
+            if self.node_id == min([self.node_id, *self.node_seen]):
+                self.dirty.update(forgotten)
+            else:
+                for user_id in forgotten:
+                    self._set_published(user_id, self.status(user_id))
+
+    def _reconcile_published(self):
+        # users only known from other nodes whose state this node missed (e.g. across a resync)
+        for user_id in list(self.published):
+            if user_id in self.local_connections or user_id in self.dirty:
+                continue
+            self._set_published(user_id, self.status(user_id))
+
+    def _set_published(self, user_id: str, status: PresenceStatus):
+        if status == PresenceStatus.offline:
+            self.published.pop(user_id, None)
+        else:
+            self.published[user_id] = status
+
+    async def _run(self):
+        last_idle_check = last_announce = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            now = time.monotonic()
+            if now - last_idle_check >= presence_idle_check_interval:
+                last_idle_check = now
+                self.dirty.update(
+                    user_id for user_id in self.local_connections
+                    if self.local_status(user_id) != self.announced.get(user_id)
+                )
+            try:
+                if now - last_announce >= presence_announce_interval:
+                    last_announce = now
+                    self.announce()
+                    self._expire_nodes()
+                    self._reconcile_published()
+                await self.flush()
+            except Exception:
+                logger.exception("presence flush failed")
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, set()
+        self.flushes += 1
+        changes: dict[str, PresenceStatus] = dict()
+        for user_id in dirty:
+            local = self.local_status(user_id)
+            if local != self.announced.get(user_id, PresenceStatus.offline):
+                self.manager.broker.publish({"op": "presence", "node": self.node_id, "user": user_id, "status": local.value})
+                if local == PresenceStatus.offline:
+                    self.announced.pop(user_id, None)
+                else:
+                    self.announced[user_id] = local
+            status = self.status(user_id)
+            if status == self.published.get(user_id, PresenceStatus.offline):
+                self.suppressed += 1
+                continue
+            self._set_published(user_id, status)
+            changes[user_id] = status
+        if not changes:
+            return
+        self.changes += len(changes)
+
+        updates_by_recipient: dict[str, list[PresenceEntry]] = dict()
+        for user_id, status in changes.items():
+            entry = PresenceEntry(user_id=user_id, status=status)
+            for friend_id in await self.get_friends(user_id):
+                if self.status(friend_id) != PresenceStatus.offline:
+                    updates_by_recipient.setdefault(friend_id, []).append(entry)
+        for recipient, updates in updates_by_recipient.items():
+            await self.manager.broadcast_to_user(recipient, "presence-update", PresenceUpdate(updates=updates))
+            self.frames += 1
+
+    async def friends_presence(self, user_id) -> list[PresenceEntry]:
+        return [
+            PresenceEntry(user_id=friend_id, status=self.status(friend_id))
+            for friend_id in await self.get_friends(str(user_id))
+        ]
+
+    def stats(self) -> dict:
+        return {
+            "local_users": len(self.local_connections),
+            "remote_users": len(self.remote),
+            "remote_nodes": len(self.node_seen),
+            "expired_nodes": self.expired_nodes,
+            "resyncs": self.resyncs,
+            "flushes": self.flushes,
+            "changes": self.changes,
+            "suppressed": self.suppressed,
+            "frames": self.frames,
+            "cached_friend_lists": len(self.friends),
+        }
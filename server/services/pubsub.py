@@ -0,0 +1,210 @@
+﻿import asyncio
+import json
+import logging
+import os
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+pubsub_url = os.getenv("PUBSUB_URL") or ""
+pubsub_queue_size = int(os.getenv("PUBSUB_QUEUE_SIZE") or 10000)
+pubsub_reconnect_delay = float(os.getenv("PUBSUB_RECONNECT_DELAY") or 1)
+pubsub_client_buffer = int(os.getenv("PUBSUB_CLIENT_BUFFER") or 8 * 1024 * 1024)
+
+def parse_url(url: str) -> tuple[str, str, int | None]:
+    # tcp://host:port or unix:///path/to/socket
+    parsed = urlparse(url)
+    if parsed.scheme == "tcp" and parsed.hostname and parsed.port:
+        return "tcp", parsed.hostname, parsed.port
+    if parsed.scheme == "unix" and parsed.path:
+        return "unix", parsed.path, None
+    raise ValueError(f"invalid PUBSUB_URL: {url}")
+
+class Broker:
+    # carries fan-out envelopes to the other nodes; every node delivers only to its own sockets,
+    # so the publisher has already handled its local users before publishing
+    def __init__(self):
+        self.handler = None
+        self.published = 0
+        self.received = 0
+        self.dropped = 0
+
+    async def start(self, handler):
+        self.handler = handler
+
+    def publish(self, envelope: dict):
+        self.published += 1
+
+    def reaches_peers(self) -> bool:
+        # whether another node can currently hear what is published
+        return False
+
+    async def close(self):
+        pass
+
+    def stats(self) -> dict:
+        return {
+            "backend": type(self).__name__,
+            "published": self.published,
+            "received": self.received,
+            "dropped": self.dropped,
+        }
+
+class LocalBroker(Broker):
+    # single process: there is nobody else to tell
+    pass
+
+class SocketBroker(Broker):
+    # newline-delimited JSON over a TCP or Unix socket to a BrokerServer, reconnecting on failure;
+    # delivery is at most once, envelopes that don't fit the queue while disconnected are dropped.
+    # After a reconnect the handler gets a local {"op": "resync"}: envelopes from the other nodes
+    # may have been missed in between, so caches kept in step by them start over
+    def __init__(self, url: str):
+        super().__init__()
+        self.url = url
+        self.kind, self.address, self.port = parse_url(url)
+        self.queue: asyncio.Queue[bytes] | None = None
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.task: asyncio.Task | None = None
+        self.connected = False
+        self.reconnects = 0
+        self.resyncs = 0
+
+    async def start(self, handler):
+        await super().start(handler)
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=pubsub_queue_size)
+        self.task = asyncio.create_task(self._run())
+
+    def publish(self, envelope: dict):
+        if self.queue is None:
+            return
+        if not self._on_loop():
+            # sync endpoints publish from worker threads, the queue may only be touched on the loop
+            self.loop.call_soon_threadsafe(self.publish, envelope)
+            return
+        try:
+            self.queue.put_nowait(json.dumps(envelope, separators=(",", ":")).encode() + b"\n")
+            self.published += 1
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def reaches_peers(self) -> bool:
+        return self.connected
+
+    def _on_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    async def _open(self):
+        if self.kind == "unix":
+            return await asyncio.open_unix_connection(self.address, limit=pubsub_client_buffer)
+        return await asyncio.open_connection(self.address, self.port, limit=pubsub_client_buffer)
+
+    async def _run(self):
+        first_attempt = True
+        while True:
+            try:
+                reader, writer = await self._open()
+            except OSError as e:
+                logger.warning("pubsub broker %s unreachable: %r", self.url, e)
+                first_attempt = False
+                await asyncio.sleep(pubsub_reconnect_delay)
+                continue
+            self.connected = True
+            logger.info("connected to pubsub broker %s", self.url)
+            if not first_attempt:
+                self.resyncs += 1
+                try:
+                    await self.handler({"op": "resync"})
+                except Exception:
+                    logger.exception("pubsub resync failed")
+            first_attempt = False
+            read_task = asyncio.create_task(self._read_loop(reader))
+            try:
+                while not read_task.done():
+                    get_task = asyncio.create_task(self.queue.get())
+                    done, _ = await asyncio.wait((get_task, read_task), return_when=asyncio.FIRST_COMPLETED)
+                    if get_task not in done:
+                        get_task.cancel()
+                        break
+                    writer.write(get_task.result())
+                    await writer.drain()
+            except (OSError, ConnectionError) as e:
+                logger.warning("pubsub broker connection lost: %r", e)
+            finally:
+                self.connected = False
+                read_task.cancel()
+                writer.close()
+            self.reconnects += 1
+            await asyncio.sleep(pubsub_reconnect_delay)
+
+    async def _read_loop(self, reader: asyncio.StreamReader):
+        while line := await reader.readline():
+            self.received += 1
+            try:
+                await self.handler(json.loads(line))
+            except Exception:
+                logger.exception("failed to handle pubsub envelope")
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def stats(self) -> dict:
+        return super().stats() | {
+            "url": self.url,
+            "connected": self.connected,
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "reconnects": self.reconnects,
+            "resyncs": self.resyncs,
+        }
+
+class BrokerServer:
+    # relays every line a node sends to all other connected nodes; a node that can't keep up
+    # is disconnected rather than buffered without limit, and resyncs by reconnecting
+    def __init__(self, url: str):
+        self.url = url
+        self.kind, self.address, self.port = parse_url(url)
+        self.clients: set[asyncio.StreamWriter] = set()
+        self.relayed = 0
+        self.disconnected_slow = 0
+
+    async def start(self) -> asyncio.AbstractServer:
+        if self.kind == "unix":
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            return await asyncio.start_unix_server(self._handle, self.address, limit=pubsub_client_buffer)
+        return await asyncio.start_server(self._handle, self.address, self.port, limit=pubsub_client_buffer)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.clients.add(writer)
+        try:
+            while line := await reader.readline():
+                for client in list(self.clients):
+                    if client is writer:
+                        continue
+                    if client.transport.get_write_buffer_size() > pubsub_client_buffer:
+                        self.disconnected_slow += 1
+                        self.clients.discard(client)
+                        client.close()
+                        continue
+                    client.write(line)
+                    self.relayed += 1
+        except (OSError, ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    def stats(self) -> dict:
+        return {
+            "nodes": len(self.clients),
+            "relayed": self.relayed,
+            "disconnected_slow": self.disconnected_slow,
+        }
+
+def create_broker(url: str = pubsub_url) -> Broker:
+    return SocketBroker(url) if url else LocalBroker()
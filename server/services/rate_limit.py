@@ -0,0 +1,108 @@
+﻿import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+@dataclass(frozen=True)
+class Limit:
+    rate: float  # tokens per second
+    burst: float
+
+    def __str__(self):
+        return f"{self.rate:g}/s, burst {self.burst:g}"
+
+def parse_limit(value: str) -> Limit | None:
+    # "rate:burst" in commands per second, "0" disables the limit
+    rate, _, burst = value.partition(":")
+    if float(rate) <= 0:
+        return None
+    return Limit(float(rate), float(burst or rate))
+
+# (user, channel) budgets per command class; posting a message, drawing and call signalling all
+# fan out to every channel member, so a channel gets its own budget on top of each sender's.
+# Clients send a whiteboard segment per pointermove, 120-240 a second on high refresh rate input,
+# and a throttled segment is lost for good, so drawing gets headroom well above that; a sync
+# builds a snapshot of the whole board and is limited on its own
+DEFAULT_LIMITS = {
+    "message": ("5:10", "20:40"),
+    "whiteboard": ("500:1000", "2000:4000"),
+    "whiteboard_sync": ("2:10", "20:40"),
+    "call": ("20:60", "40:120"),
+    "default": ("30:60", "0"),
+}
+
+def limits_from_env() -> dict[str, tuple[Limit | None, Limit | None]]:
+    return {
+        rate_class: (
+            parse_limit(os.getenv(f"RATE_LIMIT_{rate_class.upper()}_USER") or user_default),
+            parse_limit(os.getenv(f"RATE_LIMIT_{rate_class.upper()}_CHANNEL") or channel_default),
+        )
+        for rate_class, (user_default, channel_default) in DEFAULT_LIMITS.items()
+    }
+
+class RateLimiter:
+    # token buckets kept as [tokens, last refill] in an LRU-ordered dict, refilled lazily on access,
+    # so a check is a dict lookup and a little arithmetic. A bucket untouched long enough to be full
+    # again is indistinguishable from a new one, so the least recently used ones are dropped as they
+    # expire. Limits are per process: with several workers a client gets up to one budget per worker.
+    def __init__(self, limits: dict[str, tuple[Limit | None, Limit | None]] | None = None):
+        self.limits = limits if limits is not None else limits_from_env()
+        self.buckets: OrderedDict[tuple[str, str, str], list[float]] = OrderedDict()
+        self.counters = {
+            rate_class: {"checked": 0, "throttled_user": 0, "throttled_channel": 0}
+            for rate_class in self.limits
+        }
+
+    def _take(self, key: tuple[str, str, str], limit: Limit, now: float) -> float:
+        # returns 0 when a token was taken, otherwise the seconds until one is available
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [limit.burst, now]
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(limit.burst, bucket[0] + (now - bucket[1]) * limit.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        return (1 - bucket[0]) / limit.rate
+
+    def _expire(self, now: float):
+        for _ in range(2):
+            if not self.buckets:
+                return
+            key, (tokens, last) = next(iter(self.buckets.items()))
+            limit = self.limits[key[0]][0 if key[1] == "user" else 1]
+            if tokens + (now - last) * limit.rate < limit.burst:
+                return
+            self.buckets.popitem(last=False)
+
+    def check(self, rate_class: str, scope: str, key) -> float:
+        # scope is "user" or "channel"; returns 0 if allowed, otherwise the retry delay in seconds
+        if rate_class not in self.limits:
+            rate_class = "default"
+        limit = self.limits[rate_class][0 if scope == "user" else 1]
+        if limit is None:
+            return 0.0
+        now = time.monotonic()
+        self._expire(now)
+        retry_after = self._take((rate_class, scope, str(key)), limit, now)
+        counters = self.counters[rate_class]
+        if scope == "user":
+            counters["checked"] += 1
+        if retry_after:
+            counters["throttled_" + scope] += 1
+        return retry_after
+
+    def stats(self) -> dict:
+        return {
+            "buckets": len(self.buckets),
+            "classes": {
+                rate_class: counters | {
+                    "user_limit": str(user_limit) if user_limit else None,
+                    "channel_limit": str(channel_limit) if channel_limit else None,
+                }
+                for (rate_class, counters), (user_limit, channel_limit)
+                in zip(self.counters.items(), self.limits.values())
+            },
+        }
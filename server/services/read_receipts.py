@@ -0,0 +1,133 @@
+﻿import asyncio
+import logging
+import os
+from sqlmodel import Session
+
+from database import run_in_session
+from model.channels import ChannelUser
+from model.read_receipt import ReadReceipt, ReadReceiptUpdate
+from services.websocket_manager import Message
+
+logger = logging.getLogger(__name__)
+
+read_receipt_flush_interval = float(os.getenv("READ_RECEIPT_FLUSH_MS") or 1000) / 1000
+read_receipt_broadcast = (os.getenv("READ_RECEIPT_BROADCAST") or "0") == "1"
+
+class ReadReceipts:
+    # read_message commands only raise the in-memory high-water mark per (user, channel); every flush
+    # interval all of them are written in one transaction, so scrolling through a backlog costs one
+    # commit instead of one per message. A user's marks are also flushed as soon as their last
+    # connection to this node closes.
+    def __init__(self, manager, flush_interval: float = read_receipt_flush_interval, broadcast: bool = read_receipt_broadcast):
+        self.manager = manager
+        self.flush_interval = flush_interval
+        self.broadcast = broadcast
+        self.pending: dict[str, dict[str, int]] = dict()
+        self.task: asyncio.Task | None = None
+        # flushes of disconnected users, referenced until done since the loop only holds tasks weakly
+        self.disconnect_flushes: set[asyncio.Task] = set()
+        self.received = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.failures = 0
+        self.frames = 0
+        manager.disconnect_handlers.append(self.disconnected)
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.disconnect_flushes:
+            await asyncio.gather(*self.disconnect_flushes, return_exceptions=True)
+        await self.flush()
+
+    def mark_read(self, user_id, channel_id, message_id: int):
+        self.received += 1
+        channels = self.pending.setdefault(str(user_id), dict())
+        previous = channels.get(str(channel_id))
+        if previous is not None:
+            self.coalesced += 1
+            if previous >= message_id:
+                return
+        channels[str(channel_id)] = message_id
+
+    def disconnected(self, user_id: str):
+        # the manager has already dropped the closed socket, other tabs keep the marks batched
+        if user_id in self.manager.active_connections:
+            return
+        channels = self.pending.pop(user_id, None)
+        if channels:
+            task = asyncio.create_task(self._write({user_id: channels}))
+            self.disconnect_flushes.add(task)
+            task.add_done_callback(self.disconnect_flushes.discard)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("read receipt flush failed")
+
+    async def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, dict()
+        await self._write(pending)
+
+    async def _write(self, pending: dict[str, dict[str, int]]):
+        reads = [
+            (user_id, channel_id, message_id)
+            for user_id, channels in pending.items()
+            for channel_id, message_id in channels.items()
+        ]
+        try:
+            applied = await run_in_session(self.write_reads, reads)
+        except Exception:
+            logger.exception("read receipt flush failed")
+            self.failures += 1
+            # keep the marks for the next flush, unless newer ones arrived meanwhile
+            for user_id, channel_id, message_id in reads:
+                self.mark_read(user_id, channel_id, message_id)
+            return
+        self.flushes += 1
+        self.rows_written += len(applied)
+        if self.broadcast and applied:
+            await self.broadcast_receipts(applied)
+
+    @staticmethod
+    def write_reads(session: Session, reads: list[tuple[str, str, int]]) -> list[ReadReceipt]:
+        applied = [
+            ReadReceipt(channel_id=channel_id, user_id=user_id, message_id=message_id)
+            for user_id, channel_id, message_id in reads
+            if ChannelUser.advance_last_read_message_id(session, user_id, channel_id, message_id)
+        ]
+        session.commit()
+        return applied
+
+    async def broadcast_receipts(self, receipts: list[ReadReceipt]):
+        # one frame per channel and flush; the reader's own other sessions get it too and can clear their badge
+        by_channel: dict[str, list[ReadReceipt]] = dict()
+        for receipt in receipts:
+            by_channel.setdefault(receipt.channel_id, []).append(receipt)
+        for channel_id, channel_receipts in by_channel.items():
+            members = await self.manager.get_channel_members_by_id(channel_id)
+            self.frames += await self.manager.send_to_users(
+                members,
+                "read-receipt",
+                Message.encode("read-receipt", ReadReceiptUpdate(receipts=channel_receipts))
+            )
+
+    def stats(self) -> dict:
+        return {
+            "pending_users": len(self.pending),
+            "received": self.received,
+            "coalesced": self.coalesced,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "failures": self.failures,
+            "frames": self.frames,
+        }
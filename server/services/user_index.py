@@ -0,0 +1,97 @@
+﻿import os
+import threading
+import time
+from bisect import bisect_left
+from sqlmodel import Session, select
+
+from database import run_in_session
+from model.user import User, UserInfo
+
+user_search_limit = int(os.getenv("USER_SEARCH_LIMIT") or 10)
+user_search_max = int(os.getenv("USER_SEARCH_MAX") or 50)
+
+class UserIndex:
+    # usernames sorted case-insensitively, so a prefix lookup is one bisect plus a short forward scan;
+    # entries are (folded username, userid, username) and the userid keeps duplicate names distinct.
+    # With a manager, additions and removals are published on its broker for the other nodes' indexes
+    def __init__(self, manager=None):
+        self.manager = manager
+        self.entries: list[tuple[str, str, str]] = []
+        self.lock = threading.Lock()
+        self.searches = 0
+        self.total_search_seconds = 0.0
+        self.max_search_seconds = 0.0
+        if manager is not None:
+            manager.envelope_handlers["user-added"] = self.handle_user_added_envelope
+            manager.envelope_handlers["user-removed"] = self.handle_user_removed_envelope
+            manager.resync_handlers.append(self.handle_resync)
+
+    @staticmethod
+    def entry(userid, username: str) -> tuple[str, str, str]:
+        return (username.casefold(), str(userid), username)
+
+    def load(self, session: Session):
+        rows = session.exec(select(User.userid, User.username)).all()
+        entries = sorted(self.entry(userid, username) for userid, username in rows)
+        with self.lock:
+            self.entries = entries
+        print(f"User index loaded {len(entries)} users")
+
+    def add(self, userid, username: str):
+        self._add(userid, username)
+        if self.manager is not None:
+            self.manager.broker.publish({"op": "user-added", "userid": str(userid), "username": username})
+
+    def remove(self, userid, username: str):
+        self._remove(userid, username)
+        if self.manager is not None:
+            self.manager.broker.publish({"op": "user-removed", "userid": str(userid), "username": username})
+
+    async def handle_user_added_envelope(self, envelope: dict):
+        self._add(envelope["userid"], envelope["username"])
+
+    async def handle_user_removed_envelope(self, envelope: dict):
+        self._remove(envelope["userid"], envelope["username"])
+
+    async def handle_resync(self):
+        # registrations and deletions on other nodes may have been missed
+        await run_in_session(self.load)
+
+    def _add(self, userid, username: str):
+        entry = self.entry(userid, username)
+        with self.lock:
+            position = bisect_left(self.entries, entry)
+            if position == len(self.entries) or self.entries[position] != entry:
+                self.entries.insert(position, entry)
+
+    def _remove(self, userid, username: str):
+        entry = self.entry(userid, username)
+        with self.lock:
+            position = bisect_left(self.entries, entry)
+            if position < len(self.entries) and self.entries[position] == entry:
+                del self.entries[position]
+
+    def search(self, prefix: str, limit: int = user_search_limit) -> list[UserInfo]:
+        started_at = time.perf_counter()
+        folded = prefix.casefold()
+        limit = max(1, min(limit, user_search_max))
+        results = []
+        with self.lock:
+            position = bisect_left(self.entries, (folded,))
+            for folded_name, userid, username in self.entries[position:position + limit]:
+                if not folded_name.startswith(folded):
+                    break
+                results.append(UserInfo(userid=userid, username=username))
+        elapsed = time.perf_counter() - started_at
+        self.searches += 1
+        self.total_search_seconds += elapsed
+        self.max_search_seconds = max(self.max_search_seconds, elapsed)
+        return results
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self.entries),
+            "searches": self.searches,
+            "avg_search_ms": self.total_search_seconds / self.searches * 1000 if self.searches else 0.0,
+            "max_search_ms": self.max_search_seconds * 1000,
+        }
@@ -1,51 +1,403 @@
-﻿from fastapi import WebSocket
+﻿import asyncio
+import heapq
+import json
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from fastapi import WebSocket, status
 from fastapi.websockets import WebSocketState
 from pydantic import BaseModel
 
 from sqlmodel import select, Session
 
+from database import run_in_session
+from services.pubsub import Broker, create_broker
+from services.ws_codec import JSON, encode_text, pack
 from model.channels import Channel, ChannelUser
 from model.user import User
 
+logger = logging.getLogger(__name__)
+
+send_timeout = float(os.getenv("WS_SEND_TIMEOUT") or 5)
+# past outbound_queue_size droppable frames are discarded; a connection whose queue still reaches
+# outbound_queue_hard_limit frames is evicted, so that is the most a slow reader can hold. The
+# headroom between the two lets a burst of frames that can't be dropped (history, message pushes)
+# ride out slow_consumer_timeout instead of evicting the socket at once
+outbound_queue_size = int(os.getenv("WS_OUTBOUND_QUEUE_SIZE") or 256)
+outbound_queue_hard_limit = max(outbound_queue_size, int(os.getenv("WS_OUTBOUND_QUEUE_HARD_LIMIT") or 4 * outbound_queue_size))
+slow_consumer_timeout = float(os.getenv("WS_SLOW_CONSUMER_TIMEOUT") or 10)
+# a connection that has been silent for ping_interval is pinged, one silent for ping_timeout is reaped
+ping_interval = float(os.getenv("WS_PING_INTERVAL") or 25)
+ping_timeout = float(os.getenv("WS_PING_TIMEOUT") or 60)
+reap_interval = float(os.getenv("WS_REAP_INTERVAL") or 5)
+login_timeout = float(os.getenv("WS_LOGIN_TIMEOUT") or 10)
+# channels whose member list is cached, least recently used ones are dropped past this
+channel_members_cache_size = int(os.getenv("WS_CHANNEL_MEMBERS_CACHE_SIZE") or 10000)
+# connections listed one by one in the metrics, the ones with the deepest queues
+stats_top_connections = int(os.getenv("WS_STATS_TOP_CONNECTIONS") or 20)
+
+PING_FRAME = '{"cmd":"ping","data":{}}'
+
+# commands whose oldest frames may be discarded when a connection's queue is full,
+# everything else (message, call-*, friend-state-update...) is always delivered
+droppable_commands = {"whiteboard", "whiteboard-batch"}
+
+# the event loop only keeps weak references to tasks, evicted sockets' close tasks are kept here until done
+closing_tasks: set[asyncio.Task] = set()
+
 class Message(BaseModel):
     cmd: str
     data: BaseModel
     def model_dump(self, **kwargs):
         base_dict = super().model_dump(**kwargs)
-        print(self.data)
         if isinstance(self.data, BaseModel):
             base_dict['data'] = self.data.model_dump(**kwargs)
-        print(base_dict)
         return base_dict
     def model_dump_json(self, **kwargs):
-        return super().model_dump_json(**kwargs).replace('"data":{}', '"data":' + self.data.model_dump_json(**kwargs))
+        return Message.encode(self.cmd, self.data, **kwargs)
+    @staticmethod
+    def encode(cmd: str, data: BaseModel, **kwargs) -> str:
+        return '{"cmd":' + json.dumps(cmd) + ',"data":' + data.model_dump_json(**kwargs) + '}'
 
-class ConnectionManager:
+class FanoutStats:
     def __init__(self):
-        self.active_connections: dict = dict()
+        self.fanouts = 0
+        self.sockets_reached = 0
+        self.sockets_failed = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, elapsed: float, reached: int, failed: int):
+        self.fanouts += 1
+        self.sockets_reached += reached
+        self.sockets_failed += failed
+        self.total_seconds += elapsed
+        self.max_seconds = max(self.max_seconds, elapsed)
+
+    def as_dict(self) -> dict:
+        return {
+            "fanouts": self.fanouts,
+            "sockets_reached": self.sockets_reached,
+            "sockets_failed": self.sockets_failed,
+            "avg_ms": self.total_seconds / self.fanouts * 1000 if self.fanouts else 0.0,
+            "max_ms": self.max_seconds * 1000,
+        }
+
+class Connection:
+    def __init__(self, websocket: WebSocket, user_id, on_close=None, encoding: str = JSON):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.encoding = encoding
+        self.on_close = on_close
+        self.last_seen = time.monotonic()
+        self.pinged_at = 0.0
+        self.queue: deque[tuple[str, str | bytes]] = deque()
+        self.has_data = asyncio.Event()
+        self.full_since: float | None = None
+        self.sent = 0
+        self.dropped = 0
+        self.closed = False
+        self.writer = asyncio.create_task(self._write_loop())
+
+    def enqueue(self, command: str, payload: str | bytes) -> bool:
+        if self.closed:
+            return False
+        if len(self.queue) >= outbound_queue_size:
+            now = time.monotonic()
+            if self.full_since is None:
+                self.full_since = now
+            elif now - self.full_since > slow_consumer_timeout:
+                self.evict("outbound queue full for too long")
+                return False
+            if not self._drop_oldest_droppable():
+                if command in droppable_commands:
+                    self.dropped += 1
+                    return False
+                if len(self.queue) >= outbound_queue_hard_limit:
+                    self.evict(f"outbound queue reached {outbound_queue_hard_limit} frames")
+                    return False
+        self.queue.append((command, payload))
+        self.has_data.set()
+        return True
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+    def send(self, command: str, obj: BaseModel) -> bool:
+        if self.encoding == JSON:
+            return self.enqueue(command, Message.encode(command, obj))
+        return self.enqueue(command, pack(command, obj.model_dump(mode="json")))
+
+    def _drop_oldest_droppable(self) -> bool:
+        for index, (command, _) in enumerate(self.queue):
+            if command in droppable_commands:
+                del self.queue[index]
+                self.dropped += 1
+                return True
+        return False
+
+    async def _write_loop(self):
+        try:
+            while True:
+                if not self.queue:
+                    self.has_data.clear()
+                    await self.has_data.wait()
+                    continue
+                _, payload = self.queue.popleft()
+                if len(self.queue) < outbound_queue_size:
+                    self.full_since = None
+                if self.websocket.client_state != WebSocketState.CONNECTED:
+                    break
+                if isinstance(payload, bytes):
+                    await asyncio.wait_for(self.websocket.send_bytes(payload), send_timeout)
+                else:
+                    await asyncio.wait_for(self.websocket.send_text(payload), send_timeout)
+                self.sent += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("websocket writer for user %s failed: %r", self.user_id, e)
+            self.evict("send failed")
+
+    def evict(self, reason: str, code: int = status.WS_1013_TRY_AGAIN_LATER):
+        if self.closed:
+            return
+        logger.warning("evicting connection of %s: %s", self.user_id, reason)
+        self.close()
+        task = asyncio.create_task(self._close_websocket(code))
+        closing_tasks.add(task)
+        task.add_done_callback(closing_tasks.discard)
+
+    async def _close_websocket(self, code: int):
+        try:
+            await asyncio.wait_for(self.websocket.close(code=code), send_timeout)
+        except Exception:
+            pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        if self.writer is not asyncio.current_task():
+            self.writer.cancel()
+        if self.on_close is not None:
+            self.on_close(self)
+
+    def stats(self) -> dict:
+        return {
+            "user_id": str(self.user_id),
+            "encoding": self.encoding,
+            "queue_depth": len(self.queue),
+            "idle_seconds": round(time.monotonic() - self.last_seen, 1),
+            "sent": self.sent,
+            "dropped": self.dropped,
+        }
+
+class ConnectionManager:
+    # active_connections only holds this process's sockets, keyed by str(userid); fan-out is delivered
+    # locally and then published on the broker so other workers and hosts deliver to theirs.
+    # connections is the reverse index, so removing a socket doesn't scan every user
+    def __init__(self, broker: Broker | None = None):
+        self.broker = broker or create_broker()
+        self.active_connections: dict[str, set[Connection]] = dict()
+        self.connections: dict[WebSocket, Connection] = dict()
+        # other services (presence, caches...) register here for their own envelope ops, connection events
+        # and resyncs, which are async and run after the broker reconnected and envelopes may be missing
+        self.envelope_handlers: dict = dict()
+        self.connect_handlers: list = []
+        self.disconnect_handlers: list = []
+        self.resync_handlers: list = []
+        self.heartbeat_task: asyncio.Task | None = None
+        self.pings_sent = 0
+        self.reaped = 0
+        self.transcoded = 0
+        self.fanout_stats = FanoutStats()
+        self.channel_members: OrderedDict[str, list] = OrderedDict()
+        self.channel_members_hits = 0
+        self.channel_members_misses = 0
+        self.channel_members_generation = 0
+
+    async def start(self):
+        await self.broker.start(self.handle_envelope)
+        self.heartbeat_task = asyncio.create_task(self._heartbeat())
 
-    async def connect(self, websocket: WebSocket, user: User):
+    async def stop(self):
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+        await self.broker.close()
 
-        self.active_connections.setdefault(user.userid, []).append(websocket)
+    async def handle_envelope(self, envelope: dict):
+        if envelope["op"] == "send":
+            self.deliver_local(envelope["users"], envelope["cmd"], envelope["text"])
+        elif envelope["op"] == "invalidate-members":
+            self._invalidate_channel_members(envelope["channel"])
+        elif envelope["op"] == "resync":
+            self.channel_members_generation += 1
+            self.channel_members.clear()
+            for handler in self.resync_handlers:
+                await handler()
+        else:
+            handler = self.envelope_handlers.get(envelope["op"])
+            if handler is not None:
+                await handler(envelope)
+
+    async def connect(self, websocket: WebSocket, user: User, encoding: str = JSON) -> Connection:
+        connection = Connection(websocket, user.userid, self._remove, encoding)
+        self.active_connections.setdefault(str(user.userid), set()).add(connection)
+        self.connections[websocket] = connection
+        for handler in self.connect_handlers:
+            handler(str(user.userid))
+        return connection
 
     def disconnect(self, websocket: WebSocket):
-        for user_list in self.active_connections.values():
-            user_list.remove(websocket)
+        # safe to call more than once, an evicted or reaped connection is already gone
+        connection = self.connections.get(websocket)
+        if connection is not None:
+            connection.close()
+
+    def _remove(self, connection: Connection):
+        # called once by Connection.close, whatever closed it
+        self.connections.pop(connection.websocket, None)
+        user_id = str(connection.user_id)
+        user_connections = self.active_connections.get(user_id)
+        if user_connections is not None:
+            user_connections.discard(connection)
+            if not user_connections:
+                del self.active_connections[user_id]
+        for handler in self.disconnect_handlers:
+            handler(user_id)
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(reap_interval)
+            try:
+                self.check_connections()
+            except Exception:
+                logger.exception("websocket heartbeat failed")
+
+    def check_connections(self):
+        now = time.monotonic()
+        for connection in list(self.connections.values()):
+            silent = now - connection.last_seen
+            if silent > ping_timeout:
+                self.reaped += 1
+                connection.evict(f"no frames for {silent:.0f}s", status.WS_1001_GOING_AWAY)
+            elif silent >= ping_interval and now - connection.pinged_at >= ping_interval:
+                connection.pinged_at = now
+                if connection.enqueue("ping", encode_text(connection.encoding, "ping", PING_FRAME)):
+                    self.pings_sent += 1
+
+    def connection_stats(self) -> dict:
+        # totals, and per socket only the slowest readers so the listing doesn't grow with every user
+        connections = [connection.stats() for connection in self.connections.values()]
+        return {
+            "connections": len(connections),
+            "queued": sum(entry["queue_depth"] for entry in connections),
+            "max_queue_depth": max((entry["queue_depth"] for entry in connections), default=0),
+            "max_idle_seconds": max((entry["idle_seconds"] for entry in connections), default=0.0),
+            "sent": sum(entry["sent"] for entry in connections),
+            "dropped": sum(entry["dropped"] for entry in connections),
+            "deepest_queues": heapq.nlargest(stats_top_connections, connections,
+                                             key=lambda entry: (entry["queue_depth"], entry["dropped"])),
+        }
+
+    def encoding_stats(self) -> dict:
+        connections = dict()
+        for connection in self.connections.values():
+            connections[connection.encoding] = connections.get(connection.encoding, 0) + 1
+        return {
+            "connections": connections,
+            "transcoded_frames": self.transcoded,
+        }
+
+    def heartbeat_stats(self) -> dict:
+        return {
+            "connections": len(self.connections),
+            "users": len(self.active_connections),
+            "pings_sent": self.pings_sent,
+            "reaped": self.reaped,
+        }
+
+    async def send_to_users(self, user_ids, command: str, text: str) -> int:
+        # returns the number of local sockets reached, remote deliveries are not acknowledged
+        user_ids = [str(user_id) for user_id in user_ids]
+        reached = self.deliver_local(user_ids, command, text)
+        if user_ids:
+            self.broker.publish({"op": "send", "users": user_ids, "cmd": command, "text": text})
+        return reached
+
+    def deliver_local(self, user_ids: list[str], command: str, text: str) -> int:
+        start = time.perf_counter()
+        reached = 0
+        failed = 0
+        # the frame in each encoding some recipient uses, built on first need
+        payloads: dict[str, str | bytes] = {JSON: text}
+        for user_id in user_ids:
+            for connection in self.active_connections.get(user_id, ()):
+                payload = payloads.get(connection.encoding)
+                if payload is None:
+                    payload = payloads[connection.encoding] = encode_text(connection.encoding, command, text)
+                    self.transcoded += 1
+                if connection.enqueue(command, payload):
+                    reached += 1
+                else:
+                    failed += 1
+        if reached or failed:
+            elapsed = time.perf_counter() - start
+            self.fanout_stats.record(elapsed, reached, failed)
+            logger.debug("fan-out reached %d/%d sockets in %.2f ms", reached, reached + failed, elapsed * 1000)
+        return reached
 
     async def broadcast_to_user(self, user_id: str, command: str, obj: BaseModel):
-        websockets = self.active_connections.get(user_id)
-        json_str = Message(cmd=command, data=obj).model_dump_json()
-        if websockets:
-            for websocket in websockets:
-                if websocket.client_state == WebSocketState.CONNECTED:
-                    await websocket.send_text(json_str)
-        else:
-            print("no websockets for user", user_id)
+        await self.send_to_users((user_id,), command, Message.encode(command, obj))
+
+    @staticmethod
+    def load_channel_members(session: Session, channel_id) -> list:
+        return session.exec(select(ChannelUser.user_id).where(ChannelUser.channel_id == channel_id)).all()
+
+    async def get_channel_members(self, channel: Channel) -> list:
+        return await self.get_channel_members_by_id(channel.channel_id)
+
+    async def get_channel_members_by_id(self, channel_id) -> list:
+        key = str(channel_id)
+        members = self.channel_members.get(key)
+        if members is not None:
+            self.channel_members_hits += 1
+            self.channel_members.move_to_end(key)
+            return members
+        self.channel_members_misses += 1
+        generation = self.channel_members_generation
+        members = await run_in_session(self.load_channel_members, key)
+        if generation == self.channel_members_generation:
+            # don't cache a result that may predate an invalidation that happened while loading
+            self.channel_members[key] = members
+            while len(self.channel_members) > channel_members_cache_size:
+                self.channel_members.popitem(last=False)
+        return members
+
+    def invalidate_channel_members(self, channel_id: str):
+        self._invalidate_channel_members(str(channel_id))
+        self.broker.publish({"op": "invalidate-members", "channel": str(channel_id)})
+
+    def _invalidate_channel_members(self, channel_id: str):
+        self.channel_members_generation += 1
+        self.channel_members.pop(str(channel_id), None)
+
+    def channel_members_stats(self) -> dict:
+        return {
+            "cached_channels": len(self.channel_members),
+            "hits": self.channel_members_hits,
+            "misses": self.channel_members_misses,
+        }
 
-    async def broadcast_to_channel(self, session: Session, channel: Channel, command: str, obj: BaseModel, skip_user: User = None):
-        users = session.exec(select(ChannelUser.user_id).where(ChannelUser.channel_id == channel.channel_id)).all()
-        for user_id in users:
-            if not skip_user or skip_user.userid != user_id:
-                await self.broadcast_to_user(user_id, command, obj)
+    async def broadcast_to_channel(self, channel: Channel, command: str, obj: BaseModel, skip_user: User = None):
+        users = await self.get_channel_members(channel)
+        await self.send_to_users(
+            [user_id for user_id in users if not skip_user or skip_user.userid != user_id],
+            command,
+            Message.encode(command, obj)
+        )
 
 
@@ -0,0 +1,91 @@
+﻿import asyncio
+import json
+import logging
+import os
+
+from model.whiteboard import WhiteboardDrawData, WhiteboardStroke
+
+logger = logging.getLogger(__name__)
+
+whiteboard_tick = float(os.getenv("WHITEBOARD_TICK_MS") or 16) / 1000
+
+class PendingBatch:
+    def __init__(self, members: list):
+        self.members = members
+        self.strokes: dict[str, list[WhiteboardStroke]] = dict()
+
+class WhiteboardCoalescer:
+    def __init__(self, manager, tick: float = whiteboard_tick):
+        self.manager = manager
+        self.tick = tick
+        self.pending: dict[str, PendingBatch] = dict()
+        self.task: asyncio.Task | None = None
+        self.segments_in = 0
+        self.strokes_out = 0
+        self.frames_out = 0
+
+    def add(self, members: list, sender_id, data: WhiteboardDrawData):
+        self.segments_in += 1
+        batch = self.pending.get(data.channel_id)
+        if batch is None:
+            batch = self.pending[data.channel_id] = PendingBatch(members)
+        strokes = batch.strokes.setdefault(str(sender_id), [])
+        if strokes:
+            stroke = strokes[-1]
+            if (stroke.line_width == data.line_width and stroke.line_color == data.line_color
+                    and stroke.points[-2] == data.prevX and stroke.points[-1] == data.prevY):
+                stroke.points += (data.x, data.y)
+                self._schedule()
+                return
+        strokes.append(WhiteboardStroke(
+            sender_id=str(sender_id),
+            line_width=data.line_width,
+            line_color=data.line_color,
+            points=[data.prevX, data.prevY, data.x, data.y],
+        ))
+        self._schedule()
+
+    def _schedule(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self.pending:
+            await asyncio.sleep(self.tick)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.exception("whiteboard flush failed: %r", e)
+
+    async def flush(self):
+        pending, self.pending = self.pending, dict()
+        for channel_id, batch in pending.items():
+            encoded = {
+                sender_id: ",".join(stroke.model_dump_json() for stroke in strokes)
+                for sender_id, strokes in batch.strokes.items()
+            }
+            self.strokes_out += sum(len(strokes) for strokes in batch.strokes.values())
+            prefix = '{"cmd":"whiteboard-batch","data":{"channel_id":' + json.dumps(channel_id) + ',"strokes":['
+            shared_members = []
+            for member in batch.members:
+                member_id = str(member)
+                if member_id not in encoded:
+                    shared_members.append(member_id)
+                    continue
+                # senders don't get their own strokes echoed back
+                parts = [part for sender_id, part in encoded.items() if sender_id != member_id]
+                if parts:
+                    text = prefix + ",".join(parts) + ']}}'
+                    self.frames_out += await self.manager.send_to_users((member_id,), "whiteboard-batch", text)
+            if shared_members:
+                # everyone who didn't draw gets the same frame, sent as a single fan-out
+                shared_text = prefix + ",".join(encoded.values()) + ']}}'
+                self.frames_out += await self.manager.send_to_users(shared_members, "whiteboard-batch", shared_text)
+
+    def stats(self) -> dict:
+        return {
+            "tick_ms": self.tick * 1000,
+            "segments_in": self.segments_in,
+            "strokes_out": self.strokes_out,
+            "frames_out": self.frames_out,
+        }
@@ -0,0 +1,474 @@
+﻿import asyncio
+import hashlib
+import heapq
+import logging
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from pathlib import Path
+from ulid import ULID
+
+from model.whiteboard import WhiteboardDrawData
+
+try:
+    import fcntl
+except ImportError:
+    # no record locks (Windows): a single server process is assumed, it persists every board
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+whiteboard_data_dir = Path(os.getenv("WHITEBOARD_DATA_DIR") or "data/whiteboards")
+max_segments = int(os.getenv("WHITEBOARD_MAX_SEGMENTS") or 50000)
+snapshot_every = int(os.getenv("WHITEBOARD_SNAPSHOT_EVERY") or 500)
+# boards kept in memory, together with max_segments this bounds the store's total memory
+max_boards = int(os.getenv("WHITEBOARD_MAX_BOARDS") or 1000)
+board_idle_seconds = float(os.getenv("WHITEBOARD_IDLE_SECONDS") or 600)
+# how long a board loaded on first use waits for another node's copy before using the file
+peer_load_timeout = float(os.getenv("WHITEBOARD_PEER_LOAD_TIMEOUT_MS") or 200) / 1000
+# boards listed one by one in the metrics, the largest ones
+stats_top_boards = int(os.getenv("WHITEBOARD_STATS_TOP_BOARDS") or 20)
+
+SNAPSHOT_MAGIC = b"VZWB"
+SNAPSHOT_VERSION = 1
+MAX_PALETTE_SIZE = 256
+INT16_MIN = -32768
+INT16_MAX = 32767
+# snapshots are always little endian
+NEEDS_BYTESWAP = sys.byteorder != "little"
+
+def clamp_int16(value: int) -> int:
+    return INT16_MIN if value < INT16_MIN else INT16_MAX if value > INT16_MAX else value
+
+def lock_offset(channel_id: str) -> int:
+    # the byte of the shared lock file that stands for the board
+    return int.from_bytes(hashlib.blake2b(channel_id.encode("utf-8"), digest_size=7).digest(), "little")
+
+class WhiteboardLog:
+    # one segment = 4 int16 in coords (prevX, prevY, x, y) + 2 uint8 in styles (palette index, line width)
+    def __init__(self):
+        self.coords = array("h")
+        self.styles = array("B")
+        self.palette: list[str] = []
+        self.palette_index: dict[str, int] = dict()
+        self.unsaved_segments = 0
+        self.snapshot: bytes | None = None
+        self.disk_bytes = 0
+        self.last_used = time.monotonic()
+        self.revision = 0
+
+    def __len__(self):
+        return len(self.styles) // 2
+
+    def color_index(self, color: str) -> int:
+        index = self.palette_index.get(color)
+        if index is None:
+            if len(self.palette) >= MAX_PALETTE_SIZE:
+                return 0
+            index = self.palette_index[color] = len(self.palette)
+            self.palette.append(color)
+        return index
+
+    def append(self, prev_x: int, prev_y: int, x: int, y: int, color: str, line_width: int):
+        self.coords.extend((clamp_int16(prev_x), clamp_int16(prev_y), clamp_int16(x), clamp_int16(y)))
+        self.styles.extend((self.color_index(color), max(0, min(line_width, 255))))
+        self.unsaved_segments += 1
+        self.revision += 1
+        self.snapshot = None
+        if len(self) > max_segments:
+            # keep the newest three quarters, older strokes are usually painted over anyway
+            drop = len(self) - max_segments * 3 // 4
+            del self.coords[:drop * 4]
+            del self.styles[:drop * 2]
+
+    def copy(self) -> "WhiteboardLog":
+        # a frozen copy to build a snapshot from on an executor thread, one memcpy per array
+        log = WhiteboardLog()
+        log.coords = self.coords[:]
+        log.styles = self.styles[:]
+        log.palette = list(self.palette)
+        log.palette_index = dict(self.palette_index)
+        log.snapshot = self.snapshot
+        log.revision = self.revision
+        return log
+
+    def polylines(self):
+        coords = self.coords
+        styles = self.styles
+        points = None
+        style = None
+        for i in range(len(self)):
+            segment_style = (styles[i * 2], styles[i * 2 + 1])
+            prev_x, prev_y, x, y = coords[i * 4:i * 4 + 4]
+            if points is not None and segment_style == style and points[-2] == prev_x and points[-1] == prev_y \
+                    and len(points) < 0xFFFF * 2:
+                points.extend((x, y))
+                continue
+            if points is not None:
+                yield style, points
+            style = segment_style
+            points = array("h", (prev_x, prev_y, x, y))
+        if points is not None:
+            yield style, points
+
+    def build_snapshot(self) -> bytes:
+        if self.snapshot is not None:
+            return self.snapshot
+        parts = [SNAPSHOT_MAGIC, struct.pack("<BH", SNAPSHOT_VERSION, len(self.palette))]
+        for color in self.palette:
+            encoded = color.encode("utf-8")[:255]
+            parts.append(struct.pack("<B", len(encoded)))
+            parts.append(encoded)
+        strokes = []
+        for (color_index, line_width), points in self.polylines():
+            if NEEDS_BYTESWAP:
+                points.byteswap()
+            strokes.append(struct.pack("<BBH", color_index, line_width, len(points) // 2))
+            strokes.append(points.tobytes())
+        parts.append(struct.pack("<I", len(strokes) // 2))
+        parts.extend(strokes)
+        self.snapshot = b"".join(parts)
+        return self.snapshot
+
+    @staticmethod
+    def from_snapshot(data: bytes) -> "WhiteboardLog":
+        log = WhiteboardLog()
+        if data[:4] != SNAPSHOT_MAGIC:
+            raise ValueError("not a whiteboard snapshot")
+        version, palette_size = struct.unpack_from("<BH", data, 4)
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"unsupported whiteboard snapshot version {version}")
+        offset = 7
+        for _ in range(palette_size):
+            (length,) = struct.unpack_from("<B", data, offset)
+            log.color_index(data[offset + 1:offset + 1 + length].decode("utf-8"))
+            offset += 1 + length
+        (stroke_count,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+        for _ in range(stroke_count):
+            color_index, line_width, point_count = struct.unpack_from("<BBH", data, offset)
+            offset += 4
+            points = array("h")
+            points.frombytes(data[offset:offset + point_count * 4])
+            if NEEDS_BYTESWAP:
+                points.byteswap()
+            offset += point_count * 4
+            for i in range(2, len(points), 2):
+                log.coords.extend(points[i - 2:i + 2])
+                log.styles.extend((color_index, line_width))
+        log.snapshot = data
+        log.unsaved_segments = 0
+        return log
+
+    def memory_bytes(self) -> int:
+        return self.coords.itemsize * len(self.coords) + self.styles.itemsize * len(self.styles) \
+            + len(self.snapshot or b"")
+
+class WhiteboardStore:
+    # boards are loaded on first use and kept in LRU order; the least recently used board is saved
+    # and dropped once there are more than max_boards or it has been idle for board_idle_seconds.
+    # Building, decoding and writing snapshots takes ~100ms for a board at max_segments, so they run
+    # on executor threads; the event loop only copies the segment arrays.
+    # With a manager, every node holding a board applies the segments drawn on the others, and a node
+    # loading a board asks them for their copy first, since the file lags behind by up to
+    # snapshot_every segments. Of the processes holding a board only the one with a record lock on its
+    # byte in whiteboards.lock writes the file; the lock is taken on its first save and released
+    # when it evicts the board.
+    def __init__(self, manager=None, data_dir: Path = whiteboard_data_dir):
+        self.manager = manager
+        self.data_dir = data_dir
+        self.node_id = str(ULID())
+        self.boards: OrderedDict[str, WhiteboardLog] = OrderedDict()
+        # snapshot writes run on executor threads and may finish out of order
+        self.write_lock = threading.Lock()
+        self.write_generation = 0
+        self.written: dict[Path, int] = dict()
+        # latest generation being written per channel, and evicted boards whose write hasn't finished
+        self.pending_writes: dict[str, int] = dict()
+        self.evicted: dict[str, WhiteboardLog] = dict()
+        self.loading: dict[str, asyncio.Task] = dict()
+        # segments from other nodes for boards being loaded, and replies awaited from them
+        self.loading_segments: dict[str, list] = dict()
+        self.peer_requests: dict[str, asyncio.Future] = dict()
+        self.reply_tasks: set[asyncio.Task] = set()
+        self.lock_file = None
+        self.owned: set[str] = set()
+        self.evictions = 0
+        self.remote_appends = 0
+        self.peer_loads = 0
+        self.skipped_saves = 0
+        if manager is not None:
+            manager.envelope_handlers["whiteboard-appended"] = self.handle_appended_envelope
+            manager.envelope_handlers["whiteboard-want"] = self.handle_want_envelope
+            manager.envelope_handlers["whiteboard-board"] = self.handle_board_envelope
+            manager.resync_handlers.append(self.handle_resync)
+
+    def _path(self, channel_id: str) -> Path:
+        return self.data_dir / f"{channel_id}.vzwb"
+
+    async def get(self, channel_id: str) -> WhiteboardLog:
+        log = self.boards.get(channel_id)
+        if log is None and channel_id in self.evicted:
+            # evicted but not on disk yet, the file would be older than what we have
+            log = self.boards[channel_id] = self.evicted.pop(channel_id)
+        elif log is None:
+            # concurrent first uses of a board share one load
+            if channel_id not in self.loading:
+                self.loading[channel_id] = asyncio.create_task(self._load(channel_id))
+            log = await asyncio.shield(self.loading[channel_id])
+        else:
+            self.boards.move_to_end(channel_id)
+        log.last_used = time.monotonic()
+        self._evict()
+        return log
+
+    async def _load(self, channel_id: str) -> WhiteboardLog:
+        try:
+            read = asyncio.get_running_loop().run_in_executor(None, self._read, self._path(channel_id))
+            log = await self._load_from_peers(channel_id)
+            if log is None:
+                log = await read
+        finally:
+            del self.loading[channel_id]
+            segments = self.loading_segments.pop(channel_id, [])
+        # some may be in the peer's copy already, drawing a segment twice looks the same
+        for segment in segments:
+            log.append(*segment)
+        self.boards[channel_id] = log
+        return log
+
+    async def _load_from_peers(self, channel_id: str) -> WhiteboardLog | None:
+        if self.manager is None or not self.manager.broker.reaches_peers():
+            return None
+        loop = asyncio.get_running_loop()
+        future = self.peer_requests[channel_id] = loop.create_future()
+        self.manager.broker.publish({"op": "whiteboard-want", "channel": channel_id, "node": self.node_id})
+        try:
+            snapshot = await asyncio.wait_for(future, peer_load_timeout)
+        except asyncio.TimeoutError:
+            # no other node holds it
+            return None
+        finally:
+            del self.peer_requests[channel_id]
+        try:
+            log = await loop.run_in_executor(None, WhiteboardLog.from_snapshot, snapshot)
+        except Exception as e:
+            logger.warning("cannot load whiteboard %s from another node: %r", channel_id, e)
+            return None
+        self.peer_loads += 1
+        # the file lags behind the copy, it isn't saved until the next snapshot_every segments
+        log.unsaved_segments = 1
+        return log
+
+    @staticmethod
+    def _read(path: Path) -> WhiteboardLog:
+        if not path.exists():
+            return WhiteboardLog()
+        try:
+            data = path.read_bytes()
+            log = WhiteboardLog.from_snapshot(data)
+            log.disk_bytes = len(data)
+            return log
+        except Exception as e:
+            logger.warning("cannot load whiteboard snapshot %s: %r", path, e)
+            return WhiteboardLog()
+
+    def _evict(self):
+        now = time.monotonic()
+        while len(self.boards) > 1:
+            channel_id, log = next(iter(self.boards.items()))
+            if len(self.boards) <= max_boards and now - log.last_used < board_idle_seconds:
+                break
+            del self.boards[channel_id]
+            self.evictions += 1
+            if log.unsaved_segments:
+                self._save_log(channel_id, log)
+            if channel_id in self.pending_writes:
+                self.evicted[channel_id] = log
+            else:
+                self._disown(channel_id)
+
+    async def append(self, data: WhiteboardDrawData):
+        log = await self.get(data.channel_id)
+        segment = (data.prevX, data.prevY, data.x, data.y, data.line_color, data.line_width)
+        self._append(data.channel_id, log, segment)
+        if self.manager is not None:
+            self.manager.broker.publish({"op": "whiteboard-appended", "channel": data.channel_id, "segment": segment})
+
+    def _append(self, channel_id: str, log: WhiteboardLog, segment):
+        log.append(*segment)
+        if log.unsaved_segments >= snapshot_every:
+            self._save_log(channel_id, log)
+
+    async def handle_appended_envelope(self, envelope: dict):
+        channel_id = envelope["channel"]
+        if channel_id in self.loading:
+            self.loading_segments.setdefault(channel_id, []).append(envelope["segment"])
+            return
+        log = self.boards.get(channel_id)
+        if log is None:
+            log = self.evicted.get(channel_id)
+        if log is None:
+            # not held here, loaded with it from the nodes that hold it
+            return
+        self.remote_appends += 1
+        log.last_used = time.monotonic()
+        self._append(channel_id, log, envelope["segment"])
+
+    async def handle_want_envelope(self, envelope: dict):
+        if envelope["channel"] not in self.boards:
+            return
+        # the snapshot is built on an executor thread, the broker's read loop doesn't wait for it
+        task = asyncio.create_task(self._send_board(envelope["channel"], envelope["node"]))
+        self.reply_tasks.add(task)
+        task.add_done_callback(self.reply_tasks.discard)
+
+    async def _send_board(self, channel_id: str, node: str):
+        log = self.boards.get(channel_id)
+        if log is None:
+            return
+        snapshot = await self._build(log)
+        self.manager.broker.publish({
+            "op": "whiteboard-board", "channel": channel_id, "node": node,
+            "snapshot": b64encode(snapshot).decode("ascii"),
+        })
+
+    async def handle_board_envelope(self, envelope: dict):
+        if envelope["node"] != self.node_id:
+            return
+        # the first node to answer wins
+        future = self.peer_requests.get(envelope["channel"])
+        if future is not None and not future.done():
+            future.set_result(b64decode(envelope["snapshot"]))
+
+    async def handle_resync(self):
+        # segments from the other nodes may have been missed; boards another process persists are
+        # dropped and fetched again on next use, the others stay as the most complete copy around
+        for channel_id in list(self.boards):
+            if not self._owns(channel_id):
+                del self.boards[channel_id]
+
+    async def snapshot(self, channel_id: str) -> bytes:
+        return await self._build(await self.get(channel_id))
+
+    async def _build(self, log: WhiteboardLog) -> bytes:
+        if log.snapshot is not None:
+            return log.snapshot
+        frozen = log.copy()
+        snapshot = await asyncio.get_running_loop().run_in_executor(None, frozen.build_snapshot)
+        self._cache_snapshot(log, frozen)
+        return snapshot
+
+    @staticmethod
+    def _cache_snapshot(log: WhiteboardLog, frozen: WhiteboardLog):
+        # unless segments were appended while it was being built
+        if log.revision == frozen.revision:
+            log.snapshot = frozen.snapshot
+
+    def _owns(self, channel_id: str) -> bool:
+        # whether this process persists the board; the other nodes holding it have the same segments
+        if channel_id in self.owned:
+            return True
+        if fcntl is not None:
+            if self.lock_file is None:
+                self.data_dir.mkdir(parents=True, exist_ok=True)
+                self.lock_file = open(self.data_dir / "whiteboards.lock", "a+b")
+            try:
+                fcntl.lockf(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, lock_offset(channel_id))
+            except OSError:
+                return False
+        self.owned.add(channel_id)
+        return True
+
+    def _disown(self, channel_id: str):
+        if channel_id not in self.owned:
+            return
+        self.owned.discard(channel_id)
+        if fcntl is not None:
+            fcntl.lockf(self.lock_file, fcntl.LOCK_UN, 1, lock_offset(channel_id))
+
+    def _save_log(self, channel_id: str, log: WhiteboardLog):
+        if not self._owns(channel_id):
+            log.unsaved_segments = 0
+            self.skipped_saves += 1
+            return
+        frozen = log.copy()
+        log.unsaved_segments = 0
+        self.write_generation += 1
+        generation = self.pending_writes[channel_id] = self.write_generation
+        future = asyncio.get_running_loop().run_in_executor(None, self._build_and_write, self._path(channel_id), frozen, generation)
+        future.add_done_callback(lambda _: self._written(channel_id, log, frozen, generation))
+
+    def _build_and_write(self, path: Path, frozen: WhiteboardLog, generation: int):
+        self._write(path, frozen.build_snapshot(), generation)
+
+    def _written(self, channel_id: str, log: WhiteboardLog, frozen: WhiteboardLog, generation: int):
+        if frozen.snapshot is not None:
+            log.disk_bytes = len(frozen.snapshot)
+            self._cache_snapshot(log, frozen)
+        if self.pending_writes.get(channel_id) == generation:
+            del self.pending_writes[channel_id]
+            self.evicted.pop(channel_id, None)
+            if channel_id not in self.boards:
+                # written after it was evicted, another process may persist it from now on
+                self._disown(channel_id)
+
+    def save_all(self):
+        for channel_id, log in self.boards.items():
+            if log.unsaved_segments and self._owns(channel_id):
+                snapshot = log.build_snapshot()
+                log.disk_bytes = len(snapshot)
+                log.unsaved_segments = 0
+                self.write_generation += 1
+                self._write(self._path(channel_id), snapshot, self.write_generation)
+
+    def _write(self, path: Path, snapshot: bytes, generation: int):
+        tmp_path = None
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # a temp file of its own, concurrent saves of one board can't write into each other's
+            with tempfile.NamedTemporaryFile(dir=path.parent, prefix=path.stem + ".", suffix=".tmp", delete=False) as tmp:
+                tmp_path = tmp.name
+                tmp.write(snapshot)
+            with self.write_lock:
+                if self.written.get(path, 0) > generation:
+                    # a newer snapshot of this board is already in place
+                    os.unlink(tmp_path)
+                    return
+                os.replace(tmp_path, path)
+                self.written[path] = generation
+        except Exception as e:
+            logger.warning("cannot write whiteboard snapshot %s: %r", path, e)
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def stats(self) -> dict:
+        return {
+            "max_segments": max_segments,
+            "max_boards": max_boards,
+            "boards": len(self.boards),
+            "evictions": self.evictions,
+            "owned": len(self.owned),
+            "remote_appends": self.remote_appends,
+            "peer_loads": self.peer_loads,
+            "skipped_saves": self.skipped_saves,
+            "segments": sum(len(log) for log in self.boards.values()),
+            "max_board_segments": max((len(log) for log in self.boards.values()), default=0),
+            "memory_bytes": sum(log.memory_bytes() for log in self.boards.values()),
+            "disk_bytes": sum(log.disk_bytes for log in self.boards.values()),
+            "largest_boards": [
+                {
+                    "channel_id": channel_id,
+                    "segments": len(log),
+                    "memory_bytes": log.memory_bytes(),
+                    "disk_bytes": log.disk_bytes,
+                }
+                for channel_id, log in heapq.nlargest(stats_top_boards, self.boards.items(), key=lambda item: len(item[1]))
+            ],
+        }
@@ -0,0 +1,72 @@
+﻿import json
+import msgpack
+
+# Websocket frames are JSON text by default. A client can ask for "msgpack" in its login command,
+# it then gets binary frames [cmd, data] and may send them too. For the hot commands below data is
+# an array in the listed field order instead of a map; a (name, fields) entry is a list of such arrays.
+JSON = "json"
+MSGPACK = "msgpack"
+ENCODINGS = {JSON, MSGPACK}
+
+STROKE_FIELDS = ("sender_id", "line_width", "line_color", "points")
+
+COMPACT_INBOUND = {
+    "whiteboard": ("channel_id", "x", "y", "prevX", "prevY", "line_width", "line_color"),
+    "call-ice-candidate": ("channel_id", "candidate"),
+}
+
+COMPACT_OUTBOUND = {
+    "whiteboard-batch": ("channel_id", ("strokes", STROKE_FIELDS)),
+    "call-ice-candidate": ("caller_id", "candidate"),
+    "presence-update": (("updates", ("user_id", "status")),),
+}
+
+class FrameError(ValueError):
+    pass
+
+def _compact(data: dict, fields: tuple) -> list:
+    values = []
+    for field in fields:
+        if isinstance(field, tuple):
+            name, item_fields = field
+            values.append([_compact(item, item_fields) for item in data[name]])
+        else:
+            values.append(data[field])
+    return values
+
+def _expand(values: list, fields: tuple) -> dict:
+    if len(values) != len(fields):
+        raise FrameError(f"expected {len(fields)} fields, got {len(values)}")
+    data = dict()
+    for field, value in zip(fields, values):
+        if isinstance(field, tuple):
+            name, item_fields = field
+            data[name] = [_expand(item, item_fields) for item in value]
+        else:
+            data[field] = value
+    return data
+
+def pack(command: str, data) -> bytes:
+    fields = COMPACT_OUTBOUND.get(command)
+    return msgpack.packb([command, _compact(data, fields) if fields else data])
+
+def encode_text(encoding: str, command: str, text: str) -> str | bytes:
+    # re-encodes a JSON text frame, fan-out does this at most once per encoding and frame
+    if encoding == JSON:
+        return text
+    return pack(command, json.loads(text)["data"])
+
+def decode_text(text: str) -> tuple[str, object]:
+    frame = json.loads(text)
+    return frame["cmd"], frame["data"]
+
+def decode_binary(payload: bytes) -> tuple[str, object]:
+    try:
+        command, data = msgpack.unpackb(payload)
+    except (ValueError, TypeError, msgpack.UnpackException) as e:
+        raise FrameError(f"malformed msgpack frame: {e!r}") from e
+    fields = COMPACT_INBOUND.get(command)
+    if fields and isinstance(data, list):
+        # the map form is accepted too
+        data = _expand(data, fields)
+    return command, data
@@ -0,0 +1,177 @@
+﻿import logging
+import math
+import os
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pydantic import BaseModel, ValidationError
+
+from database import run_in_session
+from model.channels import Channel
+from model.throttle import Throttled
+from services.rate_limit import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+channel_cache_size = int(os.getenv("WS_CHANNEL_CACHE_SIZE") or 10000)
+
+# upper bounds of the latency histogram buckets, anything slower lands in "+inf"
+LATENCY_BUCKETS_MS = (0.1, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000)
+
+class ChannelLookup:
+    # channel rows never change identity and are never deleted, so they are cached by id for good;
+    # misses aren't cached because the channel may be created later. Membership comes from the
+    # manager's member cache, which is invalidated when members change.
+    def __init__(self, manager, size: int = channel_cache_size):
+        self.manager = manager
+        self.size = size
+        self.channels: OrderedDict[str, Channel] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, channel_id: str) -> Channel | None:
+        channel = self.channels.get(channel_id)
+        if channel is not None:
+            self.hits += 1
+            self.channels.move_to_end(channel_id)
+            return channel
+        self.misses += 1
+        channel = await run_in_session(Channel.by_channel_id, channel_id)
+        if channel is not None:
+            self.channels[channel_id] = channel
+            while len(self.channels) > self.size:
+                self.channels.popitem(last=False)
+        return channel
+
+    async def get_for_member(self, channel_id: str, user_id) -> Channel | None:
+        channel = await self.get(channel_id)
+        if channel is None:
+            return None
+        members = await self.manager.get_channel_members(channel)
+        return channel if str(user_id) in map(str, members) else None
+
+    def stats(self) -> dict:
+        return {
+            "cached_channels": len(self.channels),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+class CommandStats:
+    def __init__(self):
+        self.count = 0
+        self.invalid = 0
+        self.errors = 0
+        self.throttled = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def record(self, elapsed: float):
+        self.count += 1
+        self.total_seconds += elapsed
+        self.max_seconds = max(self.max_seconds, elapsed)
+        self.buckets[bisect_left(LATENCY_BUCKETS_MS, elapsed * 1000)] += 1
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "invalid": self.invalid,
+            "errors": self.errors,
+            "throttled": self.throttled,
+            "error_rate": (self.invalid + self.errors) / self.count if self.count else 0.0,
+            "avg_ms": self.total_seconds / self.count * 1000 if self.count else 0.0,
+            "max_ms": self.max_seconds * 1000,
+            "histogram_ms": {
+                **{f"le_{bound}": n for bound, n in zip(LATENCY_BUCKETS_MS, self.buckets)},
+                "+inf": self.buckets[-1],
+            },
+        }
+
+@dataclass
+class CommandContext:
+    user: object
+    connection: object
+    # per rate class, until when the client has already been told it is throttled
+    throttled_until: dict[str, float] = field(default_factory=dict)
+
+@dataclass
+class CommandSpec:
+    handler: object
+    model: type[BaseModel] | None
+    channel: bool
+    rate_class: str
+    stats: CommandStats
+
+class CommandRegistry:
+    # handlers are registered once at import time with the pydantic model of their payload;
+    # dispatch is one dict lookup, a validation and, for channel commands, a cached channel and
+    # membership check. A handler is called as handler(context, payload) or, with channel=True,
+    # handler(context, payload, channel) once the sender is known to be a member of payload.channel_id.
+    # The sender's budget for the command's rate class is checked before anything else, the channel's
+    # once the channel is resolved, so non-members can't use up a channel's budget.
+    def __init__(self, channels: ChannelLookup, limiter: RateLimiter | None = None):
+        self.channels = channels
+        self.limiter = limiter
+        self.commands: dict[str, CommandSpec] = dict()
+        self.unknown = 0
+        self.rejected = 0
+
+    def command(self, name: str, model: type[BaseModel] | None = None, channel: bool = False, rate_class: str = "default"):
+        def register(handler):
+            self.commands[name] = CommandSpec(handler, model, channel, rate_class, CommandStats())
+            return handler
+        return register
+
+    async def dispatch(self, context: CommandContext, cmd: str, data) -> None:
+        spec = self.commands.get(cmd)
+        if spec is None:
+            self.unknown += 1
+            logger.debug("unknown websocket command %r from %s", cmd, context.user.userid)
+            return
+        started_at = time.perf_counter()
+        try:
+            if self._throttled(context, cmd, spec, "user", context.user.userid):
+                return
+            payload = spec.model.model_validate(data) if spec.model is not None else data
+            if spec.channel:
+                channel = await self.channels.get_for_member(payload.channel_id, context.user.userid)
+                if channel is None:
+                    self.rejected += 1
+                    return
+                if self._throttled(context, cmd, spec, "channel", channel.channel_id):
+                    return
+                await spec.handler(context, payload, channel)
+            else:
+                await spec.handler(context, payload)
+        except ValidationError as e:
+            spec.stats.invalid += 1
+            logger.info("invalid %s command from %s: %s", cmd, context.user.userid, e.errors(include_url=False))
+        except Exception:
+            spec.stats.errors += 1
+            logger.exception("websocket command %s failed", cmd)
+        finally:
+            spec.stats.record(time.perf_counter() - started_at)
+
+    def _throttled(self, context: CommandContext, cmd: str, spec: CommandSpec, scope: str, key) -> bool:
+        if self.limiter is None:
+            return False
+        retry_after = self.limiter.check(spec.rate_class, scope, key)
+        if not retry_after:
+            return False
+        spec.stats.throttled += 1
+        # one throttled frame per rate class until the budget refills, a flood doesn't get one per command
+        now = time.monotonic()
+        if now >= context.throttled_until.get(spec.rate_class, 0.0):
+            context.throttled_until[spec.rate_class] = now + retry_after
+            context.connection.send("throttled", Throttled(cmd=cmd, scope=scope, retry_after_ms=math.ceil(retry_after * 1000)))
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "unknown": self.unknown,
+            "rejected": self.rejected,
+            "channels": self.channels.stats(),
+            "commands": {name: spec.stats.as_dict() for name, spec in self.commands.items()},
+        }
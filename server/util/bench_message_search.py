@@ -0,0 +1,84 @@
+﻿import argparse
+import itertools
+import os
+import random
+import tempfile
+import time
+from sqlmodel import Session, create_engine, text
+from ulid import ULID
+
+if __name__ != "__main__":
+    raise Exception("Utility script, only run directly")
+
+from migrations.runner import apply_migrations
+from services.message_search import search_messages
+
+parser = argparse.ArgumentParser(description="Measure FTS5 message search latency on a synthetic history")
+parser.add_argument("--messages", type=int, default=1_000_000)
+parser.add_argument("--users", type=int, default=2000)
+parser.add_argument("--channels", type=int, default=5000)
+parser.add_argument("--words", type=int, default=20000, help="vocabulary size, drawn with a Zipf-like distribution")
+parser.add_argument("--repeat", type=int, default=20)
+parser.add_argument("--limit", type=int, default=20)
+args = parser.parse_args()
+
+def timed(label, func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{label:<40} {elapsed * 1000:10.2f} ms")
+    return result
+
+with tempfile.TemporaryDirectory() as tmp:
+    engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+    apply_migrations(engine)
+    random.seed(1)
+    vocabulary = [f"w{i}x{random.randrange(1000)}" for i in range(args.words)]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(args.words)))
+    users = [str(ULID()) for _ in range(args.users)]
+    channels = [(str(ULID()), random.sample(users, 2)) for _ in range(args.channels)]
+
+    print(f"populating {args.messages} messages in {args.channels} channels...")
+    started_at = time.perf_counter()
+    raw = engine.raw_connection()
+    cursor = raw.cursor()
+    cursor.executemany("INSERT INTO channels (channel_id, channel_type, last_update) VALUES (?, 'user', 0)",
+                       [(channel_id,) for channel_id, _ in channels])
+    cursor.executemany("INSERT INTO channel_users (channel_id, user_id) VALUES (?, ?)",
+                       [(channel_id, user_id) for channel_id, members in channels for user_id in members])
+    batch = []
+    for i in range(args.messages):
+        channel_id, members = channels[random.randrange(len(channels))]
+        words = random.choices(vocabulary, cum_weights=cum_weights, k=random.randint(3, 15))
+        batch.append((channel_id, random.choice(members), " ".join(words), i))
+        if len(batch) == 50000:
+            cursor.executemany("INSERT INTO messages (channel_id, sender_id, message, created_at) VALUES (?, ?, ?, ?)", batch)
+            batch.clear()
+    cursor.executemany("INSERT INTO messages (channel_id, sender_id, message, created_at) VALUES (?, ?, ?, ?)", batch)
+    raw.commit()
+    print(f"populated in {time.perf_counter() - started_at:.1f}s, indexing...")
+    started_at = time.perf_counter()
+    cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    raw.commit()
+    raw.close()
+    print(f"indexed in {time.perf_counter() - started_at:.1f}s, database {os.path.getsize(os.path.join(tmp, 'bench.db')) / 1e6:.0f} MB")
+
+    user_id = max(users, key=lambda u: sum(u in members for _, members in channels))
+    user_channels = [channel_id for channel_id, members in channels if user_id in members]
+    print(f"searching as a user in {len(user_channels)} channels")
+    common, medium, rare = vocabulary[0], vocabulary[100], vocabulary[args.words - 1]
+    queries = {
+        f"common word ({common})": (common, None),
+        f"medium word ({medium})": (medium, None),
+        f"rare word ({rare})": (rare, None),
+        f"two words ({vocabulary[1]} {vocabulary[2]})": (f"{vocabulary[1]} {vocabulary[2]}", None),
+        f"prefix ({medium[:3]}*)": (f"{medium[:3]}*", None),
+        f"common word in one channel": (common, user_channels[0]),
+    }
+    with Session(engine) as session:
+        for label, (query, channel_id) in queries.items():
+            results, next_cursor = timed(label, lambda: search_messages(session, user_id, query, channel_id, None, args.limit), args.repeat)
+            if next_cursor:
+                timed("  next page", lambda: search_messages(session, user_id, query, channel_id, next_cursor, args.limit), args.repeat)
+            print(f"  {len(results)} results on first page")
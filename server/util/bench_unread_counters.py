@@ -0,0 +1,73 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+from sqlmodel import Session, SQLModel, create_engine, text
+from ulid import ULID
+
+if __name__ != "__main__":
+    raise Exception("Utility script, only run directly")
+
+from model.unread_counter import UnreadCounter
+import model.channels, model.message, model.opened_chat
+
+# the query get_opened_chats used to run on every sidebar load
+LEGACY_UNREAD_QUERY = text('''
+    SELECT COUNT(*) AS count, messages.channel_id
+    FROM messages
+    JOIN channel_users ON messages.channel_id = channel_users.channel_id
+    WHERE channel_users.user_id = :userid AND
+    channel_users.last_read_message_id < messages.id
+    GROUP BY messages.channel_id;
+''')
+
+parser = argparse.ArgumentParser(description="Compare COUNT(*) unread query with the unread_counters table")
+parser.add_argument("--messages", type=int, default=1_000_000)
+parser.add_argument("--users", type=int, default=2000)
+parser.add_argument("--channels", type=int, default=5000)
+parser.add_argument("--repeat", type=int, default=20)
+args = parser.parse_args()
+
+def timed(label, func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{label:<32} {elapsed * 1000:10.2f} ms")
+    return result
+
+with tempfile.TemporaryDirectory() as tmp:
+    engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+    SQLModel.metadata.create_all(engine)
+    random.seed(1)
+    users = [str(ULID()) for _ in range(args.users)]
+    channels = [(str(ULID()), random.sample(users, 2)) for _ in range(args.channels)]
+    # everybody starts having read up to message 0 so the legacy query counts rows
+    channel_users = [(channel_id, user_id, 0) for channel_id, members in channels for user_id in members]
+
+    print(f"populating {args.messages} messages in {args.channels} channels...")
+    raw = engine.raw_connection()
+    cursor = raw.cursor()
+    cursor.executemany("INSERT INTO channels (channel_id, channel_type, last_update) VALUES (?, 'user', 0)",
+                       [(channel_id,) for channel_id, _ in channels])
+    cursor.executemany("INSERT INTO channel_users (channel_id, user_id, last_read_message_id) VALUES (?, ?, ?)",
+                       channel_users)
+    batch = []
+    for i in range(args.messages):
+        channel_id, members = channels[random.randrange(len(channels))]
+        batch.append((channel_id, random.choice(members), "benchmark message", i))
+        if len(batch) == 50000:
+            cursor.executemany("INSERT INTO messages (channel_id, sender_id, message, created_at) VALUES (?, ?, ?, ?)", batch)
+            batch.clear()
+    cursor.executemany("INSERT INTO messages (channel_id, sender_id, message, created_at) VALUES (?, ?, ?, ?)", batch)
+    raw.commit()
+    raw.close()
+
+    with Session(engine) as session:
+        timed("rebuild unread_counters", lambda: UnreadCounter.rebuild(session), 1)
+        user_id = max(users, key=lambda u: sum(u in members for _, members in channels))
+        print(f"user in {sum(user_id in members for _, members in channels)} channels")
+        legacy = timed("legacy COUNT(*) join", lambda: session.exec(LEGACY_UNREAD_QUERY.params(userid=user_id)).all(), args.repeat)
+        counters = timed("unread_counters lookup", lambda: UnreadCounter.for_user(session, user_id), args.repeat)
+        print(f"legacy total {sum(row.count for row in legacy)}, counters total {sum(counters.values())} (counters exclude own messages)")
@@ -0,0 +1,41 @@
+﻿import argparse
+import random
+import string
+import time
+from ulid import ULID
+
+if __name__ != "__main__":
+    raise Exception("Utility script, only run directly")
+
+from services.user_index import UserIndex
+
+parser = argparse.ArgumentParser(description="Measure username prefix search latency of the in-memory user index")
+parser.add_argument("--users", type=int, default=1_000_000)
+parser.add_argument("--searches", type=int, default=10000)
+parser.add_argument("--limit", type=int, default=10)
+args = parser.parse_args()
+
+random.seed(1)
+alphabet = string.ascii_lowercase + string.digits
+names = ["".join(random.choices(alphabet, k=random.randint(4, 16))) for _ in range(args.users)]
+
+index = UserIndex()
+started_at = time.perf_counter()
+index.entries = sorted(index.entry(ULID(), name) for name in names)
+print(f"built index of {args.users} users in {time.perf_counter() - started_at:.2f}s")
+
+started_at = time.perf_counter()
+for _ in range(1000):
+    index.add(ULID(), "".join(random.choices(alphabet, k=8)))
+print(f"insert (registration)   {(time.perf_counter() - started_at) / 1000 * 1000:.3f} ms")
+
+for prefix_length in (1, 2, 3, 5):
+    prefixes = [name[:prefix_length] for name in random.sample(names, args.searches)]
+    timings = []
+    for prefix in prefixes:
+        started_at = time.perf_counter()
+        index.search(prefix, args.limit)
+        timings.append(time.perf_counter() - started_at)
+    timings.sort()
+    print(f"prefix length {prefix_length}: avg {sum(timings) / len(timings) * 1000:.3f} ms, "
+          f"p99 {timings[int(len(timings) * 0.99)] * 1000:.3f} ms")
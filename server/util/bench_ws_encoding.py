@@ -0,0 +1,65 @@
+﻿import argparse
+import json
+import random
+import time
+import msgpack
+from ulid import ULID
+
+if __name__ != "__main__":
+    raise Exception("Utility script, only run directly")
+
+from services import ws_codec
+
+parser = argparse.ArgumentParser(description="Compare websocket frame size and encode/decode CPU of JSON and msgpack")
+parser.add_argument("--iterations", type=int, default=20000)
+args = parser.parse_args()
+
+random.seed(1)
+channel_id = str(ULID())
+users = [str(ULID()) for _ in range(5)]
+
+def stroke():
+    return {
+        "sender_id": random.choice(users),
+        "line_width": random.randint(1, 10),
+        "line_color": random.choice(["#000000", "#ff0000", "#1e90ff"]),
+        "points": [random.randint(0, 1920) for _ in range(32)],
+    }
+
+# (direction, command, data); inbound frames are decoded by the server, outbound ones encoded
+frames = [
+    ("in", "whiteboard", {"channel_id": channel_id, "x": 512, "y": 384, "prevX": 510, "prevY": 381, "line_width": 3, "line_color": "#ff0000"}),
+    ("in", "call-ice-candidate", {"channel_id": channel_id, "candidate": {
+        "candidate": "candidate:842163049 1 udp 1677729535 203.0.113.7 46154 typ srflx raddr 0.0.0.0 rport 0 generation 0",
+        "sdpMid": "0", "sdpMLineIndex": 0}}),
+    ("out", "whiteboard-batch", {"channel_id": channel_id, "strokes": [stroke() for _ in range(3)]}),
+    ("out", "presence-update", {"updates": [{"user_id": user, "status": "online"} for user in users]}),
+    ("out", "message", {"message": "see you at the standup tomorrow", "id": 123456, "sender_id": users[0],
+                        "created_at": 1760000000, "channel_id": channel_id}),
+]
+
+def timed(func, payload) -> float:
+    started_at = time.perf_counter()
+    for _ in range(args.iterations):
+        func(payload)
+    return (time.perf_counter() - started_at) / args.iterations * 1e6
+
+print(f"{'frame':<24}{'format':<18}{'bytes':>7}{'encode us':>12}{'decode us':>12}")
+for direction, command, data in frames:
+    compact = ws_codec.COMPACT_INBOUND if direction == "in" else ws_codec.COMPACT_OUTBOUND
+    fields = compact.get(command)
+    text = json.dumps({"cmd": command, "data": data}, separators=(",", ":"))
+    formats = [
+        ("json", text, lambda frame: json.dumps(frame, separators=(",", ":")), json.loads, {"cmd": command, "data": data}),
+        ("msgpack map", msgpack.packb([command, data]), msgpack.packb, msgpack.unpackb, [command, data]),
+    ]
+    if fields:
+        compact_frame = [command, ws_codec._compact(data, fields)]
+        formats.append(("msgpack compact", msgpack.packb(compact_frame), msgpack.packb,
+                        ws_codec.decode_binary if direction == "in" else msgpack.unpackb, compact_frame))
+    for name, encoded, encode, decode, frame in formats:
+        print(f"{direction + ' ' + command:<24}{name:<18}{len(encoded):>7}{timed(encode, frame):>12.2f}{timed(decode, encoded):>12.2f}")
+    if direction == "out":
+        # what fan-out pays once per frame when msgpack clients are among the recipients
+        transcode = timed(lambda t: ws_codec.encode_text(ws_codec.MSGPACK, command, t), text)
+        print(f"{'':<24}{'json -> msgpack':<18}{'':>7}{transcode:>12.2f}")
@@ -0,0 +1,123 @@
+﻿import os
+import re
+import sys
+import tempfile
+from sqlalchemy import event
+from sqlmodel import Session, SQLModel, select
+from ulid import ULID
+
+if __name__ != "__main__":
+    raise Exception("Utility script, only run directly")
+
+# runs every hot query against an empty schema and fails if SQLite plans a full scan of one of
+# our tables, so a dropped index or a rewritten query shows up before it reaches a large database
+temp_dir = tempfile.TemporaryDirectory()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(temp_dir.name, 'plans.db')}"
+
+from database import engine
+from migrations.runner import apply_migrations
+from model.user import User
+from model.message import Message
+from model.channels import Channel, ChannelUser
+from model.opened_chat import OpenedChat
+from model.friend_list import FriendListEntry
+from model.unread_counter import UnreadCounter
+from model.email_outbox import OutboundEmail
+from services.websocket_manager import ConnectionManager
+from services.message_history import load_page_bounds, stream_page, PageBounds
+from services.message_search import search_messages, encode_search_cursor
+
+checked_tables = {table.name for table in SQLModel.metadata.sorted_tables}
+full_scan = re.compile(r"^SCAN (\w+)")
+# walking an index in order is fine when a LIMIT stops it after one page
+bounded_index_scan = re.compile(r"^SCAN \w+ USING (COVERING )?INDEX ")
+
+apply_migrations(engine)
+
+user = User(id=1, email="a@example.com", username="a", passwordhash="")
+other = User(id=2, email="b@example.com", username="b", passwordhash="")
+channel = Channel(id=1, channel_type="user", last_update=0)
+message = Message(id=1, channel_id=channel.channel_id, sender_id=user.userid, message="", created_at=0)
+channel_id = str(channel.channel_id)
+
+# functions that return early for a user without channels (search_messages) need a membership row
+# to reach the queries they exist for
+with Session(engine) as session:
+    session.add(ChannelUser(channel_id=channel.channel_id, user_id=user.userid))
+    session.commit()
+
+# each entry calls the function main.py, model/ or services/ runs on a request or websocket path,
+# the SQL it issues is captured and explained, so the check can't drift from the shipped queries
+hot_queries = {
+    "User primary key (get_current_user, delete_user)": lambda session: session.get(User, 1),
+    "User.by_email": lambda session: User.by_email(session, "a@example.com"),
+    "User.by_userid": lambda session: User.by_userid(session, str(ULID())),
+    "User.page": lambda session: User.page(session, None, 100),
+    "User.page(after)": lambda session: User.page(session, str(ULID()), 100),
+    "Message.latest": lambda session: Message.latest(session, channel.channel_id, 20),
+    "Message.latest(before_id)": lambda session: Message.latest(session, channel.channel_id, 20, 100),
+    "Message.channel_id_of": lambda session: Message.channel_id_of(session, 1),
+    "Channel.by_channel_id": lambda session: Channel.by_channel_id(session, channel_id),
+    "OpenedChat.find": lambda session: OpenedChat.find(session, user.userid, channel.channel_id),
+    "OpenedChat.channels_for_user": lambda session: OpenedChat.channels_for_user(session, user.userid),
+    "FriendListEntry.find": lambda session: FriendListEntry.find(session, user.id, other.id),
+    "FriendListEntry.list_users(friends)": lambda session: FriendListEntry.list_users(session, user.id, "friends"),
+    "FriendListEntry.list_users(outgoing)": lambda session: FriendListEntry.list_users(session, user.id, "outgoing-requests"),
+    "FriendListEntry.list_users(incoming)": lambda session: FriendListEntry.list_users(session, user.id, "incoming-requests"),
+    "Channel.get_users": lambda session: channel.get_users(session, user),
+    "ChannelUser.find_user_channel": lambda session: ChannelUser.find_user_channel(session, str(user.userid), str(other.userid)),
+    "ChannelUser.update_last_read_message_id": lambda session: ChannelUser.update_last_read_message_id(session, str(user.userid), message),
+    "UnreadCounter.increment_for_channel": lambda session: UnreadCounter.increment_for_channel(session, channel_id, str(user.userid)),
+    "UnreadCounter.recount": lambda session: UnreadCounter.recount(session, channel_id, str(user.userid), 1),
+    "UnreadCounter.for_user": lambda session: UnreadCounter.for_user(session, str(user.userid)),
+    "FriendListEntry.friend_userids": lambda session: FriendListEntry.friend_userids(session, str(user.userid)),
+    "OutboundEmail.due": lambda session: OutboundEmail.due(session, 0, 50),
+    "OutboundEmail.next_attempt": lambda session: OutboundEmail.next_attempt(session),
+    "ConnectionManager.load_channel_members": lambda session: ConnectionManager.load_channel_members(session, channel_id),
+    "message_history.load_page_bounds(latest)": lambda session: load_page_bounds(session, channel_id, "latest", None, 20),
+    "message_history.load_page_bounds(before)": lambda session: load_page_bounds(session, channel_id, "before", 100, 20),
+    "message_history.load_page_bounds(after)": lambda session: load_page_bounds(session, channel_id, "after", 100, 20),
+    "message_history.load_page_bounds(around)": lambda session: load_page_bounds(session, channel_id, "around", 100, 20),
+    "message_history.stream_page": lambda session: list(stream_page(engine, PageBounds(channel_id, 1, 20, 20))),
+    "message_search.search_messages": lambda session: search_messages(session, str(user.userid), "hello wor*", None, None, 20),
+    "message_search.search_messages(channel, cursor)": lambda session: search_messages(
+        session, str(user.userid), "hello", channel_id, encode_search_cursor(20, 100), 20),
+}
+
+captured = []
+
+@event.listens_for(engine, "before_cursor_execute")
+def capture(_connection, _cursor, statement, parameters, _context, _executemany):
+    captured.append((statement, parameters))
+
+failures = 0
+for name, run in hot_queries.items():
+    captured.clear()
+    with Session(engine) as session:
+        run(session)
+        session.rollback()
+    statements = [(statement, parameters) for statement, parameters in captured if statement.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE", "DELETE"))]
+
+    print(name)
+    scans = []
+    with engine.connect() as connection:
+        for statement, parameters in statements:
+            for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters):
+                detail = row[-1]
+                print(f"    {detail}")
+                match = full_scan.match(detail)
+                if bounded_index_scan.match(detail) and " LIMIT " in statement.upper():
+                    continue
+                if match and match.group(1) in checked_tables:
+                    scans.append(detail)
+    if scans:
+        failures += 1
+        print(f"  FULL SCAN: {'; '.join(scans)}")
+
+engine.dispose()
+temp_dir.cleanup()
+
+if failures:
+    print(f"{failures} of {len(hot_queries)} hot queries fall back to a full table scan")
+    sys.exit(1)
+print(f"All {len(hot_queries)} hot queries use indexes")
@@ -0,0 +1,28 @@
+﻿import asyncio
+import sys
+
+if __name__ != "__main__":
+    raise Exception("Utility script, only run directly")
+
+from services.pubsub import BrokerServer, pubsub_url
+
+usage = "usage: python -m util.pubsub_broker [tcp://host:port | unix:///path/to/socket]  (defaults to PUBSUB_URL)"
+
+url = sys.argv[1] if len(sys.argv) > 1 else pubsub_url
+if not url or len(sys.argv) > 2:
+    print(usage)
+    sys.exit(2)
+
+async def serve():
+    broker = BrokerServer(url)
+    server = await broker.start()
+    print(f"Pub/sub broker listening on {url}")
+    async with server:
+        while True:
+            await asyncio.sleep(60)
+            print(f"Pub/sub broker: {broker.stats()}")
+
+try:
+    asyncio.run(serve())
+except KeyboardInterrupt:
+    pass
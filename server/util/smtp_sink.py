@@ -0,0 +1,85 @@
+﻿import argparse
+import asyncio
+from email import message_from_bytes
+
+if __name__ != "__main__":
+    raise Exception("Utility script, only run directly")
+
+# a stand-in SMTP server for local testing of the email outbox: accepts everything, prints
+# what it receives and can be told to fail, so retries and reconnects can be exercised.
+# Run the server with SMTP_HOST=localhost SMTP_PORT=8025 SMTP_STARTTLS=0
+
+parser = argparse.ArgumentParser(description="Local SMTP sink for testing outgoing email")
+parser.add_argument("--host", default="localhost")
+parser.add_argument("--port", type=int, default=8025)
+parser.add_argument("--fail-first", type=int, default=0, help="answer 451 to the first N messages")
+parser.add_argument("--refuse", default="", help="answer 550 to RCPT for addresses containing this")
+parser.add_argument("--drop-after", type=int, default=0, help="close each connection after N messages")
+args = parser.parse_args()
+
+stats = {"connections": 0, "messages": 0, "failed": 0}
+
+async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    stats["connections"] += 1
+    connection = stats["connections"]
+    received = 0
+
+    async def reply(line: str):
+        writer.write(line.encode() + b"\r\n")
+        await writer.drain()
+
+    await reply("220 smtp-sink ready")
+    recipients = []
+    try:
+        while line := await reader.readline():
+            command = line.decode(errors="replace").strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb in ("EHLO", "HELO"):
+                await reply("250 smtp-sink")
+            elif verb == "MAIL":
+                recipients = []
+                await reply("250 OK")
+            elif verb == "RCPT":
+                if args.refuse and args.refuse in command:
+                    await reply("550 no such user")
+                    continue
+                recipients.append(command.partition(":")[2].strip())
+                await reply("250 OK")
+            elif verb == "DATA":
+                await reply("354 end with <CRLF>.<CRLF>")
+                data = b""
+                while (chunk := await reader.readline()) not in (b".\r\n", b""):
+                    data += chunk[1:] if chunk.startswith(b"..") else chunk
+                if stats["failed"] < args.fail_first:
+                    stats["failed"] += 1
+                    await reply("451 try again later")
+                    continue
+                stats["messages"] += 1
+                received += 1
+                message = message_from_bytes(data)
+                print(f"[connection {connection}] {', '.join(recipients)}: {message['Subject']}", flush=True)
+                await reply("250 OK queued")
+                if args.drop_after and received >= args.drop_after:
+                    break
+            elif verb in ("RSET", "NOOP"):
+                await reply("250 OK")
+            elif verb == "QUIT":
+                await reply("221 bye")
+                break
+            else:
+                await reply("502 not implemented")
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def serve():
+    server = await asyncio.start_server(handle, args.host, args.port)
+    print(f"SMTP sink listening on {args.host}:{args.port}", flush=True)
+    async with server:
+        await server.serve_forever()
+
+try:
+    asyncio.run(serve())
+except KeyboardInterrupt:
+    print(stats)
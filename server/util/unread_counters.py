@@ -0,0 +1,30 @@
+﻿import sys
+from sqlmodel import Session
+
+if __name__ != "__main__":
+    raise Exception("Utility script, only run directly")
+
+from database import engine
+from migrations.runner import ensure_schema
+from model.unread_counter import UnreadCounter
+
+usage = "usage: python -m util.unread_counters rebuild|verify"
+
+if len(sys.argv) != 2 or sys.argv[1] not in ("rebuild", "verify"):
+    print(usage)
+    sys.exit(2)
+
+ensure_schema(engine)
+
+with Session(engine) as session:
+    if sys.argv[1] == "rebuild":
+        UnreadCounter.rebuild(session)
+        print("Unread counters rebuilt")
+    else:
+        mismatches = UnreadCounter.verify(session)
+        for row in mismatches:
+            print(f"channel {row.channel_id} user {row.user_id}: expected {row.expected_count}, stored {row.actual_count}")
+        if mismatches:
+            print(f"{len(mismatches)} unread counters out of date, run 'python -m util.unread_counters rebuild'")
+            sys.exit(1)
+        print("Unread counters OK")
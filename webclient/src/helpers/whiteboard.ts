@@ -0,0 +1,39 @@
+import type { DrawBatch, DrawStroke } from "@/components/WhiteBoard/Whiteboard.vue";
+
+// Decodes the binary whiteboard snapshot produced by server/services/whiteboard_store.py
+export function decodeWhiteboardSnapshot(channelId: string, snapshot: string): DrawBatch {
+    const bytes = Uint8Array.from(atob(snapshot), (c) => c.charCodeAt(0));
+    const view = new DataView(bytes.buffer);
+    const decoder = new TextDecoder();
+    const strokes: DrawStroke[] = [];
+
+    const paletteSize = view.getUint16(5, true);
+    let offset = 7;
+    const palette: string[] = [];
+    for (let i = 0; i < paletteSize; i++) {
+        const length = view.getUint8(offset);
+        palette.push(decoder.decode(bytes.subarray(offset + 1, offset + 1 + length)));
+        offset += 1 + length;
+    }
+
+    const strokeCount = view.getUint32(offset, true);
+    offset += 4;
+    for (let i = 0; i < strokeCount; i++) {
+        const colorIndex = view.getUint8(offset);
+        const lineWidth = view.getUint8(offset + 1);
+        const pointCount = view.getUint16(offset + 2, true);
+        offset += 4;
+        const points: number[] = [];
+        for (let p = 0; p < pointCount * 2; p++) {
+            points.push(view.getInt16(offset, true));
+            offset += 2;
+        }
+        strokes.push({
+            sender_id: "",
+            line_width: lineWidth,
+            line_color: palette[colorIndex],
+            points,
+        });
+    }
+    return { channel_id: channelId, strokes };
+}
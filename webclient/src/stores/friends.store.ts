@@ -6,6 +6,7 @@ interface FriendListStore {
     friendList: User[],
     incomingFriendRequests: User[],
     outgoingFriendRequests: User[],
+    presence: Record<string, string>,
     isLoading: boolean,
     error: string | null,
 }
@@ -30,11 +31,17 @@ export interface FriendStateUpdate {
   new_state: string;
 }
 
+export interface PresenceEntry {
+  user_id: string;
+  status: string;
+}
+
 export const useFriendsStore = defineStore("friends", {
   state: (): FriendListStore => ({
     friendList: [],
     incomingFriendRequests: [],
     outgoingFriendRequests: [],
+    presence: {},
     isLoading: true,
     error: null,
   }),
@@ -49,6 +56,10 @@ export const useFriendsStore = defineStore("friends", {
             fetchUserList("/api/user/incoming-friend-requests"),
             fetchUserList("/api/user/outgoing-friend-requests"),
         ]);
+        const response = await fetchWrapper.get("/api/presence/friends");
+        if (response.success) {
+          this.updatePresence(response.value as PresenceEntry[]);
+        }
       } catch (err: any) {
         this.error = err.message; 
       } finally {
@@ -70,6 +81,14 @@ export const useFriendsStore = defineStore("friends", {
         }
         return FriendState.Unknown;
     },
+    updatePresence(updates: PresenceEntry[]){
+      for (const entry of updates) {
+        this.presence[entry.user_id] = entry.status;
+      }
+    },
+    getPresence(userid: string){
+      return this.presence[userid] ?? "offline";
+    },
     updateFriendState(update: FriendStateUpdate){
       switch(update.new_state){
         case "accept-outgoing":